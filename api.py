@@ -1,15 +1,219 @@
-from fastapi import FastAPI, HTTPException, Request, Body
-from pydantic import BaseModel
-from generator import generate_content
-from store import ProjectStore, Page, Project
-from fastapi.responses import HTMLResponse
-from starlette.applications import Starlette
-from starlette.routing import Route, Mount
-from starlette.requests import Request as StarletteRequest
+from fastapi import FastAPI, HTTPException, Request, Body, Query
+import json
+from pydantic import BaseModel, Field
+import hmac
+import queue
+import random
+import threading
+import time
+import prefix
+import metrics
+from metrics import REQUEST_SECONDS, REQUESTS_IN_FLIGHT, TRACE
+from profiling import (
+    MAX_PROFILE_SECONDS,
+    SharedSlowTraces,
+    SlowTraces,
+    collapsed,
+    sample_stacks,
+)
+from typing import Callable, List, Literal, Mapping, Optional, Tuple
+from functools import lru_cache
+from generator import (
+    cacheable,
+    generate_content,
+    generate_content_stream,
+    generate_edit,
+    in_flight,
+    is_error,
+    llm_cache,
+    stream_content,
+    usage_log,
+)
+from patch import PatchError, apply_search_replace
+from jobs import Job, JobQueue
+from store import (
+    ProjectStore,
+    Page,
+    Project,
+    COMPRESSORS,
+    VersionConflict,
+    validate_asset_path,
+)
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
 from fastapi.middleware.cors import CORSMiddleware
+from responses import BlobResponse
+from archive import QueueReader, export_archive, import_archive
+import asyncio
+from pathlib import Path
+import mimetypes
 
 
-def create_app(project_store: ProjectStore):
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# upper bound on variations per batch request, and on how many run at once
+MAX_VARIATIONS = 8
+
+# blobs at least this big are served from their file through mmap rather
+# than read into (and kept in) the blob cache
+LARGE_BLOB_SIZE = 256 * 1024
+
+
+# the entity tag in If-None-Match that names content_hash or one of its
+# encoded variants ("<hash>-gzip", "<hash>-br"), so a 304 can send back the
+# tag of the representation the client has
+def matching_etag(if_none_match: str, content_hash: str) -> Optional[str]:
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return content_hash
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        base, _, encoding = tag.partition("-")
+        if base == content_hash and (not encoding or encoding in COMPRESSORS):
+            return tag
+    return None
+
+
+def etag_matches(if_none_match: str, content_hash: str) -> bool:
+    return matching_etag(if_none_match, content_hash) is not None
+
+
+# encodings we have precompressed variants for, in our order of preference
+def accepted_encodings(accept_encoding: str) -> List[str]:
+    qualities = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+    wildcard = qualities.get("*", 0.0)
+    return [
+        encoding
+        for encoding in ("br", "gzip")
+        if encoding in COMPRESSORS and qualities.get(encoding, wildcard) > 0
+    ]
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# <project>[_<version>] from a content host's subdomain; every request to a
+# project's pages asks, so the answers are cached
+@lru_cache(maxsize=4096)
+def parse_subdomain(subdomain: str) -> Tuple[str, Optional[str]]:
+    project_name, _, version_name = subdomain.partition("_")
+    return project_name, version_name or None
+
+
+def request_host(scope) -> str:
+    for name, value in scope["headers"]:
+        if name == b"host":
+            return value.decode("latin-1")
+    return ""
+
+
+class HostRouter:
+    # dispatches on the Host header read straight from the ASGI scope:
+    # api.<domain> goes to the api app, anything else to a project's content.
+    # Page requests (GET / or /<page>) skip FastAPI's routing and validation
+    # and go straight to page_response; everything else on a content host
+    # (static files, errors) still goes through the content app. Requests
+    # are timed by the endpoint the app routed them to, and traced when
+    # slow_traces has a threshold
+    def __init__(
+        self,
+        api: FastAPI,
+        content: FastAPI,
+        page_response: Callable,
+        slow_traces: SlowTraces = None,
+    ):
+        self.api = api
+        self.content = content
+        self.page_response = page_response
+        self.slow_traces = slow_traces or SlowTraces()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            # startup and shutdown hooks belong on the api app
+            await self.api(scope, receive, send)
+            return
+
+        host = request_host(scope)
+        app = "api" if host.startswith("api.") else "content"
+        # read once: tracing may be turned off while the request runs
+        threshold = self.slow_traces.threshold
+        trace = token = None
+        if threshold is not None:
+            trace = []
+            token = TRACE.set(trace)
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc(app)
+        try:
+            if app == "api":
+                await self.api(scope, receive, send)
+            else:
+                await self.serve_content(scope, receive, send, host)
+        finally:
+            seconds = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec(app)
+            endpoint = scope.get("endpoint")
+            route = endpoint.__name__ if endpoint else "unmatched"
+            if token is not None:
+                TRACE.reset(token)
+                if seconds >= threshold:
+                    self.slow_traces.record(scope, app, route, seconds, trace)
+            REQUEST_SECONDS.observe(seconds, app, route)
+
+    async def serve_content(self, scope, receive, send, host: str):
+        subdomain = host.split(".")[0] if "." in host else None
+        scope["subdomain"] = subdomain
+        path = scope["path"]
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD") and "/" not in path[1:]:
+            scope["endpoint"] = self.page_response
+            response = await run_in_threadpool(
+                self.page_response,
+                Headers(scope=scope),
+                *parse_subdomain(subdomain or ""),
+                path[1:],
+            )
+            await response(scope, receive, send)
+            return
+        await self.content(scope, receive, send)
+
+
+# uploads_path holds static files per project (uploads/<project>/...) that
+# pages can reference as /static/...; admin_token enables the /v0/admin
+# endpoints, and requests slower than slow_request_seconds are traced.
+# Worker processes given the same metrics_path (a sqlite file) report
+# metrics and slow requests for all of them, whichever one is asked
+def create_app(
+    project_store: ProjectStore,
+    job_queue: JobQueue = None,
+    uploads_path: Path = None,
+    admin_token: str = None,
+    slow_request_seconds: float = None,
+    metrics_path: Path = None,
+):
+    if job_queue is None:
+        job_queue = JobQueue()
+    if metrics_path:
+        slow_traces = SharedSlowTraces(metrics_path, slow_request_seconds)
+        shared_samples = metrics.SharedSamples(metrics_path)
+    else:
+        slow_traces = SlowTraces(slow_request_seconds)
+        shared_samples = None
+    profiling = threading.Lock()
+
     api = FastAPI(
         title="Codette API",
         description="API for managing projects and pages",
@@ -30,9 +234,111 @@ def create_app(project_store: ProjectStore):
     async def root():
         return api.openapi()
 
+    # counters kept elsewhere (cache hit rates, job states), read at
+    # scrape time
+    def scrape_metrics() -> List[metrics.Metric]:
+        cache_requests = metrics.Counter(
+            "codette_cache_requests_total", "Cache lookups", ["cache", "result"]
+        )
+        cache_bytes = metrics.Gauge("codette_cache_bytes", "Bytes held in a cache", ["cache"])
+        for name, cache in [
+            ("project", project_store.project_cache),
+            ("blob", project_store.blob_cache),
+            ("llm", llm_cache),
+        ]:
+            cache_requests.inc(name, "hit", amount=cache.hits)
+            cache_requests.inc(name, "miss", amount=cache.misses)
+        cache_bytes.set(project_store.blob_cache.bytes, "blob")
+        coalesced = metrics.Counter(
+            "codette_generate_coalesced_total", "Generation calls that shared another's result"
+        )
+        coalesced.inc(amount=in_flight.coalesced)
+        jobs = metrics.Gauge("codette_jobs", "Generation jobs by status", ["status"])
+        for status in ("queued", "running", "done", "error"):
+            jobs.set(0, status)
+        for job in list(job_queue.jobs.values()):
+            jobs.inc(job.status)
+        return [cache_requests, cache_bytes, coalesced, jobs]
+
+    def collect_metrics() -> List[metrics.Metric]:
+        return [*metrics.REGISTRY.metrics, *scrape_metrics()]
+
+    if shared_samples:
+        shared_samples.start(collect_metrics)
+        slow_traces.start()
+
+    @api.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        if shared_samples:
+            shared_samples.flush(collect_metrics())
+            return Response(shared_samples.render(), media_type=metrics.CONTENT_TYPE)
+        return Response(
+            metrics.REGISTRY.render(scrape_metrics()), media_type=metrics.CONTENT_TYPE
+        )
+
+    # without a token the admin endpoints don't exist
+    def check_admin(request: Request):
+        if not admin_token:
+            raise HTTPException(status_code=404, detail="Not Found")
+        expected = f"Bearer {admin_token}".encode()
+        if not hmac.compare_digest(request.headers.get("authorization", "").encode(), expected):
+            raise HTTPException(status_code=401, detail="Invalid admin token")
+
+    # samples every thread for a while and returns collapsed stacks, e.g.
+    # curl -H "Authorization: Bearer $TOKEN" .../v0/admin/profile?seconds=30 | flamegraph.pl
+    @api.get("/v0/admin/profile", include_in_schema=False)
+    def profile(
+        request: Request,
+        seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS),
+        interval: float = Query(0.005, ge=0.001, le=1),
+        idle: bool = False,
+    ):
+        check_admin(request)
+        if not profiling.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="A profile is already running")
+        try:
+            stacks = sample_stacks(seconds, interval, idle)
+        finally:
+            profiling.release()
+        return Response(collapsed(stacks), media_type="text/plain")
+
+    @api.get("/v0/admin/slow-requests", include_in_schema=False)
+    def list_slow_requests(request: Request):
+        check_admin(request)
+        return {"threshold": slow_traces.threshold, "requests": slow_traces.list()}
+
+    # threshold in seconds; leaving it out turns tracing off
+    @api.put("/v0/admin/slow-requests", include_in_schema=False)
+    def set_slow_request_threshold(
+        request: Request, threshold: Optional[float] = Query(None, gt=0)
+    ):
+        check_admin(request)
+        slow_traces.threshold = threshold
+        return {"threshold": slow_traces.threshold, "requests": slow_traces.list()}
+
+    @api.get("/v0/stats")
+    def stats():
+        return {
+            "project_cache": project_store.project_cache.stats(),
+            "blob_cache": project_store.blob_cache.stats(),
+            "generation": {
+                "coalesced": in_flight.coalesced,
+                "usage": usage_log.stats(),
+            },
+            "llm_cache": llm_cache.stats(),
+        }
+
+    # one summary per project from the version index; versions=true also
+    # lists every version of each project, newest first
     @api.get("/v0/projects")
-    def list_projects():
-        return project_store.list_projects()
+    def list_projects(
+        response: Response,
+        limit: int = Query(100, ge=1, le=1000),
+        offset: int = Query(0, ge=0),
+        versions: bool = False,
+    ):
+        response.headers["X-Total-Count"] = str(project_store.count_projects())
+        return project_store.list_projects(limit, offset, include_versions=versions)
 
     @api.post("/v0/projects", status_code=201)
     def create_project(project: Project):
@@ -50,89 +356,458 @@ def create_app(project_store: ProjectStore):
         except FileNotFoundError as e:
             raise HTTPException(status_code=404, detail=str(e))
 
+    # a tar of every version of the projects and the blobs they use, for
+    # backups and moving projects between instances; see archive.py
+    @api.get("/v0/export")
+    def export_projects(project: List[str] = Query(None)):
+        names = project or project_store.index.projects()
+        missing = [name for name in names if not project_store.exists(name)]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Projects not found: {missing}")
+        filename = names[0] if len(names) == 1 else "codette"
+        return StreamingResponse(
+            export_archive(project_store, names),
+            media_type="application/x-tar",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.tar"'},
+        )
+
+    @api.get("/v0/projects/{project_name}/export")
+    def export_project(project_name: str):
+        return export_projects([project_name])
+
+    # the archive is read as it is uploaded, on a worker thread, so it never
+    # has to fit in memory or be spooled to disk first
+    @api.post("/v0/import")
+    async def import_projects(request: Request):
+        reader = QueueReader()
+
+        def run():
+            try:
+                return import_archive(project_store, reader)
+            finally:
+                reader.stop()
+
+        task = asyncio.ensure_future(run_in_threadpool(run))
+        try:
+            async for chunk in request.stream():
+                if task.done():
+                    break
+                await run_in_threadpool(reader.feed, chunk)
+        except BaseException:
+            # a disconnect or cancellation: the import fails on its next
+            # read, and nobody is left to see its error
+            reader.abort()
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            raise
+        await run_in_threadpool(reader.finish)
+        try:
+            return await task
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
     @api.get("/v0/projects/{project_name}/versions")
     def list_project_versions(project_name: str):
         return project_store.list_project_versions(project_name)
 
+    # expected_version makes the write a compare-and-swap against the
+    # project's latest version; a stale one gets a 409
     @api.post("/v0/projects/{project_name}/pages", status_code=201)
-    def create_or_update_page(project_name: str, page: Page):
-        return project_store.create_or_update_page(
-            project_name, page.name, page.content
-        )
+    def create_or_update_page(
+        project_name: str, page: Page, expected_version: Optional[str] = None
+    ):
+        try:
+            return project_store.create_or_update_page(
+                project_name, page.name, page.content, expected_version=expected_version
+            )
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
 
     # FIXME(ja): we should be able to send more context here (not just the prompt, but other resources
     # to include in the context (api docs, other pages, list of static files, ...)
     class GeneratePageRequest(BaseModel):
         prompt: str
+        # "edit" asks for a patch against the current page, "full" for the
+        # whole document, and "auto" edits whenever there is a page to edit
+        mode: Literal["auto", "edit", "full"] = "auto"
+
+    def load_existing(project_name: str, page_name: str) -> Optional[str]:
+        page = project_store.load_page(project_name, page_name)
+        if page:
+            return project_store.load_content(project_name, page.content_hash)
+        return None
+
+    def build_messages(existing_content: Optional[str], prompt: str) -> List:
+        messages = []
+        if existing_content:
+            messages.append(f"What is the current page content?")
+            # repeated edits of a page resend it, so let the provider cache it
+            messages.append(cacheable(existing_content))
+        messages.append(prompt)
+        return messages
+
+    def edit(existing_content: str, messages: List) -> Tuple[Optional[str], dict]:
+        result = generate_edit(messages)
+        if is_error(result):
+            return None, {"mode": "full", "fallback": "edit request failed"}
+        try:
+            content = apply_search_replace(existing_content, result["patch"])
+        except PatchError as e:
+            return None, {"mode": "full", "fallback": str(e)}
+        # estimate what re-emitting the whole page would have cost from the
+        # tokens per character the model spent on the patch
+        output_tokens = result["output_tokens"]
+        full_estimate = round(output_tokens * len(content) / max(len(result["patch"]), 1))
+        return content, {
+            "mode": "edit",
+            "output_tokens": output_tokens,
+            "full_output_tokens_estimate": full_estimate,
+            "saved_output_tokens": max(full_estimate - output_tokens, 0),
+        }
+
+    # with on_chunk the page is streamed to it as it is written (an edit
+    # arrives as the whole patched page at once)
+    def generate(
+        project_name: str,
+        page_name: str,
+        prompt: str,
+        mode: str = "auto",
+        on_chunk: Callable[[str], None] = None,
+    ) -> dict:
+        existing_content = load_existing(project_name, page_name)
+        messages = build_messages(existing_content, prompt)
 
-    @api.post("/v0/projects/{project_name}/pages/{page_name}/generate", status_code=201)
+        content, report = None, {"mode": "full"}
+        if existing_content and mode in ("auto", "edit"):
+            content, report = edit(existing_content, messages)
+        if content is None and on_chunk:
+            content = stream_content(messages, on_chunk, generate_content_stream)
+        elif content is None:
+            content = generate_content(messages)
+        elif on_chunk:
+            on_chunk(content)
+        if is_error(content):
+            # fails the job rather than saving the error page as a version
+            message = content.partition("<p>")[2].partition("</p>")[0]
+            raise RuntimeError(f"Generation failed: {message}")
+        usage_log.record_edit(report)
+
+        # FIXME(ja): we should save more context here ... like the parent or ...
+        project = project_store.create_or_update_page(project_name, page_name, content)
+        return {"project": project, "report": report}
+
+    @api.post("/v0/projects/{project_name}/pages/{page_name}/generate", status_code=202)
     def generate_page(
+        project_name: str,
+        page_name: str,
+        response: Response,
+        request: GeneratePageRequest = Body(...),
+    ) -> Job:
+        if not project_store.exists(project_name):
+            raise HTTPException(status_code=404, detail=f"Project {project_name} not found")
+        job = job_queue.submit(
+            project_name,
+            page_name,
+            lambda: generate(project_name, page_name, request.prompt, request.mode),
+        )
+        response.headers["Location"] = f"/v0/jobs/{job.id}"
+        return job
+
+    # streams the page as server-sent events: "job" names the generation
+    # job (it runs on the job queue like any other, so waits its turn), then
+    # "chunk" events carry text as it is written and "done" carries the
+    # saved project (or "error")
+    @api.post("/v0/projects/{project_name}/pages/{page_name}/generate/stream")
+    def generate_page_stream(
         project_name: str, page_name: str, request: GeneratePageRequest = Body(...)
     ):
-        messages = []
+        if not project_store.exists(project_name):
+            raise HTTPException(status_code=404, detail=f"Project {project_name} not found")
+        chunks = queue.Queue()
+        job = job_queue.submit(
+            project_name,
+            page_name,
+            lambda: generate(project_name, page_name, request.prompt, request.mode, chunks.put),
+            lambda job: chunks.put(None),
+        )
 
-        page = project_store.load_page(project_name, page_name)
-        if page:
-            existing_content = project_store.load_content(
-                project_name, page.content_hash
+        def events():
+            yield sse("job", {"id": job.id})
+            while (chunk := chunks.get()) is not None:
+                yield sse("chunk", chunk)
+            if job.status == "error":
+                yield sse("error", {"error": job.error})
+                return
+            yield sse("done", job.result["project"].model_dump())
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    class VariationsRequest(BaseModel):
+        prompt: str
+        # either how many random style prefixes to try, or the prefixes
+        count: Optional[int] = Field(None, ge=1, le=MAX_VARIATIONS)
+        prefixes: Optional[List[str]] = Field(None, min_length=1, max_length=MAX_VARIATIONS)
+        concurrency: int = Field(4, ge=1, le=MAX_VARIATIONS)
+
+    # generates the page once per style prefix, concurrently, saving each
+    # as <page>-v<n>; a "variation" event is sent as each one is saved, then
+    # "done" compares the wall clock with running them one after another
+    @api.post("/v0/projects/{project_name}/pages/{page_name}/variations")
+    def generate_variations(
+        project_name: str, page_name: str, request: VariationsRequest = Body(...)
+    ):
+        if not project_store.exists(project_name):
+            raise HTTPException(status_code=404, detail=f"Project {project_name} not found")
+        styles = request.prefixes or random.sample(prefix.prefixs, request.count or 4)
+        existing_content = load_existing(project_name, page_name)
+
+        def variation(i: int, style: str) -> dict:
+            start = time.perf_counter()
+            messages = build_messages(existing_content, f"{style}\n\n{request.prompt}")
+            content = generate_content(messages)
+            generated = time.perf_counter() - start
+            result = {"index": i, "page": f"{page_name}-v{i + 1}", "prefix": style}
+            if is_error(content):
+                return {**result, "error": content, "seconds": generated}
+            project = project_store.create_or_update_page(project_name, result["page"], content)
+            seconds = time.perf_counter() - start
+            return {**result, "version": project.version, "seconds": seconds}
+
+        # at most request.concurrency variations are queued at a time, and
+        # they run as jobs so the queue's global and per-project limits
+        # apply across every batch
+        def events():
+            start = time.perf_counter()
+            sequential = 0.0
+            finished = queue.Queue()
+            pending = iter(enumerate(styles))
+
+            def submit_next():
+                item = next(pending, None)
+                if item is not None:
+                    i, style = item
+                    job_queue.submit(
+                        project_name,
+                        f"{page_name}-v{i + 1}",
+                        lambda: variation(i, style),
+                        lambda job: finished.put((i, style, job)),
+                    )
+
+            for _ in range(request.concurrency):
+                submit_next()
+            for _ in styles:
+                i, style, job = finished.get()
+                submit_next()
+                result = job.result
+                if job.status == "error":
+                    result = {
+                        "index": i,
+                        "page": f"{page_name}-v{i + 1}",
+                        "prefix": style,
+                        "error": job.error,
+                        "seconds": job.finished - job.started,
+                    }
+                sequential += result["seconds"]
+                yield sse("error" if "error" in result else "variation", result)
+            wall = time.perf_counter() - start
+            yield sse(
+                "done",
+                {
+                    "variations": len(styles),
+                    "wall_seconds": wall,
+                    "sequential_seconds": sequential,
+                    "speedup": sequential / wall if wall else None,
+                },
             )
-            if existing_content:
-                messages.append(f"What is the current page content?")
-                messages.append(existing_content)
 
-        messages.append(request.prompt)
-        content = generate_content(messages)
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
-        # FIXME(ja): we should save more context here ... like the parent or ...
-        return project_store.create_or_update_page(project_name, page_name, content)
+    @api.get("/v0/jobs/{job_id}")
+    def get_job(job_id: str) -> Job:
+        job = job_queue.get(job_id)
+        if not job:
+            raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+        return job
 
     @api.delete("/v0/projects/{project_name}/pages/{page_name}")
-    def delete_page(project_name: str, page_name: str):
+    def delete_page(project_name: str, page_name: str, expected_version: Optional[str] = None):
         # FIXME(ja): we should support mutating versions other than the latest
-        return project_store.delete_page(project_name, page_name)
+        try:
+            return project_store.delete_page(
+                project_name, page_name, expected_version=expected_version
+            )
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+    def blob_response(
+        request_headers: Mapping[str, str],
+        content_hash: str,
+        media_type: str,
+        headers: dict,
+        encoding=None,
+    ) -> BlobResponse:
+        path = project_store.blob_file(content_hash, encoding)
+        if path is not None and path.stat().st_size >= LARGE_BLOB_SIZE:
+            return BlobResponse(
+                path=path, media_type=media_type, headers=headers, request_headers=request_headers
+            )
+        content = project_store.load_blob(content_hash, encoding)
+        return BlobResponse(
+            content=content, media_type=media_type, headers=headers, request_headers=request_headers
+        )
+
+    # the body is hashed as it streams to disk, so uploads never sit in
+    # memory, and identical files are only stored once across projects and
+    # versions
+    @api.put("/v0/projects/{project_name}/assets/{path:path}", status_code=201)
+    async def upload_asset(
+        request: Request, project_name: str, path: str, expected_version: Optional[str] = None
+    ):
+        if not project_store.exists(project_name):
+            raise HTTPException(status_code=404, detail=f"Project {project_name} not found")
+        try:
+            validate_asset_path(path)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        with project_store.blob_writer() as writer:
+            async for chunk in request.stream():
+                await run_in_threadpool(writer.write, chunk)
+            content_hash = await run_in_threadpool(writer.finish)
+        media_type = mimetypes.guess_type(path)[0] or request.headers.get("content-type")
+        try:
+            return await run_in_threadpool(
+                project_store.save_asset,
+                project_name,
+                path,
+                content_hash,
+                writer.size,
+                media_type,
+                expected_version=expected_version,
+            )
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+    @api.get("/v0/projects/{project_name}/assets")
+    def list_assets(project_name: str):
+        try:
+            return project_store.load_project(project_name).assets
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
+    @api.delete("/v0/projects/{project_name}/assets/{path:path}")
+    def delete_asset(project_name: str, path: str, expected_version: Optional[str] = None):
+        try:
+            return project_store.delete_asset(
+                project_name, path, expected_version=expected_version
+            )
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except VersionConflict as e:
+            raise HTTPException(status_code=409, detail=str(e))
 
     @api.get("/v0/projects/{project_name}/raw/{page_name}")
-    def get_page_raw(project_name: str, page_name: str):
+    def get_page_raw(request: Request, project_name: str, page_name: str):
         # FIXME(ja): we should support loading raw content for older versions
-        content = project_store.load_content(project_name, page_name)
-        return HTMLResponse(content=content)
+        try:
+            return blob_response(
+                request.headers, page_name, "text/html", {"ETag": f'"{page_name}"'}
+            )
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
 
-    @content.get("/{page_name}")
-    @content.get("/")
-    def serve_page(request: Request, page_name: str = None):
-        subdomain = request.scope.get("subdomain")
-        if "_" in subdomain:
-            project_name, version_name = subdomain.split("_")
-        else:
-            project_name = subdomain
-            version_name = None
+    # assets uploaded to a project, e.g. data a page fetches; files under
+    # uploads_path are served for projects that predate asset uploads
+    @content.get("/static/{path:path}")
+    def serve_static(request: Request, path: str):
+        project_name, version_name = parse_subdomain(request.scope.get("subdomain") or "")
+        try:
+            asset = project_store.load_asset(project_name, path, version_name)
+        except FileNotFoundError:
+            asset = None
+        if asset:
+            headers = {
+                "ETag": f'"{asset.content_hash}"',
+                "Cache-Control": IMMUTABLE if version_name else REVALIDATE,
+            }
+            if etag_matches(request.headers.get("if-none-match"), asset.content_hash):
+                return Response(status_code=304, headers=headers)
+            return blob_response(
+                request.headers, asset.content_hash, asset.media_type, headers
+            )
 
+        if uploads_path is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        root = (uploads_path / project_name).resolve()
+        file_path = (root / path).resolve()
+        if not file_path.is_relative_to(root) or not file_path.is_file():
+            raise HTTPException(status_code=404, detail="File not found")
+
+        st = file_path.stat()
+        tag = f"{st.st_mtime_ns:x}{st.st_size:x}"
+        headers = {"ETag": f'"{tag}"', "Cache-Control": REVALIDATE}
+        if etag_matches(request.headers.get("if-none-match"), tag):
+            return Response(status_code=304, headers=headers)
+        media_type = mimetypes.guess_type(file_path.name)[0] or "application/octet-stream"
+        return BlobResponse(
+            path=file_path, media_type=media_type, headers=headers, request_headers=request.headers
+        )
+
+    # shared by the content app and HostRouter's fast path, so it works from
+    # the raw request headers rather than a Request
+    def page_response(
+        request_headers: Mapping[str, str],
+        project_name: str,
+        version_name: Optional[str],
+        page_name: Optional[str],
+    ) -> Response:
         if not page_name:
             page_name = "index"
 
-        page = project_store.load_page(project_name, page_name, version=version_name)
+        try:
+            page = project_store.load_page(project_name, page_name, version=version_name)
+        except FileNotFoundError:
+            page = None
         if page:
-            content = project_store.load_content(project_name, page.content_hash)
-            return HTMLResponse(content=content)
+            # the content hash is a strong validator, and pinned versions
+            # can never change what they serve
+            headers = {
+                "ETag": f'"{page.content_hash}"',
+                "Cache-Control": IMMUTABLE if version_name else REVALIDATE,
+                "Vary": "Accept-Encoding",
+            }
+            tag = matching_etag(request_headers.get("if-none-match"), page.content_hash)
+            if tag:
+                return Response(status_code=304, headers={**headers, "ETag": f'"{tag}"'})
 
-        raise HTTPException(status_code=404, detail="Page not found")
+            for encoding in accepted_encodings(request_headers.get("accept-encoding")):
+                encoded = {
+                    **headers,
+                    "ETag": f'"{page.content_hash}-{encoding}"',
+                    "Content-Encoding": encoding,
+                }
+                try:
+                    return blob_response(
+                        request_headers, page.content_hash, "text/html", encoded, encoding
+                    )
+                except FileNotFoundError:
+                    continue
 
-    async def router(scope, receive, send):
-        if scope["type"] == "http":
-            request = StarletteRequest(scope, receive)
-            host = request.headers.get("host", "")
-
-            if host.startswith("api."):
-                await api(scope, receive, send)
-            else:
-                subdomain = host.split(".")[0] if "." in host else None
-                scope["subdomain"] = subdomain
+            return blob_response(request_headers, page.content_hash, "text/html", headers)
 
-                await content(scope, receive, send)
-        else:
-            # Handle other types of requests (e.g., WebSocket)
-            raise NotImplementedError(f"Unsupported scope type: {scope['type']}")
+        return JSONResponse(status_code=404, content={"detail": "Page not found"})
 
-    app = Starlette(routes=[Mount("/", app=router)])
+    @content.get("/{page_name}")
+    @content.get("/")
+    def serve_page(request: Request, page_name: str = None):
+        project_name, version_name = parse_subdomain(request.scope.get("subdomain") or "")
+        return page_response(request.headers, project_name, version_name, page_name)
 
-    return app
+    return HostRouter(api, content, page_response, slow_traces)
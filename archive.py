@@ -0,0 +1,278 @@
+import hashlib
+import io
+import json
+import mimetypes
+import queue
+import re
+import tarfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List
+from store import Asset, Page, Project, ProjectStore, validate_name
+
+# an archive is a tar stream of
+#   projects/<name>/<seq>.json   every version of a project, oldest first,
+#                                as the project json plus its "updated" time
+#   blobs/<sha256>               each blob any of those versions uses, once
+# manifests for a project come before the blobs it adds, but readers
+# shouldn't rely on the order
+
+CHUNK_SIZE = 1024 * 1024
+
+# imported blobs smaller than this get precompressed variants, like content
+# stored through the api
+MAX_COMPRESS_SIZE = 1024 * 1024
+
+MANIFEST = re.compile(r"projects/([a-z0-9-]+)/(\d+)\.json")
+BLOB = re.compile(r"blobs/([0-9a-f]{64})")
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def tar_entry(name: str, size: int, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        yield chunk
+    if written != size:
+        raise ArchiveError(f"{name} was {written} bytes, expected {size}")
+    if size % tarfile.BLOCKSIZE:
+        yield b"\0" * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+
+def file_chunks(path: Path) -> Iterator[bytes]:
+    with path.open("rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def blob_chunks(store: ProjectStore, content_hash: str) -> Iterator[bytes]:
+    path = store.blob_file(content_hash)
+    if path is None:
+        yield store.blobs.get(content_hash)
+        return
+    yield from file_chunks(path)
+
+
+def blob_size(store: ProjectStore, content_hash: str) -> int:
+    path = store.blob_file(content_hash)
+    return path.stat().st_size if path else len(store.blobs.get(content_hash))
+
+
+# the tar is produced entry by entry and blobs are read in chunks, so the
+# whole archive never has to fit in memory
+def export_archive(store: ProjectStore, project_names: List[str]) -> Iterator[bytes]:
+    exported = set()
+    for name in project_names:
+        blobs = []
+        for seq, location in enumerate(store.index.locations(name)):
+            project = store.load_project(name, location.version)
+            data = json.dumps({**project.model_dump(), "updated": location.updated}).encode()
+            yield from tar_entry(f"projects/{name}/{seq:06d}.json", len(data), [data])
+            for content_hash in [p.content_hash for p in project.pages] + [
+                a.content_hash for a in project.assets
+            ]:
+                if content_hash and content_hash not in exported:
+                    exported.add(content_hash)
+                    blobs.append(content_hash)
+        for content_hash in blobs:
+            yield from tar_entry(
+                f"blobs/{content_hash}",
+                blob_size(store, content_hash),
+                blob_chunks(store, content_hash),
+            )
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+# a directory as an archive of one version of one project: html files
+# become pages, anything else an asset. Files are read once to hash them
+# and again to send them, so none has to fit in memory
+def directory_archive(name: str, path: Path) -> Iterator[bytes]:
+    pages, assets, files = [], [], {}
+    for file_path in sorted(path.iterdir()):
+        if not file_path.is_file():
+            continue
+        digest, size = hashlib.sha256(), 0
+        for chunk in file_chunks(file_path):
+            digest.update(chunk)
+            size += len(chunk)
+        content_hash = digest.hexdigest()
+        files[content_hash] = (file_path, size)
+        if file_path.suffix == ".html":
+            pages.append(
+                Page(name=file_path.stem, title=file_path.stem, content_hash=content_hash)
+            )
+        else:
+            assets.append(
+                Asset(
+                    path=file_path.name,
+                    content_hash=content_hash,
+                    size=size,
+                    media_type=mimetypes.guess_type(file_path.name)[0]
+                    or "application/octet-stream",
+                )
+            )
+    project = Project(name=name, pages=pages, assets=assets)
+    data = json.dumps({**project.model_dump(), "updated": time.time()}).encode()
+    yield from tar_entry(f"projects/{name}/000000.json", len(data), [data])
+    for content_hash, (file_path, size) in files.items():
+        yield from tar_entry(f"blobs/{content_hash}", size, file_chunks(file_path))
+    yield b"\0" * (tarfile.BLOCKSIZE * 2)
+
+
+def _import_blob(store: ProjectStore, content_hash: str, f: BinaryIO, report: Dict):
+    if store.blobs.has(content_hash):
+        report["blobs_skipped"] += 1
+        return
+    with store.blob_writer() as writer:
+        while chunk := f.read(CHUNK_SIZE):
+            writer.write(chunk)
+        if writer.hash.hexdigest() != content_hash:
+            raise ArchiveError(f"blobs/{content_hash} doesn't match its hash")
+        writer.finish()
+    if writer.size < MAX_COMPRESS_SIZE:
+        store._compress_content(content_hash, store.blobs.get(content_hash))
+    report["blobs_written"] += 1
+    report["bytes_written"] += writer.size
+
+
+# blobs are written as they are read, skipping ones we already have;
+# versions are only saved once the whole archive has been read and every
+# blob they use is present, and projects that already exist are left alone
+def import_archive(store: ProjectStore, f: BinaryIO) -> Dict:
+    report = {
+        "projects": [],
+        "existing": [],
+        "versions": 0,
+        "blobs_written": 0,
+        "blobs_skipped": 0,
+        "bytes_written": 0,
+    }
+    manifests: Dict[str, List] = {}
+    try:
+        with tarfile.open(fileobj=f, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if match := BLOB.fullmatch(member.name):
+                    _import_blob(store, match.group(1), tar.extractfile(member), report)
+                elif match := MANIFEST.fullmatch(member.name):
+                    data = json.load(tar.extractfile(member))
+                    manifests.setdefault(match.group(1), []).append((int(match.group(2)), data))
+    except tarfile.TarError as e:
+        raise ArchiveError(f"Not a valid archive: {e}")
+
+    versions = {}
+    for name, entries in manifests.items():
+        validate_name(name)
+        versions[name] = []
+        for _, data in sorted(entries, key=lambda entry: entry[0]):
+            updated = data.pop("updated", None)
+            project = Project.model_validate({**data, "name": name})
+            for content_hash in [p.content_hash for p in project.pages] + [
+                a.content_hash for a in project.assets
+            ]:
+                if content_hash and not store.blobs.has(content_hash):
+                    raise ArchiveError(
+                        f"{name} {project.version} uses missing blob {content_hash}"
+                    )
+            versions[name].append((project, updated))
+
+    for name, projects in versions.items():
+        with store.lock(name):
+            if store.exists(name):
+                report["existing"].append(name)
+                continue
+            for project, updated in projects:
+                store.save_project(project, updated=updated)
+            report["projects"].append(name)
+            report["versions"] += len(projects)
+    return report
+
+
+# a blocking file object fed from another thread, so a synchronous tar
+# reader can consume a request body as it arrives; feed() blocks while the
+# reader is behind, which keeps memory bounded
+class QueueReader(io.RawIOBase):
+    def __init__(self, maxsize: int = 16):
+        self.queue = queue.Queue(maxsize)
+        self.buffer = memoryview(b"")
+        self.eof = False
+        self.stopped = False
+        self.aborted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def feed(self, data: bytes):
+        while not self.stopped:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self):
+        self.feed(b"")
+
+    # the consumer is done (or failed); later feeds are dropped
+    def stop(self):
+        self.stopped = True
+
+    # the producer gave up part way (e.g. the client went away), so reads
+    # fail rather than wait for data that's never coming or see a clean end
+    def abort(self):
+        self.aborted = True
+
+    def readinto(self, b) -> int:
+        while not self.buffer and not self.eof:
+            if self.aborted:
+                raise ArchiveError("The upload ended before the archive did")
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk:
+                self.buffer = memoryview(chunk)
+            else:
+                self.eof = True
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Codette project archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="write projects to a tar archive")
+    export.add_argument("path", help="store path, e.g. ./prod")
+    export.add_argument("projects", nargs="*", help="defaults to every project")
+    export.add_argument("-o", "--output", help="defaults to stdout")
+
+    load = subparsers.add_parser("import", help="add the projects in a tar archive")
+    load.add_argument("path", help="store path, e.g. ./prod")
+    load.add_argument("archive", nargs="?", help="defaults to stdin")
+
+    args = parser.parse_args()
+    store = ProjectStore(Path(args.path))
+
+    if args.command == "export":
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        with out:
+            for chunk in export_archive(store, args.projects or store.index.projects()):
+                out.write(chunk)
+    elif args.command == "import":
+        with open(args.archive, "rb") if args.archive else sys.stdin.buffer as f:
+            print(json.dumps(import_archive(store, f), indent=2))
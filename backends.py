@@ -0,0 +1,254 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+from urllib.parse import urlparse
+from utils import atomic_write, sqlite_conn
+
+
+class Stat(NamedTuple):
+    size: int
+    mtime: float
+
+
+class Backend(ABC):
+    # flat key/value storage for manifests and blobs; keys are
+    # "/"-separated paths relative to the store root, e.g. content/<sha256>
+    @abstractmethod
+    def get(self, key: str) -> bytes: ...
+
+    @abstractmethod
+    def put(self, key: str, data: bytes): ...
+
+    @abstractmethod
+    def delete(self, key: str): ...
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[Stat]: ...
+
+    # every key starting with prefix, in no particular order
+    @abstractmethod
+    def keys(self, prefix: str = "") -> Iterator[str]: ...
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    # store a local file under key; the file may be moved rather than copied
+    def put_file(self, key: str, path: Path):
+        self.put(key, path.read_bytes())
+
+    # object stores can't append, so the default rewrites the whole object
+    def append(self, key: str, data: bytes):
+        try:
+            existing = self.get(key)
+        except FileNotFoundError:
+            existing = b""
+        self.put(key, existing + data)
+
+    # a local file holding the object, when there is one, so it can be
+    # served without copying it through python
+    def path(self, key: str) -> Optional[Path]:
+        return None
+
+
+class FilesystemBackend(Backend):
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> bytes:
+        try:
+            return (self.root / key).read_bytes()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise FileNotFoundError(f"{key} not found")
+
+    def put(self, key: str, data: bytes):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, data)
+
+    def put_file(self, key: str, path: Path):
+        target = self.root / key
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError:
+            # on another filesystem: copy next to the target, then rename
+            fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+            os.close(fd)
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+
+    def append(self, key: str, data: bytes):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("ab") as f:
+            f.write(data)
+
+    def delete(self, key: str):
+        try:
+            (self.root / key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def stat(self, key: str) -> Optional[Stat]:
+        try:
+            st = (self.root / key).stat()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return Stat(st.st_size, st.st_mtime) if os.path.isfile(self.root / key) else None
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        # walk from the deepest directory the prefix names
+        directory, _, _ = prefix.rpartition("/")
+        top = self.root / directory
+        for dirpath, _, filenames in os.walk(top):
+            rel = Path(dirpath).relative_to(self.root).as_posix()
+            for name in filenames:
+                key = name if rel == "." else f"{rel}/{name}"
+                if key.startswith(prefix) and not name.startswith(".tmp-"):
+                    yield key
+
+    def path(self, key: str) -> Optional[Path]:
+        path = self.root / key
+        return path if path.is_file() else None
+
+
+class SQLiteBackend(Backend):
+    # everything in one database file, which is easy to copy or replicate
+    # (e.g. with litestream) off a single machine
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            " key TEXT PRIMARY KEY, data BLOB NOT NULL, mtime REAL NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite_conn(self._local, self.path)
+
+    def get(self, key: str) -> bytes:
+        row = self._conn().execute("SELECT data FROM objects WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{key} not found")
+        return bytes(row[0])
+
+    def put(self, key: str, data: bytes):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO objects (key, data, mtime) VALUES (?, ?, ?)",
+                (key, data, time.time()),
+            )
+
+    # copied in through incremental blob io rather than read into memory
+    def put_file(self, key: str, path: Path):
+        size = path.stat().st_size
+        with self._conn() as conn, path.open("rb") as f:
+            cursor = conn.execute(
+                "INSERT OR REPLACE INTO objects (key, data, mtime) VALUES (?, zeroblob(?), ?)",
+                (key, size, time.time()),
+            )
+            with conn.blobopen("objects", "data", cursor.lastrowid) as blob:
+                while chunk := f.read(1024 * 1024):
+                    blob.write(chunk)
+
+    def append(self, key: str, data: bytes):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO objects (key, data, mtime) VALUES (?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET"
+                " data = CAST(data || excluded.data AS BLOB), mtime = excluded.mtime",
+                (key, data, time.time()),
+            )
+
+    def delete(self, key: str):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM objects WHERE key = ?", (key,))
+
+    def stat(self, key: str) -> Optional[Stat]:
+        row = (
+            self._conn()
+            .execute("SELECT length(data), mtime FROM objects WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return Stat(*row) if row else None
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        rows = self._conn().execute(
+            "SELECT key FROM objects WHERE key >= ? AND key < ?", (prefix, prefix + "\uffff")
+        )
+        return [r[0] for r in rows]
+
+
+class S3Backend(Backend):
+    # any S3-compatible object store (S3, R2, minio, tigris on fly); client
+    # is a boto3 s3 client or anything with the same methods
+    def __init__(self, client, bucket: str, prefix: str = ""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+
+    @staticmethod
+    def _missing(e: Exception) -> bool:
+        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        return code in ("404", "NoSuchKey", "NotFound")
+
+    def get(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if self._missing(e):
+                raise FileNotFoundError(f"{key} not found")
+            raise
+        return response["Body"].read()
+
+    def put(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    # boto3 streams the file, switching to a multipart upload when it's big
+    def put_file(self, key: str, path: Path):
+        self.client.upload_file(str(path), self.bucket, self.prefix + key)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def stat(self, key: str) -> Optional[Stat]:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if self._missing(e):
+                return None
+            raise
+        return Stat(response["ContentLength"], response["LastModified"].timestamp())
+
+    def keys(self, prefix: str = "") -> Iterator[str]:
+        kwargs = {"Bucket": self.bucket, "Prefix": self.prefix + prefix}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for item in response.get("Contents", []):
+                yield item["Key"][len(self.prefix) :]
+            if not response.get("IsTruncated"):
+                return
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+# file:// (or a plain path), sqlite:///path/to/store.db or s3://bucket/prefix;
+# s3 needs boto3 and picks up endpoint and credentials from the environment
+def backend_from_url(url: str) -> Backend:
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "file"):
+        return FilesystemBackend(Path(parsed.path))
+    if parsed.scheme == "sqlite":
+        return SQLiteBackend(Path(parsed.path))
+    if parsed.scheme == "s3":
+        import boto3
+
+        return S3Backend(boto3.client("s3"), parsed.netloc, parsed.path)
+    raise ValueError(f"Unknown storage backend {url}")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# Write and cold read latency of load_page + load_content for each storage
+# backend.  S3 is only measured when given a bucket (needs boto3, and
+# AWS_ENDPOINT_URL for minio and friends).
+#
+#     python benchmarks/bench_backends.py --pages 200 --size 20000
+#     python benchmarks/bench_backends.py --s3 s3://codette-bench/run
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import common  # noqa: F401
+from backends import FilesystemBackend, SQLiteBackend, backend_from_url
+from store import ProjectStore
+
+
+def bench(make_backend, pages: int, size: int):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = ProjectStore(
+            Path(temp_dir) / "local", backend=make_backend(Path(temp_dir)), blob_cache_bytes=0
+        )
+        store.create_project("bench", [])
+        writes = []
+        for i in range(pages):
+            content = "".join(f"<p>{rng.random()}</p>\n" for _ in range(size // 26))
+            start = time.perf_counter()
+            store.create_or_update_page("bench", f"page-{i}", content)
+            writes.append(time.perf_counter() - start)
+
+        reads = []
+        for i in rng.sample(range(pages), min(pages, 100)):
+            store.project_cache.clear()
+            start = time.perf_counter()
+            page = store.load_page("bench", f"page-{i}")
+            store.load_content("bench", page.content_hash)
+            reads.append(time.perf_counter() - start)
+    return statistics.median(writes) * 1000, statistics.median(reads) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=20_000)
+    parser.add_argument("--s3", help="s3://bucket/prefix to include an S3 backend")
+    args = parser.parse_args()
+
+    backends = {
+        "files": lambda path: FilesystemBackend(path / "objects"),
+        "sqlite": lambda path: SQLiteBackend(path / "objects.db"),
+    }
+    if args.s3:
+        backends["s3"] = lambda path: backend_from_url(f"{args.s3}/{time.time_ns()}")
+
+    print(f"{'backend':<8} {'write ms':>9} {'read ms':>8}")
+    for name, make_backend in backends.items():
+        write, read = bench(make_backend, args.pages, args.size)
+        print(f"{name:<8} {write:>9.3f} {read:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Disk usage and cold load_content latency for whole-file vs chunked blobs
+# when one page is edited many times.
+#
+#     python benchmarks/bench_blob_storage.py --edits 500 --size 200000
+
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import common  # noqa: F401
+from store import ProjectStore
+
+
+def page_versions(size: int, edits: int):
+    rng = random.Random(0)
+    lines = []
+    while sum(len(line) for line in lines) < size:
+        lines.append(f"  <li data-id='{len(lines)}'>{rng.random():.12f}</li>\n")
+    yield "".join(lines)
+    for _ in range(edits):
+        # each edit touches a few lines somewhere in the page
+        for _ in range(3):
+            i = rng.randrange(len(lines))
+            lines[i] = f"  <li data-id='{i}'>edited {rng.random():.12f}</li>\n"
+        yield "".join(lines)
+
+
+def bench(chunked: bool, size: int, edits: int):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = ProjectStore(Path(temp_dir), chunked_blobs=chunked, blob_cache_bytes=0)
+        start = time.perf_counter()
+        hashes = [store._store_content(content) for content in page_versions(size, edits)]
+        write = (time.perf_counter() - start) / len(hashes)
+
+        timings = []
+        for content_hash in hashes[-50:]:
+            start = time.perf_counter()
+            store.load_content("bench", content_hash)
+            timings.append(time.perf_counter() - start)
+        usage = store.blobs.usage()
+    return {
+        "stored_bytes": usage["stored_bytes"],
+        "logical_bytes": usage["logical_bytes"],
+        "write_ms": write * 1000,
+        "load_ms": statistics.median(timings) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--edits", type=int, default=500)
+    parser.add_argument("--size", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'layout':<8} {'content MB':>11} {'on disk MB':>11} {'write ms':>9} {'load ms':>8}")
+    for name, chunked in (("files", False), ("chunked", True)):
+        r = bench(chunked, args.size, args.edits)
+        print(
+            f"{name:<8} {r['logical_bytes'] / 1e6:>11.1f} {r['stored_bytes'] / 1e6:>11.1f} "
+            f"{r['write_ms']:>9.2f} {r['load_ms']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# Requests/sec against a local uvicorn server: the old one-connection-per-call
+# client (plain requests.get/post), the pooled CodetteClient and the
+# AsyncCodetteClient, each fetching raw pages then uploading pages.
+#
+#     python benchmarks/bench_client.py --requests 500 --concurrency 16
+
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import uvicorn
+
+import common  # noqa: F401
+from api import create_app
+from client import AsyncCodetteClient, CodetteClient
+from store import Page, ProjectStore
+
+HOST = "api.localhost"
+
+
+# the server gets its own process so it isn't sharing a GIL with the clients
+def serve(path: str, port: int):
+    app = create_app(ProjectStore(Path(path)))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="error")
+
+
+def start_server(path: Path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(str(path), port))
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    while True:
+        try:
+            requests.get(f"{url}/v0/projects", headers={"Host": HOST})
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+
+def legacy(url: str, project: str, hashes, pages, concurrency: int):
+    def get(h):
+        response = requests.get(f"{url}/v0/projects/{project}/raw/{h}", headers={"Host": HOST})
+        response.raise_for_status()
+
+    def post(page):
+        response = requests.post(
+            f"{url}/v0/projects/{project}/pages", json=page.model_dump(), headers={"Host": HOST}
+        )
+        response.raise_for_status()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(get, hashes))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(post, pages))
+
+
+def pooled(url: str, project: str, hashes, pages, concurrency: int):
+    with CodetteClient(url, host=HOST, pool_size=concurrency) as client:
+        client.fetch_raw_pages(project, hashes)
+        client.upload_pages(project, pages)
+
+
+def pooled_async(url: str, project: str, hashes, pages, concurrency: int):
+    async def run():
+        async with AsyncCodetteClient(url, host=HOST, pool_size=concurrency) as client:
+            await client.fetch_raw_pages(project, hashes)
+            await client.upload_pages(project, pages)
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--size", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = ProjectStore(Path(temp_dir))
+        store.create_project("bench", [])
+        hashes = [
+            store.create_or_update_page("bench", f"page-{i}", f"<p>{i}</p>" * (args.size // 10))
+            .pages[-1]
+            .content_hash
+            for i in range(50)
+        ]
+        hashes = (hashes * (args.requests // len(hashes) + 1))[: args.requests]
+        for name in ("legacy", "pooled", "async"):
+            store.create_project(f"bench-{name}", [])
+        process, url = start_server(Path(temp_dir))
+
+        print(f"{'client':<8} {'get req/s':>10} {'post req/s':>11}")
+        for name, run in [("legacy", legacy), ("pooled", pooled), ("async", pooled_async)]:
+            pages = [
+                Page(name=f"{name}-{i}", content=f"<p>{i}</p>") for i in range(args.requests // 5)
+            ]
+            start = time.perf_counter()
+            run(url, "bench", hashes, [], args.concurrency)
+            gets = len(hashes) / (time.perf_counter() - start)
+            start = time.perf_counter()
+            run(url, f"bench-{name}", [], pages, args.concurrency)
+            posts = len(pages) / (time.perf_counter() - start)
+            print(f"{name:<8} {gets:>10.0f} {posts:>11.0f}")
+
+        process.terminate()
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Bytes on the wire and CPU per request for serving a large generated page
+# uncompressed, compressed on the fly, and from precompressed variants.
+#
+#     python benchmarks/bench_compression.py --requests 500 --size 200000
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from common import asgi_request
+from starlette.middleware.gzip import GZipMiddleware
+from api import create_app
+from store import ProjectStore, COMPRESSORS
+
+
+def synthetic_page(size: int) -> str:
+    rng = random.Random(0)
+    rows = []
+    while sum(len(r) for r in rows) < size:
+        x, y = rng.random(), rng.random()
+        rows.append(f'{{"id": {len(rows)}, "x": {x:.6f}, "y": {y:.6f}, "label": "point"}},\n')
+    return (
+        '<!DOCTYPE html>\n<html lang="en">\n<head><title>bench</title></head>\n'
+        "<body><canvas id='c'></canvas><script>\nconst data = [\n"
+        + "".join(rows)
+        + "];\nconsole.log(data.length);\n</script></body></html>\n"
+    )
+
+
+async def run(app, accept_encoding: str, requests: int):
+    headers = {"Accept-Encoding": accept_encoding}
+    start_cpu, start_wall = time.process_time(), time.perf_counter()
+    for _ in range(requests):
+        status, response_headers, body = await asgi_request(app, "bench.test", "/", headers=headers)
+        assert status == 200
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start_wall
+    return {
+        "encoding": response_headers.get("content-encoding", "identity"),
+        "bytes_on_wire": len(body),
+        "cpu_ms_per_request": cpu / requests * 1000,
+        "wall_ms_per_request": wall / requests * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--size", type=int, default=200_000)
+    args = parser.parse_args()
+
+    page = synthetic_page(args.size)
+    with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as plain_dir:
+        store = ProjectStore(Path(temp_dir))
+        store.create_project("bench", [{"name": "index", "title": "", "content": page}])
+        app = create_app(store)
+
+        # the same page without precompressed variants, gzipped per request
+        plain_store = ProjectStore(Path(plain_dir))
+        plain_store.create_project("bench", [{"name": "index", "title": "", "content": page}])
+        for variant in (Path(plain_dir) / "content").glob("*.*"):
+            variant.unlink()
+        on_the_fly = GZipMiddleware(create_app(plain_store), minimum_size=500)
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run(app, "identity", 20))
+        results = [
+            ("uncompressed", loop.run_until_complete(run(app, "identity", args.requests))),
+            ("gzip on the fly", loop.run_until_complete(run(on_the_fly, "gzip", args.requests))),
+            ("precompressed gzip", loop.run_until_complete(run(app, "gzip", args.requests))),
+        ]
+        if "br" in COMPRESSORS:
+            results.append(("precompressed br", loop.run_until_complete(run(app, "br", args.requests))))
+
+    print(f"{'mode':<20} {'encoding':<10} {'bytes':>10} {'cpu ms/req':>11} {'wall ms/req':>12}")
+    for name, r in results:
+        print(
+            f"{name:<20} {r['encoding']:<10} {r['bytes_on_wire']:>10} "
+            f"{r['cpu_ms_per_request']:>11.3f} {r['wall_ms_per_request']:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Latency and peak python heap for serving multi-MB pages under concurrent
+# requests: reading the whole blob into memory vs streaming it from the
+# file through mmap.
+#
+#     python benchmarks/bench_large_blobs.py --size 8 --concurrency 32
+
+import argparse
+import asyncio
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import common  # noqa: F401
+import api
+from api import create_app
+from store import ProjectStore
+
+
+# like common.asgi_request, but drops the body as it arrives so the client
+# doesn't hold every response in memory
+async def fetch(app, host: str) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", host.encode()), (b"accept-encoding", b"identity")],
+        "client": ("127.0.0.1", 1234),
+        "server": (host, 80),
+    }
+    received = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal received
+        if message["type"] == "http.response.body":
+            received += len(message.get("body", b""))
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    assert received > 0
+    return time.perf_counter() - start
+
+
+async def run(app, host: str, concurrency: int, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        timings += await asyncio.gather(*(fetch(app, host) for _ in range(concurrency)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=float, default=4, help="page size in MB")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    lines = []
+    while len(lines) * 30 < args.size * 1e6:
+        lines.append(f"[{rng.random():.10f}, {rng.random():.10f}],\n")
+    content = "".join(lines)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = ProjectStore(Path(temp_dir), blob_cache_bytes=0)
+        store.create_project("big", [{"name": "index", "title": "", "content": content}])
+        app = create_app(store)
+
+        print(f"{'path':<10} {'p50 ms':>8} {'p95 ms':>8} {'peak heap MB':>13}")
+        for name, threshold in (("in memory", float("inf")), ("mmap", 0)):
+            api.LARGE_BLOB_SIZE = threshold
+            tracemalloc.start()
+            timings = asyncio.run(run(app, "big.localhost", args.concurrency, args.rounds))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            timings.sort()
+            print(
+                f"{name:<10} {statistics.median(timings) * 1000:>8.1f} "
+                f"{timings[int(len(timings) * 0.95)] * 1000:>8.1f} {peak / 1e6:>13.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
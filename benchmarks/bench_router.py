@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Requests/sec for content pages through the old router (a Starlette Mount
+# that builds a Request to read the Host header, then FastAPI routing) and
+# through HostRouter's fast path, for full responses and 304s.
+#
+#     python benchmarks/bench_router.py --requests 5000
+
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from common import asgi_request
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.routing import Mount
+from api import create_app
+from store import ProjectStore
+
+
+# what create_app returned before HostRouter
+def legacy_app(app):
+    async def router(scope, receive, send):
+        request = Request(scope, receive)
+        host = request.headers.get("host", "")
+        if host.startswith("api."):
+            await app.api(scope, receive, send)
+        else:
+            scope["subdomain"] = host.split(".")[0] if "." in host else None
+            await app.content(scope, receive, send)
+
+    return Starlette(routes=[Mount("/", app=router)])
+
+
+async def run(app, requests: int, headers=None) -> float:
+    start = time.perf_counter()
+    for _ in range(requests):
+        status, _, _ = await asgi_request(app, "bench.test", "/", headers=headers)
+        assert status in (200, 304)
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = ProjectStore(Path(temp_dir))
+        project = store.create_project(
+            "bench", [{"name": "index", "title": "", "content": "<p>hello</p>" * 100}]
+        )
+        etag = {"If-None-Match": f'"{project.pages[0].content_hash}"'}
+        app = create_app(store)
+        apps = {"before": legacy_app(app), "after": app}
+
+        print(f"{'router':<8} {'200 req/s':>10} {'304 req/s':>10}")
+        for name, target in apps.items():
+            asyncio.run(run(target, 100))
+            full = asyncio.run(run(target, args.requests))
+            not_modified = asyncio.run(run(target, args.requests, etag))
+            print(f"{name:<8} {full:>10.0f} {not_modified:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# Latency, throughput and memory for the main serving and store paths,
+# against a synthetic store of projects x versions x page size.  Requests go
+# through the ASGI app in-process (no network or client overhead) and/or a
+# local uvicorn server; the model is replaced by a deterministic stub.
+# Results are written as JSON so runs can be compared across commits.
+#
+#     python benchmarks/bench_suite.py --projects 20 --versions 50 --page-size 20000
+#     python benchmarks/bench_suite.py --mode uvicorn -o after.json --compare before.json
+
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import uvicorn
+
+from common import asgi_request
+import api
+import generator
+from api import create_app
+from store import ProjectStore
+
+PAGES_PER_PROJECT = 5
+
+
+def synthetic_page(rng: random.Random, size: int) -> str:
+    rows = []
+    while sum(len(r) for r in rows) < size:
+        rows.append(f"<tr><td>{rng.randrange(10**6)}</td><td>{rng.random():.8f}</td></tr>\n")
+    return "<!DOCTYPE html>\n<html><body><table>\n" + "".join(rows) + "</table></body></html>\n"
+
+
+# every project gets `versions` versions, each editing one of its pages
+def build_store(path: Path, projects: int, versions: int, page_size: int, seed: int = 0):
+    rng = random.Random(seed)
+    store = ProjectStore(path)
+    for p in range(projects):
+        name = f"project-{p}"
+        pages = [
+            {
+                "name": "index" if i == 0 else f"page-{i}",
+                "title": "",
+                "content": synthetic_page(rng, page_size),
+            }
+            for i in range(min(PAGES_PER_PROJECT, versions))
+        ]
+        store.create_project(name, pages)
+        for v in range(versions - 1):
+            page = pages[rng.randrange(len(pages))]["name"]
+            store.create_or_update_page(name, page, synthetic_page(rng, page_size))
+
+
+# stands in for the model: the same prompt always gives the same page
+def stub_generate_content(messages, **kwargs) -> str:
+    digest = hashlib.sha256(json.dumps(messages, default=str).encode()).hexdigest()
+    return f"<!DOCTYPE html>\n<html><body><p>{digest}</p></body></html>\n"
+
+
+def stub_generate_content_stream(messages, **kwargs):
+    content = stub_generate_content(messages)
+    for i in range(0, len(content), 16):
+        yield content[i : i + 16]
+
+
+# streamed pages still go through the model cache, so it's kept with the store
+def install_stub(path: Path):
+    generator.llm_cache.path = path / "llm_cache.db"
+    api.generate_content = stub_generate_content
+    api.generate_content_stream = stub_generate_content_stream
+    api.generate_edit = lambda messages, **kwargs: "<title>error</title>"
+
+
+# each scenario makes (method, host, path, headers, body) for the nth request
+def scenarios(store: ProjectStore, projects: int):
+    names = [f"project-{p}" for p in range(projects)]
+    heads = {name: store.load_project(name) for name in names}
+    versions = {name: store.list_project_versions(name) for name in names}
+
+    def page(n):
+        return "GET", f"{names[n % projects]}.localhost", "/", {}, b""
+
+    def pinned_page(n):
+        name = names[n % projects]
+        version = versions[name][n % len(versions[name])]
+        return "GET", f"{name}_{version}.localhost", "/", {}, b""
+
+    def not_modified(n):
+        project = heads[names[n % projects]]
+        index = next(p for p in project.pages if p.name == "index")
+        headers = {"If-None-Match": f'"{index.content_hash}"'}
+        return "GET", f"{project.name}.localhost", "/", headers, b""
+
+    def list_projects(n):
+        return "GET", "api.localhost", "/v0/projects?limit=100", {}, b""
+
+    def get_project(n):
+        return "GET", "api.localhost", f"/v0/projects/{names[n % projects]}", {}, b""
+
+    def update_page(n):
+        body = json.dumps({"name": f"bench-{n % 10}", "content": f"<p>update {n}</p>"})
+        path = f"/v0/projects/{names[n % projects]}/pages"
+        return "POST", "api.localhost", path, {"Content-Type": "application/json"}, body.encode()
+
+    def generate(n):
+        body = json.dumps({"prompt": f"a page about {n}", "mode": "full"})
+        path = f"/v0/projects/{names[n % projects]}/pages/generated/generate/stream"
+        return "POST", "api.localhost", path, {"Content-Type": "application/json"}, body.encode()
+
+    return {
+        "serve_page": page,
+        "serve_page_pinned": pinned_page,
+        "serve_page_304": not_modified,
+        "list_projects": list_projects,
+        "get_project": get_project,
+        "create_or_update_page": update_page,
+        "generate_stream": generate,
+    }
+
+
+def memory(pid: str = "self") -> dict:
+    # resident and peak resident set size, from /proc where there is one
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {"rss_mb": None, "peak_rss_mb": peak if pid == "self" else None}
+    fields = dict(line.split(":", 1) for line in status.splitlines() if ":" in line)
+    return {
+        "rss_mb": int(fields["VmRSS"].split()[0]) / 1024,
+        "peak_rss_mb": int(fields["VmHWM"].split()[0]) / 1024,
+    }
+
+
+def summarize(timings, errors: int, wall: float) -> dict:
+    timings = sorted(timings)
+    return {
+        "requests": len(timings),
+        "errors": errors,
+        "rps": len(timings) / wall,
+        "p50_ms": statistics.median(timings) * 1000,
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+    }
+
+
+async def run_in_process(app, make_request, count: int, concurrency: int):
+    timings, errors = [], 0
+    queue = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        for n in queue:
+            method, host, path, headers, body = make_request(n)
+            start = time.perf_counter()
+            status, _, _ = await asgi_request(app, host, path, method, headers, body)
+            timings.append(time.perf_counter() - start)
+            errors += status >= 400
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(timings, errors, time.perf_counter() - start)
+
+
+# a pooled session per client thread, so connections are reused
+def run_over_http(url: str, make_request, count: int, concurrency: int):
+    local = threading.local()
+    sessions = []
+
+    def call(n):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            sessions.append(session)
+        method, host, path, headers, body = make_request(n)
+        start = time.perf_counter()
+        response = session.request(method, url + path, headers={"Host": host, **headers}, data=body)
+        return time.perf_counter() - start, response.status_code >= 400
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(call, range(count)))
+    wall = time.perf_counter() - start
+    for session in sessions:
+        session.close()
+    return summarize([t for t, _ in results], sum(e for _, e in results), wall)
+
+
+def serve(path: str, port: int):
+    install_stub(Path(path))
+    app = create_app(ProjectStore(Path(path)))
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="error")
+
+
+def start_server(path: Path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(str(path), port))
+    process.start()
+    url = f"http://127.0.0.1:{port}"
+    while True:
+        try:
+            requests.get(f"{url}/v0/projects", headers={"Host": "api.localhost"})
+            return process, url
+        except requests.ConnectionError:
+            time.sleep(0.05)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline_path: str):
+    baseline = json.loads(Path(baseline_path).read_text())
+    baseline = {(r["mode"], r["scenario"]): r for r in baseline["results"]}
+    print(f"\ncompared with {baseline_path}")
+    print(f"{'mode':<11} {'scenario':<22} {'rps':>8} {'p50':>8} {'p99':>8}")
+    for r in results["results"]:
+        old = baseline.get((r["mode"], r["scenario"]))
+        if not old:
+            continue
+        changes = [
+            f"{(r[key] / old[key] - 1) * 100:+.0f}%" if old[key] else "-"
+            for key in ("rps", "p50_ms", "p99_ms")
+        ]
+        print(f"{r['mode']:<11} {r['scenario']:<22} " + " ".join(f"{c:>8}" for c in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--versions", type=int, default=50, help="versions per project")
+    parser.add_argument("--page-size", type=int, default=20_000, help="bytes per page")
+    parser.add_argument("--requests", type=int, default=500, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mode", choices=["in-process", "uvicorn", "both"], default="both")
+    parser.add_argument("--scenario", action="append", help="only these scenarios")
+    parser.add_argument("-o", "--output", help="defaults to bench-<commit>.json")
+    parser.add_argument("--compare", help="an earlier results file to compare with")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir)
+        start = time.perf_counter()
+        build_store(path, args.projects, args.versions, args.page_size)
+        results["build_seconds"] = time.perf_counter() - start
+        print(
+            f"built {args.projects} projects x {args.versions} versions"
+            f" in {results['build_seconds']:.1f}s"
+        )
+
+        install_stub(path)
+        modes = ["in-process", "uvicorn"] if args.mode == "both" else [args.mode]
+        print(f"{'mode':<11} {'scenario':<22} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'rss mb':>7}")
+        for mode in modes:
+            store = ProjectStore(path)
+            app = create_app(store) if mode == "in-process" else None
+            process, url = start_server(path) if mode == "uvicorn" else (None, None)
+            for name, make_request in scenarios(store, args.projects).items():
+                if args.scenario and name not in args.scenario:
+                    continue
+                if mode == "in-process":
+                    result = asyncio.run(
+                        run_in_process(app, make_request, args.requests, args.concurrency)
+                    )
+                    result.update(memory())
+                else:
+                    result = run_over_http(url, make_request, args.requests, args.concurrency)
+                    result.update(memory(process.pid))
+                results["results"].append({"mode": mode, "scenario": name, **result})
+                print(
+                    f"{mode:<11} {name:<22} {result['rps']:>8.0f} {result['p50_ms']:>8.2f}"
+                    f" {result['p99_ms']:>8.2f} {result['rss_mb'] or 0:>7.0f}"
+                )
+            if process:
+                process.terminate()
+                process.join()
+
+    output = args.output or f"bench-{results['commit'] or int(results['time'])}.json"
+    Path(output).write_text(json.dumps(results, indent=2))
+    print(f"wrote {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import asyncio
+import sys
+from pathlib import Path
+from typing import Dict, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+# drive an ASGI app directly so client-side work (decompression, httpx
+# bookkeeping) doesn't end up in the numbers
+async def asgi_request(
+    app,
+    host: str,
+    path: str = "/",
+    method: str = "GET",
+    headers: Dict[str, str] = None,
+    body: bytes = b"",
+) -> Tuple[int, Dict[str, str], bytes]:
+    path, _, query = path.partition("?")
+    raw_headers = [(b"host", host.encode())]
+    if body:
+        raw_headers.append((b"content-length", str(len(body)).encode()))
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode(), value.encode()))
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": raw_headers,
+        "client": ("127.0.0.1", 1234),
+        "server": (host, 80),
+    }
+    status = 0
+    response_headers = {}
+    chunks = []
+    requested = False
+    finished = asyncio.Event()
+
+    # the body once, then like a server: nothing until the response is
+    # sent, then a disconnect (streaming responses wait for one)
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            for name, value in message.get("headers", []):
+                response_headers[name.decode().lower()] = value.decode()
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                finished.set()
+
+    await app(scope, receive, send)
+    return status, response_headers, b"".join(chunks)
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from backends import Backend
+import utils
+
+
+HASH = re.compile(r"[0-9a-f]{64}")
+
+# chunk boundaries fall after lines whose crc is a multiple of BOUNDARY once a
+# chunk is at least MIN_CHUNK bytes, so an edit only rewrites the chunks
+# around it; long lines (minified js) are cut at MAX_CHUNK
+MIN_CHUNK = 2048
+MAX_CHUNK = 16384
+BOUNDARY = 8
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunk(data: bytes) -> List[bytes]:
+    chunks = []
+    start = pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos, start + MAX_CHUNK)
+        if end == -1:
+            end = min(start + MAX_CHUNK, len(data))
+            pos = end
+            cut = end - start >= MAX_CHUNK or end == len(data)
+        else:
+            line = data[pos : end + 1]
+            pos = end + 1
+            cut = pos - start >= MIN_CHUNK and zlib.crc32(line) % BOUNDARY == 0
+        if cut:
+            chunks.append(data[start:pos])
+            start = pos
+    if start < len(data):
+        chunks.append(data[start:])
+    return chunks
+
+
+class BlobStore:
+    # content-addressed blobs in a storage backend, either as whole objects
+    # (content/<sha256>) or, when chunked, as a recipe listing deduplicated
+    # chunks (content/recipes/<sha256>, content/chunks/<sha256>); reads
+    # handle both so a store can be migrated in place
+    def __init__(self, backend: Backend, chunked: bool = False):
+        self.backend = backend
+        self.chunked = chunked
+
+    def has(self, content_hash: str) -> bool:
+        return self.backend.exists(f"content/{content_hash}") or self.backend.exists(
+            f"content/recipes/{content_hash}"
+        )
+
+    def file_path(self, content_hash: str) -> Optional[Path]:
+        return self.backend.path(f"content/{content_hash}")
+
+    def get(self, content_hash: str) -> bytes:
+        try:
+            return self.backend.get(f"content/{content_hash}")
+        except FileNotFoundError:
+            pass
+        try:
+            recipe = json.loads(self.backend.get(f"content/recipes/{content_hash}"))
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Content {content_hash} not found")
+        return b"".join(
+            self.backend.get(f"content/chunks/{chunk_hash}") for chunk_hash in recipe["chunks"]
+        )
+
+    def put(self, content_hash: str, data: bytes):
+        if self.has(content_hash):
+            return
+        if self.chunked:
+            self._put_chunked(content_hash, data)
+        else:
+            self.backend.put(f"content/{content_hash}", data)
+
+    # large uploads are always kept whole so they can be served from disk
+    def put_file(self, content_hash: str, path: Path):
+        if not self.has(content_hash):
+            self.backend.put_file(f"content/{content_hash}", path)
+
+    def writer(self, tmp_path: Path) -> "BlobWriter":
+        return BlobWriter(self, tmp_path)
+
+    def _put_chunked(self, content_hash: str, data: bytes):
+        chunk_hashes = []
+        for piece in chunk(data):
+            chunk_hash = hash_bytes(piece)
+            if not self.backend.exists(f"content/chunks/{chunk_hash}"):
+                self.backend.put(f"content/chunks/{chunk_hash}", piece)
+            chunk_hashes.append(chunk_hash)
+        recipe = {"size": len(data), "chunks": chunk_hashes}
+        self.backend.put(f"content/recipes/{content_hash}", json.dumps(recipe).encode())
+
+    def get_variant(self, content_hash: str, suffix: str) -> Optional[bytes]:
+        try:
+            return self.backend.get(f"content/{content_hash}{suffix}")
+        except FileNotFoundError:
+            return None
+
+    def has_variant(self, content_hash: str, suffix: str) -> bool:
+        return self.backend.exists(f"content/{content_hash}{suffix}")
+
+    def put_variant(self, content_hash: str, suffix: str, data: bytes):
+        self.backend.put(f"content/{content_hash}{suffix}", data)
+
+    # hashes of the objects directly under prefix, e.g. content/chunks/
+    def _hashes(self, prefix: str) -> Iterator[str]:
+        for key in self.backend.keys(prefix):
+            if HASH.fullmatch(key[len(prefix) :]):
+                yield key[len(prefix) :]
+
+    def hashes(self) -> Iterator[str]:
+        seen = set()
+        for prefix in ("content/", "content/recipes/"):
+            for content_hash in self._hashes(prefix):
+                if content_hash not in seen:
+                    seen.add(content_hash)
+                    yield content_hash
+
+    # rewrite every blob in the current layout; chunks shared with other
+    # blobs are only removed once nothing refers to them
+    def migrate(self) -> Dict[str, int]:
+        before = self.usage()
+        for content_hash in list(self.hashes()):
+            plain = f"content/{content_hash}"
+            recipe = f"content/recipes/{content_hash}"
+            # write the new copy before removing the old one
+            if self.chunked and self.backend.exists(plain):
+                if not self.backend.exists(recipe):
+                    self._put_chunked(content_hash, self.backend.get(plain))
+                self.backend.delete(plain)
+            elif not self.chunked and self.backend.exists(recipe):
+                if not self.backend.exists(plain):
+                    self.backend.put(plain, self.get(content_hash))
+                self.backend.delete(recipe)
+        self._remove_unused_chunks()
+        after = self.usage()
+        return {"before": before["stored_bytes"], "after": after["stored_bytes"], **after}
+
+    def _remove_unused_chunks(self):
+        used = set()
+        for recipe_hash in list(self._hashes("content/recipes/")):
+            used.update(json.loads(self.backend.get(f"content/recipes/{recipe_hash}"))["chunks"])
+        for chunk_hash in list(self._hashes("content/chunks/")):
+            if chunk_hash not in used:
+                self.backend.delete(f"content/chunks/{chunk_hash}")
+
+    def usage(self) -> Dict[str, int]:
+        blobs = logical = stored = 0
+        for content_hash in self._hashes("content/"):
+            size = self.backend.stat(f"content/{content_hash}").size
+            blobs += 1
+            logical += size
+            stored += size
+        for recipe_hash in self._hashes("content/recipes/"):
+            key = f"content/recipes/{recipe_hash}"
+            blobs += 1
+            logical += json.loads(self.backend.get(key))["size"]
+            stored += self.backend.stat(key).size
+        for chunk_hash in self._hashes("content/chunks/"):
+            stored += self.backend.stat(f"content/chunks/{chunk_hash}").size
+        return {"blobs": blobs, "logical_bytes": logical, "stored_bytes": stored}
+
+
+class BlobWriter:
+    # hashes a blob as it is written to a temp file, so an upload is never
+    # held in memory; finish() stores it under its hash
+    def __init__(self, blobs: BlobStore, tmp_path: Path):
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=tmp_path, prefix=".upload-")
+        self.blobs = blobs
+        self.path = Path(path)
+        self.file = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def finish(self) -> str:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        content_hash = self.hash.hexdigest()
+        self.blobs.put_file(content_hash, self.path)
+        utils.rm(self.path)
+        return content_hash
+
+    def abort(self):
+        self.file.close()
+        utils.rm(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.abort()
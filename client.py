@@ -0,0 +1,247 @@
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from store import Page, Project, ProjectSummary
+
+# responses worth retrying: rate limited, or a proxy in front of a
+# restarting server
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+class CodetteClient:
+    # one pooled session per client, so calls reuse connections instead of
+    # opening a new one each time; idempotent requests are retried with
+    # exponential backoff. host overrides the Host header, for reaching the
+    # api through an address that isn't api.<domain>
+    def __init__(
+        self,
+        base_url: str,
+        retries: int = 3,
+        backoff: float = 0.2,
+        pool_size: int = 16,
+        timeout: float = 30,
+        host: str = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if host:
+            self.session.headers["Host"] = host
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(
+            method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def list_projects(
+        self, limit: int = 100, offset: int = 0, versions: bool = False
+    ) -> List[ProjectSummary]:
+        params = {"limit": limit, "offset": offset, "versions": versions}
+        response = self._request("GET", "/v0/projects", params=params)
+        return [ProjectSummary(**project) for project in response.json()]
+
+    def create_project(self, project: Project) -> Project:
+        response = self._request("POST", "/v0/projects", json=project.model_dump())
+        return Project(**response.json())
+
+    def get_project(self, project_name: str) -> Project:
+        return Project(**self._request("GET", f"/v0/projects/{project_name}").json())
+
+    def list_project_versions(self, project_name: str) -> List[str]:
+        return self._request("GET", f"/v0/projects/{project_name}/versions").json()
+
+    def create_or_update_page(
+        self, project_name: str, page: Page, expected_version: str = None
+    ) -> Project:
+        response = self._request(
+            "POST",
+            f"/v0/projects/{project_name}/pages",
+            json=page.model_dump(),
+            params={"expected_version": expected_version} if expected_version else None,
+        )
+        return Project(**response.json())
+
+    def delete_page(self, project_name: str, page_name: str) -> Project:
+        response = self._request("DELETE", f"/v0/projects/{project_name}/pages/{page_name}")
+        return Project(**response.json())
+
+    def get_raw(self, project_name: str, content_hash: str) -> bytes:
+        return self._request("GET", f"/v0/projects/{project_name}/raw/{content_hash}").content
+
+    # streams the file rather than reading it into memory
+    def upload_asset(self, project_name: str, path: str, file_path: str) -> Project:
+        with open(file_path, "rb") as f:
+            response = self._request(
+                "PUT", f"/v0/projects/{project_name}/assets/{path}", data=f
+            )
+        return Project(**response.json())
+
+    # downloads a tar of the projects' full history, in chunks
+    def export_projects(self, path: str, project_names: List[str] = None):
+        response = self._request(
+            "GET", "/v0/export", params={"project": project_names or []}, stream=True
+        )
+        with response, open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+    def import_projects(self, path: str) -> dict:
+        with open(path, "rb") as f:
+            return self.import_archive(f)
+
+    # chunks is a file or any iterable of tar chunks, sent as it's read
+    def import_archive(self, chunks) -> dict:
+        return self._request("POST", "/v0/import", data=chunks).json()
+
+    # every page becomes its own version, in whatever order the server
+    # finishes them; returns the project after each write, in input order
+    def upload_pages(self, project_name: str, pages: Iterable[Page]) -> List[Project]:
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            return list(
+                pool.map(lambda page: self.create_or_update_page(project_name, page), pages)
+            )
+
+    def fetch_raw_pages(
+        self, project_name: str, content_hashes: Iterable[str]
+    ) -> Dict[str, bytes]:
+        content_hashes = list(content_hashes)
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            contents = pool.map(lambda h: self.get_raw(project_name, h), content_hashes)
+            return dict(zip(content_hashes, contents))
+
+
+class AsyncCodetteClient:
+    # the same api on httpx's async client; pool_size also bounds how many
+    # requests the bulk helpers have in flight
+    def __init__(
+        self,
+        base_url: str,
+        retries: int = 3,
+        backoff: float = 0.2,
+        pool_size: int = 16,
+        timeout: float = 30,
+        host: str = None,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={"Host": host} if host else None,
+        )
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                retry = method in IDEMPOTENT_METHODS and response.status_code in RETRY_STATUSES
+            except httpx.TransportError as e:
+                # a request that never connected is safe to send again
+                connect = isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+                if attempt >= self.retries or not (connect or method in IDEMPOTENT_METHODS):
+                    raise
+                retry, response = True, None
+            if not retry or attempt >= self.retries:
+                response.raise_for_status()
+                return response
+            await asyncio.sleep(self.backoff * 2**attempt * (0.5 + random.random() / 2))
+            attempt += 1
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def list_projects(
+        self, limit: int = 100, offset: int = 0, versions: bool = False
+    ) -> List[ProjectSummary]:
+        params = {"limit": limit, "offset": offset, "versions": versions}
+        response = await self._request("GET", "/v0/projects", params=params)
+        return [ProjectSummary(**project) for project in response.json()]
+
+    async def create_project(self, project: Project) -> Project:
+        response = await self._request("POST", "/v0/projects", json=project.model_dump())
+        return Project(**response.json())
+
+    async def get_project(self, project_name: str) -> Project:
+        return Project(**(await self._request("GET", f"/v0/projects/{project_name}")).json())
+
+    async def list_project_versions(self, project_name: str) -> List[str]:
+        return (await self._request("GET", f"/v0/projects/{project_name}/versions")).json()
+
+    async def create_or_update_page(
+        self, project_name: str, page: Page, expected_version: str = None
+    ) -> Project:
+        response = await self._request(
+            "POST",
+            f"/v0/projects/{project_name}/pages",
+            json=page.model_dump(),
+            params={"expected_version": expected_version} if expected_version else None,
+        )
+        return Project(**response.json())
+
+    async def delete_page(self, project_name: str, page_name: str) -> Project:
+        response = await self._request(
+            "DELETE", f"/v0/projects/{project_name}/pages/{page_name}"
+        )
+        return Project(**response.json())
+
+    async def get_raw(self, project_name: str, content_hash: str) -> bytes:
+        response = await self._request(
+            "GET", f"/v0/projects/{project_name}/raw/{content_hash}"
+        )
+        return response.content
+
+    async def _bounded(self, calls) -> List:
+        semaphore = asyncio.Semaphore(self.pool_size)
+
+        async def run(call):
+            async with semaphore:
+                return await call
+
+        return await asyncio.gather(*(run(call) for call in calls))
+
+    async def upload_pages(self, project_name: str, pages: Iterable[Page]) -> List[Project]:
+        return await self._bounded(self.create_or_update_page(project_name, p) for p in pages)
+
+    async def fetch_raw_pages(
+        self, project_name: str, content_hashes: Iterable[str]
+    ) -> Dict[str, bytes]:
+        content_hashes = list(content_hashes)
+        contents = await self._bounded(self.get_raw(project_name, h) for h in content_hashes)
+        return dict(zip(content_hashes, contents))
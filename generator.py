@@ -1,31 +1,48 @@
 import json
 import os
 import hashlib
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
 from functools import wraps
+from pathlib import Path
 from claudette import Chat
+from llm_cache import LLMCache
+from metrics import GENERATE_SECONDS, GENERATE_TOKENS, LLM_CACHE_REQUESTS
 import traceback
 
 
-def disk_cache(cache_dir=".llm_cache"):
+# Create a unique key based on function arguments
+def cache_key(args, kwargs) -> str:
+    return hashlib.md5(json.dumps((args, kwargs), sort_keys=True).encode()).hexdigest()
+
+
+def is_error(result) -> bool:
+    return isinstance(result, str) and result.startswith("<title>error</title>")
+
+
+def disk_cache(cache: LLMCache):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Create a unique key based on function arguments
-            key = hashlib.md5(
-                json.dumps((args, kwargs), sort_keys=True).encode()
-            ).hexdigest()
-            cache_file = os.path.join(cache_dir, f"{func.__name__}_{key}.json")
-
             force_refresh = kwargs.get("force_refresh", False)
+            # force_refresh changes whether we read the cache, not what the
+            # call returns, so it isn't part of the key
+            key = cache_key(
+                args, {k: v for k, v in kwargs.items() if k != "force_refresh"}
+            )
 
-            if os.path.exists(cache_file) and not force_refresh:
-                with open(cache_file, "r") as f:
-                    return json.load(f)
+            if not force_refresh:
+                result = cache.get(key)
+                if result is not None:
+                    LLM_CACHE_REQUESTS.inc(func.__name__, "hit")
+                    return result
+            LLM_CACHE_REQUESTS.inc(func.__name__, "refresh" if force_refresh else "miss")
 
             result = func(*args, **kwargs)
-            os.makedirs(cache_dir, exist_ok=True)
-            with open(cache_file, "w") as f:
-                json.dump(result, f)
+            if not is_error(result):
+                cache.put(key, result, name=func.__name__)
 
             return result
 
@@ -34,7 +51,143 @@ def disk_cache(cache_dir=".llm_cache"):
     return decorator
 
 
-@disk_cache()
+llm_cache = LLMCache(
+    Path(".llm_cache") / "cache.db",
+    max_bytes=int(os.environ.get("CODETTE_LLM_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    max_age=float(os.environ["CODETTE_LLM_CACHE_MAX_AGE"])
+    if "CODETTE_LLM_CACHE_MAX_AGE" in os.environ
+    else None,
+)
+
+
+class SingleFlight:
+    # concurrent calls with the same key share the first caller's result
+    # instead of each doing the work
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.do(cache_key(args, kwargs), lambda: func(*args, **kwargs))
+
+        return wrapper
+
+
+in_flight = SingleFlight()
+
+
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+)
+
+
+class UsageLog:
+    # token and latency accounting for the model calls we actually make
+    def __init__(self, history: int = 100):
+        self.calls = 0
+        self.latency = 0.0
+        self.tokens = defaultdict(int)
+        self.edits = defaultdict(int)
+        self.recent = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def record(self, model: str, usage, latency: float, stream: bool = False) -> dict:
+        entry = {
+            "model": model,
+            "stream": stream,
+            "latency": latency,
+            **{field: getattr(usage, field, 0) or 0 for field in USAGE_FIELDS},
+        }
+        with self._lock:
+            self.calls += 1
+            self.latency += latency
+            for field in USAGE_FIELDS:
+                self.tokens[field] += entry[field]
+            self.recent.append(entry)
+        GENERATE_SECONDS.observe(latency, model, "true" if stream else "false")
+        for field in USAGE_FIELDS:
+            GENERATE_TOKENS.inc(model, field.removesuffix("_tokens"), amount=entry[field])
+        return entry
+
+    def record_edit(self, report: dict):
+        with self._lock:
+            self.edits[report["mode"]] += 1
+            self.edits["saved_output_tokens"] += report.get("saved_output_tokens", 0)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "latency": self.latency,
+            "tokens": dict(self.tokens),
+            "edits": dict(self.edits),
+            "recent": list(self.recent),
+        }
+
+
+usage_log = UsageLog()
+
+# Anthropic allows four cache breakpoints per request, and one of them goes
+# on the system prompt
+MAX_CACHED_BLOCKS = 3
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+# marks a message as stable context (api docs, the current page, ...) so the
+# provider can cache the prompt prefix ending with it across calls
+def cacheable(text: str) -> dict:
+    return {"text": text, "cache": True}
+
+
+def is_cacheable(message) -> bool:
+    return isinstance(message, dict) and message.get("cache", False)
+
+
+def build_prompt(messages, system_prompt):
+    if not any(is_cacheable(m) for m in messages):
+        return messages, system_prompt
+
+    blocks = []
+    for message in messages:
+        text = message["text"] if isinstance(message, dict) else message
+        blocks.append({"type": "text", "text": text})
+    # a breakpoint caches everything before it, so only the last ones count
+    cached = [i for i, m in enumerate(messages) if is_cacheable(m)]
+    for i in cached[-MAX_CACHED_BLOCKS:]:
+        blocks[i]["cache_control"] = CACHE_CONTROL
+    system = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+    return blocks, system
+
+
+@in_flight
+@disk_cache(llm_cache)
 def generate_content(
     messages,
     model="claude-3-5-sonnet-20240620",
@@ -43,8 +196,11 @@ def generate_content(
     force_refresh=False,
 ):
     try:
-        chat = Chat(model, sp=system_prompt)
-        r = chat(messages, prefill=prefill)
+        prompt, system = build_prompt(messages, system_prompt)
+        chat = Chat(model, sp=system)
+        start = time.perf_counter()
+        r = chat(prompt, prefill=prefill)
+        usage_log.record(model, chat.use, time.perf_counter() - start)
 
         return parse(r)
 
@@ -52,5 +208,87 @@ def generate_content(
         return f"<title>error</title><p>{str(e)}</p><pre>{traceback.format_exc()}</pre>"
 
 
+EDIT_SYSTEM_PROMPT = """You are an expert web developer editing an existing single html file.  Reply only with the edits needed, as one or more blocks in exactly this format:
+
+<<<<<<< SEARCH
+lines copied exactly from the current file
+=======
+the lines to replace them with
+>>>>>>> REPLACE
+
+Each SEARCH section must match the current file exactly and only once, so include enough surrounding lines to make it unique.  Never repeat the whole file."""
+
+
+# asks for SEARCH/REPLACE blocks against the current page rather than the
+# whole document, so output tokens scale with the change not the page
+@in_flight
+@disk_cache(llm_cache)
+def generate_edit(
+    messages,
+    model="claude-3-5-sonnet-20240620",
+    prefill="<<<<<<< SEARCH",
+    system_prompt=EDIT_SYSTEM_PROMPT,
+    force_refresh=False,
+):
+    try:
+        prompt, system = build_prompt(messages, system_prompt)
+        chat = Chat(model, sp=system)
+        start = time.perf_counter()
+        r = chat(prompt, prefill=prefill)
+        entry = usage_log.record(model, chat.use, time.perf_counter() - start)
+
+        return {"patch": parse(r), "output_tokens": entry["output_tokens"]}
+
+    except Exception as e:
+        return f"<title>error</title><p>{str(e)}</p><pre>{traceback.format_exc()}</pre>"
+
+
+# yields the page as the model writes it, starting with the prefill; unlike
+# generate_content errors are raised so callers can stop the stream cleanly
+def generate_content_stream(
+    messages,
+    model="claude-3-5-sonnet-20240620",
+    prefill='<!DOCTYPE html>\n<html lang="en">',
+    system_prompt="""You are an expert web developer, you are tasked with producing a single html files.  All of your code should be inline in the html file, but you can use CDNs to import packages if needed.""",
+):
+    prompt, system = build_prompt(messages, system_prompt)
+    chat = Chat(model, sp=system)
+    start = time.perf_counter()
+    yield from chat(prompt, prefill=prefill, stream=True)
+    usage_log.record(model, chat.use, time.perf_counter() - start, stream=True)
+
+
 def parse(r):
     return r.content[0].text
+
+
+# a page streamed through on_chunk that shares generate_content's cache and
+# in-flight calls: a cached page, or one another caller is already
+# generating, arrives as a single chunk, and a streamed page is cached for
+# both. stream is generate_content_stream or a stand-in for it
+def stream_content(messages, on_chunk, stream=generate_content_stream) -> str:
+    key = cache_key((messages,), {})
+    cached = llm_cache.get(key)
+    if cached is not None:
+        LLM_CACHE_REQUESTS.inc("generate_content", "hit")
+        on_chunk(cached)
+        return cached
+    LLM_CACHE_REQUESTS.inc("generate_content", "miss")
+
+    streamed = False
+
+    def run():
+        nonlocal streamed
+        streamed = True
+        chunks = []
+        for chunk in stream(messages):
+            chunks.append(chunk)
+            on_chunk(chunk)
+        content = "".join(chunks)
+        llm_cache.put(key, content, name="generate_content")
+        return content
+
+    content = in_flight.do(key, run)
+    if not streamed:
+        on_chunk(content)
+    return content
@@ -0,0 +1,228 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+from utils import sqlite_conn
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS versions (
+    project TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    segment INTEGER,
+    line INTEGER,
+    pages INTEGER,
+    updated REAL,
+    PRIMARY KEY (project, seq)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS versions_by_name ON versions (project, version);
+CREATE TABLE IF NOT EXISTS heads (
+    project TEXT PRIMARY KEY,
+    version TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stamp (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stamp (id, value) VALUES (0, 0);
+"""
+
+
+# where a version's manifest lives: a line in a packed manifest segment, or
+# a legacy <project>_<version>.json file when segment is None; pages and
+# updated let listings skip loading the manifest at all
+class Location(NamedTuple):
+    version: str
+    seq: int
+    segment: Optional[int]
+    line: Optional[int]
+    pages: Optional[int] = None
+    updated: Optional[float] = None
+
+
+class Summary(NamedTuple):
+    project: str
+    version: str
+    pages: Optional[int]
+    updated: Optional[float]
+
+
+LOCATION = "version, seq, segment, line, pages, updated"
+
+
+class VersionIndex:
+    # per-project ordered version list plus a head pointer, so finding the
+    # latest version doesn't need to glob + stat every manifest on disk
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        # indexes written by older versions lack the location and summary columns
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(versions)")}
+        for column, kind in (
+            ("segment", "INTEGER"),
+            ("line", "INTEGER"),
+            ("pages", "INTEGER"),
+            ("updated", "REAL"),
+        ):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE versions ADD COLUMN {column} {kind}")
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite_conn(self._local, self.path)
+
+    def head(self, project: str) -> Optional[str]:
+        row = (
+            self._conn()
+            .execute("SELECT version FROM heads WHERE project = ?", (project,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def head_location(self, project: str) -> Optional[Location]:
+        row = (
+            self._conn()
+            .execute(
+                "SELECT v.version, v.seq, v.segment, v.line, v.pages, v.updated FROM heads h"
+                " JOIN versions v ON v.project = h.project AND v.seq = h.seq"
+                " WHERE h.project = ?",
+                (project,),
+            )
+            .fetchone()
+        )
+        return Location(*row) if row else None
+
+    def location(self, project: str, version: str) -> Optional[Location]:
+        row = (
+            self._conn()
+            .execute(
+                f"SELECT {LOCATION} FROM versions WHERE project = ? AND version = ?",
+                (project, version),
+            )
+            .fetchone()
+        )
+        return Location(*row) if row else None
+
+    def locations(self, project: str) -> List[Location]:
+        rows = self._conn().execute(
+            f"SELECT {LOCATION} FROM versions WHERE project = ? ORDER BY seq",
+            (project,),
+        )
+        return [Location(*row) for row in rows]
+
+    def next_segment(self, project: str) -> int:
+        (segment,) = (
+            self._conn()
+            .execute(
+                "SELECT COALESCE(MAX(segment) + 1, 0) FROM versions WHERE project = ?",
+                (project,),
+            )
+            .fetchone()
+        )
+        return segment
+
+    def exists(self, project: str) -> bool:
+        return self.head(project) is not None
+
+    def has_version(self, project: str, version: str) -> bool:
+        return self.location(project, version) is not None
+
+    def projects(self) -> List[str]:
+        rows = self._conn().execute("SELECT project FROM heads ORDER BY project")
+        return [r[0] for r in rows]
+
+    def project_count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM heads").fetchone()[0]
+
+    # one row per project from the head pointers, ordered by name
+    def summaries(self, limit: int = -1, offset: int = 0) -> List[Summary]:
+        rows = self._conn().execute(
+            "SELECT h.project, h.version, v.pages, v.updated FROM heads h"
+            " JOIN versions v ON v.project = h.project AND v.seq = h.seq"
+            " ORDER BY h.project LIMIT ? OFFSET ?",
+            (limit, offset),
+        )
+        return [Summary(*row) for row in rows]
+
+    # bumped whenever stored data is rewritten rather than added to
+    # (rebuilds, repacks, backfilled variants), so processes sharing the
+    # store know to drop what they've cached
+    def stamp(self) -> int:
+        return self._conn().execute("SELECT value FROM stamp").fetchone()[0]
+
+    def bump(self, conn: sqlite3.Connection = None):
+        if conn is not None:
+            conn.execute("UPDATE stamp SET value = value + 1")
+            return
+        with self._conn() as conn:
+            conn.execute("UPDATE stamp SET value = value + 1")
+
+    def versions(self, project: str) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT version FROM versions WHERE project = ? ORDER BY seq DESC",
+            (project,),
+        )
+        return [r[0] for r in rows]
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM versions").fetchone()[0]
+
+    def add(
+        self,
+        project: str,
+        version: str,
+        segment: int = None,
+        line: int = None,
+        pages: int = None,
+        updated: float = None,
+    ):
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._add(conn, project, version, segment, line, pages, updated)
+
+    def _add(
+        self, conn: sqlite3.Connection, project, version, segment, line, pages, updated
+    ):
+        exists = conn.execute(
+            "SELECT 1 FROM versions WHERE project = ? AND version = ?",
+            (project, version),
+        ).fetchone()
+        if exists:
+            return
+        (seq,) = conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) + 1 FROM versions WHERE project = ?",
+            (project,),
+        ).fetchone()
+        conn.execute(
+            "INSERT INTO versions (project, seq, version, segment, line, pages, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (project, seq, version, segment, line, pages, updated),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO heads (project, version, seq) VALUES (?, ?, ?)",
+            (project, version, seq),
+        )
+
+    # entries are (project, version, segment, line, pages, updated), in the
+    # order the versions were created (oldest first)
+    def rebuild(self, entries: Iterable[Tuple]):
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM versions")
+            conn.execute("DELETE FROM heads")
+            for entry in entries:
+                self._add(conn, *entry)
+            self.bump(conn)
+
+    # entries are (version, segment, line, pages, updated)
+    def replace_project(self, project: str, entries: Iterable[Tuple]):
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM versions WHERE project = ?", (project,))
+            conn.execute("DELETE FROM heads WHERE project = ?", (project,))
+            for entry in entries:
+                self._add(conn, project, *entry)
+            self.bump(conn)
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, Field
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from metrics import JOB_WAIT_SECONDS
+from utils import sqlite_conn, worker_alive
+
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
+    project: str
+    page: str
+    status: str = "queued"  # queued, running, done or error
+    result: Any = None
+    error: Optional[str] = None
+    created: float = Field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    # pid of the process running it
+    worker: int = Field(default_factory=os.getpid)
+
+
+class JobRegistry:
+    # jobs shared through sqlite, so any worker process can report on a job
+    # another one is running; each worker still runs only its own jobs
+    def __init__(self, path: Path, history: int = 1000):
+        self.path = path
+        self.history = history
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, created REAL NOT NULL, data TEXT NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite_conn(self._local, self.path)
+
+    def put(self, job: Job):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, created, data) VALUES (?, ?, ?)",
+                (job.id, job.created, job.model_dump_json()),
+            )
+
+    # a job whose worker has exited is never going to finish
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._conn().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = Job.model_validate_json(row[0])
+        if not job.finished and not worker_alive(job.worker):
+            job.status = "error"
+            job.error = f"Worker {job.worker} exited before the job finished"
+        return job
+
+    def prune(self):
+        with self._conn() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE id NOT IN"
+                " (SELECT id FROM jobs ORDER BY created DESC LIMIT ?)",
+                (self.history,),
+            )
+
+
+class JobQueue:
+    # runs at most max_workers jobs at once, and at most max_per_project for
+    # any one project; jobs over the project limit wait without holding a
+    # worker so they can't starve other projects. With a registry, job state
+    # is also written there for other processes to read (the limits stay
+    # per process)
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_per_project: int = 2,
+        history: int = 1000,
+        registry: JobRegistry = None,
+    ):
+        self.max_workers = max_workers
+        self.max_per_project = max_per_project
+        self.history = history
+        self.registry = registry
+        self.jobs: Dict[str, Job] = OrderedDict()
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="codette-job")
+        self._running = defaultdict(int)
+        self._waiting = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    # on_finish is called with the job once it is done or has failed
+    def submit(
+        self,
+        project: str,
+        page: str,
+        fn: Callable[[], Any],
+        on_finish: Callable[[Job], None] = None,
+    ) -> Job:
+        job = Job(project=project, page=page)
+        if self.registry:
+            self.registry.put(job)
+            self.registry.prune()
+        with self._lock:
+            self.jobs[job.id] = job
+            self._prune()
+            if self._running[project] < self.max_per_project:
+                self._start(job, fn, on_finish)
+            else:
+                self._waiting[project].append((job, fn, on_finish))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None and self.registry:
+            return self.registry.get(job_id)
+        return job
+
+    def _publish(self, job: Job):
+        if self.registry:
+            self.registry.put(job)
+
+    def _start(self, job: Job, fn: Callable[[], Any], on_finish: Callable[[Job], None]):
+        self._running[job.project] += 1
+        self._executor.submit(self._run, job, fn, on_finish)
+
+    def _run(self, job: Job, fn: Callable[[], Any], on_finish: Callable[[Job], None]):
+        job.status = "running"
+        job.started = time.time()
+        JOB_WAIT_SECONDS.observe(job.started - job.created)
+        try:
+            self._publish(job)
+            job.result = fn()
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+        finally:
+            finished = time.time()
+            # other workers see the outcome before anyone here is told the
+            # job has finished or another job takes its place
+            self._publish(job.model_copy(update={"finished": finished}))
+            job.finished = finished
+            with self._lock:
+                self._running[job.project] -= 1
+                if self._waiting[job.project]:
+                    self._start(*self._waiting[job.project].popleft())
+                if not self._running[job.project] and not self._waiting[job.project]:
+                    del self._running[job.project]
+                    del self._waiting[job.project]
+            if on_finish:
+                on_finish(job)
+
+    def _prune(self):
+        # forget the oldest finished jobs once we're over history
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in [j.id for j in self.jobs.values() if j.finished][:excess]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
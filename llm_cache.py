@@ -0,0 +1,171 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from utils import sqlite_conn
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_by_accessed ON entries (accessed);
+"""
+
+
+class LLMCache:
+    # size and age bounded cache of LLM responses in a single sqlite file,
+    # evicting the least recently used entries first
+    def __init__(
+        self,
+        path: Path,
+        max_bytes: Optional[int] = 256 * 1024 * 1024,
+        max_age: Optional[float] = None,
+    ):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    # connect lazily so importing the generator doesn't touch the disk
+    def _conn(self) -> sqlite3.Connection:
+        if getattr(self._local, "conn", None) is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        return sqlite_conn(self._local, self.path, SCHEMA)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._conn() as conn:
+            row = conn.execute(
+                "SELECT value, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.max_age is not None and now - row[1] > self.max_age:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, name: str = ""):
+        data = json.dumps(value)
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, name, value, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, name, data, len(data), now, now),
+            )
+            self._prune(conn, self.max_bytes, self.max_age)
+
+    def prune(self, max_bytes: Optional[int] = None, max_age: Optional[float] = None) -> int:
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return self._prune(conn, max_bytes, max_age)
+
+    def _prune(self, conn: sqlite3.Connection, max_bytes, max_age) -> int:
+        removed = 0
+        if max_age is not None:
+            removed += conn.execute(
+                "DELETE FROM entries WHERE created < ?", (time.time() - max_age,)
+            ).rowcount
+        if max_bytes is not None:
+            (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+            excess = total - max_bytes
+            if excess > 0:
+                evict = []
+                for key, size in conn.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed ASC"
+                ):
+                    evict.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM entries WHERE key = ?", evict)
+                removed += len(evict)
+        return removed
+
+    def clear(self) -> int:
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM entries").rowcount
+
+    def entries(self, limit: int = 20) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT key, name, size, created, accessed FROM entries"
+            " ORDER BY accessed DESC LIMIT ?",
+            (limit,),
+        )
+        columns = ("key", "name", "size", "created", "accessed")
+        return [dict(zip(columns, row)) for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        entries, size = (
+            self._conn()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+            .fetchone()
+        )
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "max_age": self.max_age,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    # pull in the <name>_<key>.json files written by the old disk_cache
+    def import_legacy(self, cache_dir: Path) -> int:
+        imported = 0
+        for file_path in Path(cache_dir).glob("*_*.json"):
+            name, key = file_path.stem.rsplit("_", 1)
+            with file_path.open("r") as f:
+                self.put(key, json.load(f), name=name)
+            imported += 1
+        return imported
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and prune the LLM response cache")
+    parser.add_argument("--path", default=".llm_cache/cache.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="show entry count and size")
+    entries = subparsers.add_parser("list", help="list the most recently used entries")
+    entries.add_argument("--limit", type=int, default=20)
+    prune = subparsers.add_parser("prune", help="evict entries over a size or age")
+    prune.add_argument("--max-bytes", type=int)
+    prune.add_argument("--max-age", type=float, help="seconds")
+    subparsers.add_parser("clear", help="remove every entry")
+    legacy = subparsers.add_parser("import-legacy", help="import old per-call json files")
+    legacy.add_argument("cache_dir", nargs="?", default=".llm_cache")
+
+    args = parser.parse_args()
+    cache = LLMCache(Path(args.path), max_bytes=None)
+
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.command == "list":
+        for entry in cache.entries(args.limit):
+            print(
+                f"{entry['key']}  {entry['name']:<20} {entry['size']:>9}  "
+                f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['accessed']))}"
+            )
+    elif args.command == "prune":
+        print(f"removed {cache.prune(args.max_bytes, args.max_age)} entries")
+    elif args.command == "clear":
+        print(f"removed {cache.clear()} entries")
+    elif args.command == "import-legacy":
+        print(f"imported {cache.import_legacy(Path(args.cache_dir))} entries")
@@ -0,0 +1,151 @@
+import json
+from typing import Dict, Iterator, List, Tuple
+from backends import Backend
+
+
+# each segment starts with a full snapshot of the project's pages and assets,
+# and every following line only records what changed relative to the line
+# before it, so loading a version replays at most SEGMENT_SIZE records. Every
+# record also carries the time its version was saved ("updated")
+SEGMENT_SIZE = 256
+
+
+def snapshot_record(version: str, pages: List[Dict], assets: Dict[str, Dict] = None) -> Dict:
+    record = {"version": version, "pages": pages}
+    if assets:
+        record["assets"] = assets
+    return record
+
+
+def replay(records: List[Dict]) -> List[Dict]:
+    pages = []
+    for record in records:
+        if "pages" in record:
+            pages = list(record["pages"])
+            continue
+        replaced = set(record.get("del", [])) | {p["name"] for p in record.get("set", [])}
+        pages = [p for p in pages if p["name"] not in replaced] + record.get("set", [])
+    return pages
+
+
+# assets are keyed by path; in a delta, a path mapped to None was removed
+def replay_assets(records: List[Dict]) -> Dict[str, Dict]:
+    assets = {}
+    for record in records:
+        if "pages" in record:
+            assets = {}
+        for path, asset in record.get("assets", {}).items():
+            if asset is None:
+                assets.pop(path, None)
+            else:
+                assets[path] = asset
+    return assets
+
+
+# the pages and assets that changed or went away since parent; falls back
+# to a snapshot when the page order can't be reproduced that way
+def delta_record(
+    version: str,
+    parent: List[Dict],
+    pages: List[Dict],
+    parent_assets: Dict[str, Dict] = None,
+    assets: Dict[str, Dict] = None,
+) -> Dict:
+    parent_assets, assets = parent_assets or {}, assets or {}
+    before = {p["name"]: p for p in parent}
+    names = {p["name"] for p in pages}
+    record = {"version": version}
+    changed = [p for p in pages if before.get(p["name"]) != p]
+    removed = [name for name in before if name not in names]
+    if changed:
+        record["set"] = changed
+    if removed:
+        record["del"] = removed
+    changed_assets = {
+        path: asset for path, asset in assets.items() if parent_assets.get(path) != asset
+    }
+    changed_assets.update({path: None for path in parent_assets if path not in assets})
+    if changed_assets:
+        record["assets"] = changed_assets
+    if replay([snapshot_record("", parent), record]) != pages:
+        return snapshot_record(version, pages, assets)
+    return record
+
+
+class StaleManifest(Exception):
+    pass
+
+
+class ManifestPack:
+    # project manifests packed into manifests/<project>/<segment>.pack, one
+    # compact json record per line
+    def __init__(self, backend: Backend):
+        self.backend = backend
+
+    def _key(self, project: str, segment: int) -> str:
+        return f"manifests/{project}/{segment:06d}.pack"
+
+    def _lines(self, project: str, segment: int) -> List[bytes]:
+        return self.backend.get(self._key(project, segment)).splitlines(True)
+
+    def read(self, project: str, segment: int, line: int) -> List[Dict]:
+        lines = self._lines(project, segment)
+        # a trailing line without a newline is a write still in progress
+        if len(lines) <= line or not lines[line].endswith(b"\n"):
+            raise FileNotFoundError(f"Manifest {project} {segment}:{line} not found")
+        return [json.loads(raw) for raw in lines[: line + 1]]
+
+    def append(self, project: str, segment: int, line: int, record: Dict):
+        key = self._key(project, segment)
+        try:
+            lines = self._lines(project, segment)
+        except FileNotFoundError:
+            lines = []
+        if len(lines) < line:
+            raise ValueError(f"Manifest {project} segment {segment} is missing records")
+        # complete records past `line` were written by someone the local
+        # index hasn't heard of (a write that died before reaching the index,
+        # or another machine on the same backend); they are never
+        # overwritten, the caller has to index them first
+        if len(lines) > line and lines[line].endswith(b"\n"):
+            raise StaleManifest(
+                f"Manifest {project} segment {segment} has records past line {line}"
+            )
+        data = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        if len(lines) > line:
+            # only a partial last line, from an append that was cut short
+            self.backend.put(key, b"".join(lines[:line]) + data)
+        else:
+            self.backend.append(key, data)
+
+    def delete(self, project: str, segment: int):
+        self.backend.delete(self._key(project, segment))
+
+    def segments(self, project: str) -> List[int]:
+        prefix = f"manifests/{project}/"
+        return sorted(
+            int(key[len(prefix) : -len(".pack")])
+            for key in self.backend.keys(prefix)
+            if key.endswith(".pack") and "/" not in key[len(prefix) :]
+        )
+
+    def projects(self) -> List[str]:
+        return sorted({key.split("/")[1] for key in self.backend.keys("manifests/")})
+
+    # every (version, segment, line, page count, updated time) for a
+    # project, in segment order; records written before they carried their
+    # time get the segment's mtime
+    def entries(self, project: str) -> Iterator[Tuple[str, int, int, int, float]]:
+        for segment in self.segments(project):
+            mtime = self.backend.stat(self._key(project, segment)).mtime
+            names = set()
+            for line, raw in enumerate(self._lines(project, segment)):
+                if not raw.endswith(b"\n"):
+                    break
+                record = json.loads(raw)
+                if "pages" in record:
+                    names = {p["name"] for p in record["pages"]}
+                names.difference_update(record.get("del", []))
+                names.update(p["name"] for p in record.get("set", []))
+                updated = record.get("updated", mtime)
+                yield record["version"], segment, line, len(names), updated
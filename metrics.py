@@ -0,0 +1,285 @@
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from utils import sqlite_conn, worker_alive
+
+# counters, gauges and histograms in the prometheus text format. Recording
+# is a dict lookup and an add under a lock, cheap enough to leave on for
+# every request; anything derived (cache sizes, queue depth) is read when
+# /metrics is scraped rather than tracked
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# while a request is being traced, a list that histograms append
+# (name, labels, seconds) to, so a slow request shows where its time went
+TRACE: ContextVar[Optional[List]] = ContextVar("codette_trace", default=None)
+
+# seconds, from a cached page read up to a slow model call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+DEFAULT_BUCKETS += (1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{n}="{escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def samples(self) -> Iterator[Tuple[str, str, float]]: ...
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for name, labels, value in self.samples():
+            yield f"{name}{labels} {format_value(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    # per label set: a count per bucket (not cumulative; summed when
+    # rendered), then the +Inf count and the sum
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+        trace = TRACE.get()
+        if trace is not None:
+            trace.append((self.name, labels, value))
+
+    def count(self, *labels) -> int:
+        counts = self._values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    # times every call of the decorated function
+    def time(self, *labels):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *labels)
+
+            return wrapper
+
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        for labels, counts in sorted(values):
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                total += n
+                le = f'le="{format_value(float(bound))}"'
+                yield f"{self.name}_bucket", format_labels(self.labels, labels, le), total
+            yield f"{self.name}_count", format_labels(self.labels, labels), total
+            yield f"{self.name}_sum", format_labels(self.labels, labels), counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    # extra metrics (e.g. gauges filled in at scrape time) are rendered
+    # after the registered ones
+    def render(self, extra: Iterable[Metric] = ()) -> str:
+        lines = []
+        for metric in [*self.metrics, *extra]:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# how often each worker writes its samples for the others to read
+FLUSH_SECONDS = 5.0
+
+
+class SharedSamples:
+    # every worker process's samples in sqlite, so a scrape of any one of
+    # them reports the whole server. Each worker replaces its own rows when
+    # scraped and every FLUSH_SECONDS, and a scrape adds up every worker's;
+    # counters and histograms keep the counts of workers that have exited,
+    # so totals never go backwards, while gauges only count live workers
+    def __init__(self, path: Path):
+        self.path = path
+        self._pid = self._worker = None
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            " worker TEXT NOT NULL, pid INTEGER NOT NULL, seq INTEGER NOT NULL,"
+            " metric TEXT NOT NULL, kind TEXT NOT NULL, help TEXT NOT NULL,"
+            " sample TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL)"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite_conn(self._local, self.path)
+
+    def flush(self, metrics: Iterable[Metric]):
+        pid = os.getpid()
+        if pid != self._pid:
+            # pids get reused, so a worker is its pid and when it started
+            self._pid, self._worker = pid, f"{pid}-{time.time_ns()}"
+        rows = [
+            (self._worker, pid, seq, metric.name, metric.kind, metric.help, name, labels, value)
+            for seq, metric in enumerate(metrics)
+            for name, labels, value in metric.samples()
+        ]
+        with self._conn() as conn:
+            conn.execute("DELETE FROM samples WHERE worker = ?", (self._worker,))
+            conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    # writes this worker's samples every FLUSH_SECONDS from a daemon thread
+    def start(self, collect: Callable[[], Iterable[Metric]]):
+        def run():
+            while True:
+                time.sleep(FLUSH_SECONDS)
+                try:
+                    self.flush(collect())
+                except sqlite3.Error:
+                    pass
+
+        threading.Thread(target=run, name="codette-metrics", daemon=True).start()
+
+    def render(self) -> str:
+        rows = self._conn().execute(
+            "SELECT pid, metric, kind, help, sample, labels, value FROM samples"
+            " ORDER BY seq, rowid"
+        )
+        alive = {}
+        metrics: Dict[str, Tuple[str, str, Dict]] = {}
+        for pid, metric, kind, help, sample, labels, value in rows:
+            if kind == "gauge":
+                if pid not in alive:
+                    alive[pid] = worker_alive(pid)
+                if not alive[pid]:
+                    continue
+            values = metrics.setdefault(metric, (kind, help, {}))[2]
+            values[sample, labels] = values.get((sample, labels), 0) + value
+        lines = []
+        for metric, (kind, help, values) in metrics.items():
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (sample, labels), value in values.items():
+                value = int(value) if value.is_integer() else value
+                lines.append(f"{sample}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    # counts start over, e.g. when the server is restarted
+    def reset(self):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM samples")
+
+
+REGISTRY = Registry()
+
+LOAD_PROJECT_SECONDS = REGISTRY.histogram(
+    "codette_load_project_seconds", "Time to load a project, by project cache result", ["cache"]
+)
+LOAD_BLOB_SECONDS = REGISTRY.histogram(
+    "codette_load_blob_seconds", "Time to load page content or a blob variant"
+)
+GENERATE_SECONDS = REGISTRY.histogram(
+    "codette_generate_seconds", "Model call latency", ["model", "stream"]
+)
+GENERATE_TOKENS = REGISTRY.counter(
+    "codette_generate_tokens_total", "Tokens used by model calls", ["model", "type"]
+)
+LLM_CACHE_REQUESTS = REGISTRY.counter(
+    "codette_llm_cache_requests_total", "Generation cache lookups", ["function", "result"]
+)
+JOB_WAIT_SECONDS = REGISTRY.histogram(
+    "codette_job_wait_seconds", "Time generation jobs spend queued before starting"
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "codette_request_seconds", "Time to handle a request, by app and route", ["app", "route"]
+)
+REQUESTS_IN_FLIGHT = REGISTRY.gauge(
+    "codette_requests_in_flight", "Requests currently being handled", ["app"]
+)
@@ -0,0 +1,33 @@
+import re
+from typing import List, Tuple
+
+
+class PatchError(ValueError):
+    pass
+
+
+BLOCK = re.compile(
+    r"<<<<<<< SEARCH\n(.*?)\n?=======\n(.*?)\n?>>>>>>> REPLACE", re.DOTALL
+)
+
+
+def parse_search_replace(patch: str) -> List[Tuple[str, str]]:
+    return BLOCK.findall(patch)
+
+
+# applies every block in order; each search must match exactly once so an
+# edit can't land somewhere the model didn't mean
+def apply_search_replace(content: str, patch: str) -> str:
+    blocks = parse_search_replace(patch)
+    if not blocks:
+        raise PatchError("no SEARCH/REPLACE blocks in patch")
+    for search, replace in blocks:
+        if not search:
+            raise PatchError("empty SEARCH block")
+        count = content.count(search)
+        if count == 0:
+            raise PatchError(f"SEARCH block not found: {search[:80]!r}")
+        if count > 1:
+            raise PatchError(f"SEARCH block matches {count} times: {search[:80]!r}")
+        content = content.replace(search, replace, 1)
+    return content
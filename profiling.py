@@ -0,0 +1,201 @@
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+from typing import Dict, List, Optional
+from utils import sqlite_conn
+
+# on-demand stack sampling of a live process, and traces of slow requests.
+# Samples are "collapsed stacks" (root;...;leaf count per line), the input
+# flamegraph.pl, speedscope and friends take
+
+# where threads sit when they have nothing to do; dropped unless asked for
+IDLE_FRAMES = {
+    "threading:Condition.wait",
+    "threading:Event.wait",
+    "queue:Queue.get",
+    "selectors:EpollSelector.select",
+    "selectors:KqueueSelector.select",
+    "selectors:PollSelector.select",
+    "selectors:SelectSelector.select",
+    "concurrent.futures.thread:_worker",
+}
+
+MAX_PROFILE_SECONDS = 60
+
+# how often a worker writes the slow traces it has queued and rereads a
+# threshold shared with other workers
+THRESHOLD_CHECK_SECONDS = 1.0
+
+
+def frame_label(frame, labels: Dict) -> str:
+    code = frame.f_code
+    label = labels.get(code)
+    if label is None:
+        module = frame.f_globals.get("__name__", "?")
+        label = labels[code] = f"{module}:{code.co_qualname}".replace(" ", "_")
+    return label
+
+
+# samples every thread but this one each interval for `seconds`; frames are
+# module:qualname, e.g. store:ProjectStore.load_project, so store and
+# backend frames show disk time and generator/anthropic frames model time
+def sample_stacks(seconds: float, interval: float = 0.005, idle: bool = False) -> Counter:
+    me = threading.get_ident()
+    labels = {}
+    stacks = Counter()
+    deadline = time.monotonic() + min(seconds, MAX_PROFILE_SECONDS)
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame, labels))
+                frame = frame.f_back
+            if not idle and stack[0] in IDLE_FRAMES:
+                continue
+            stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+class SlowTraces:
+    # the last `history` requests that took at least threshold seconds, with
+    # the store and generation time recorded while they ran (see
+    # metrics.TRACE); a threshold of None turns tracing off
+    def __init__(self, threshold: Optional[float] = None, history: int = 100):
+        self.threshold = threshold
+        self.traces = deque(maxlen=history)
+
+    @staticmethod
+    def trace(scope, app: str, route: str, seconds: float, spans: List) -> dict:
+        timings = {}
+        for name, labels, value in spans:
+            key = name if not labels else f"{name}{{{','.join(map(str, labels))}}}"
+            timings[key] = timings.get(key, 0) + value
+        return {
+            "time": time.time(),
+            "worker": os.getpid(),
+            "method": scope.get("method"),
+            "path": scope.get("path"),
+            "app": app,
+            "route": route,
+            "seconds": seconds,
+            "spans": timings,
+            "untracked_seconds": max(seconds - sum(timings.values()), 0),
+        }
+
+    def record(self, scope, app: str, route: str, seconds: float, spans: List):
+        self.traces.append(self.trace(scope, app, route, seconds, spans))
+
+    def list(self) -> List[dict]:
+        return sorted(self.traces, key=lambda t: t["time"], reverse=True)
+
+
+class SharedSlowTraces(SlowTraces):
+    # the threshold and traces in sqlite, for every worker process of a
+    # server: a threshold set through one worker applies to all of them
+    # within THRESHOLD_CHECK_SECONDS, and any of them lists every trace.
+    # Requests never wait on sqlite: record only queues the trace, and a
+    # daemon thread (see start) writes it and rereads the threshold.
+    # threshold is where tracing starts until it is changed at runtime
+    def __init__(self, path: Path, threshold: Optional[float] = None, history: int = 100):
+        self.path = path
+        self.history = history
+        self._local = threading.local()
+        # traces coming in faster than they're written are dropped
+        self._pending = queue.Queue(maxsize=history)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS traces ("
+            " id INTEGER PRIMARY KEY, time REAL NOT NULL, data TEXT NOT NULL)"
+        )
+        with conn:
+            # workers starting later keep whatever the threshold is now
+            conn.execute(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES ('threshold', ?)",
+                (threshold,),
+            )
+        self._threshold = self._read_threshold()
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite_conn(self._local, self.path)
+
+    def _read_threshold(self) -> Optional[float]:
+        row = self._conn().execute("SELECT value FROM settings WHERE key = 'threshold'").fetchone()
+        return row[0] if row else None
+
+    # read for every request, so this worker's copy
+    @property
+    def threshold(self) -> Optional[float]:
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, value: Optional[float]):
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('threshold', ?)", (value,)
+            )
+        self._threshold = value
+
+    def record(self, scope, app: str, route: str, seconds: float, spans: List):
+        try:
+            self._pending.put_nowait(self.trace(scope, app, route, seconds, spans))
+        except queue.Full:
+            pass
+
+    def _write_pending(self):
+        traces = []
+        while True:
+            try:
+                traces.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not traces:
+            return
+        with self._conn() as conn:
+            for trace in traces:
+                cursor = conn.execute(
+                    "INSERT INTO traces (time, data) VALUES (?, ?)",
+                    (trace["time"], json.dumps(trace)),
+                )
+            conn.execute("DELETE FROM traces WHERE id <= ?", (cursor.lastrowid - self.history,))
+
+    # every THRESHOLD_CHECK_SECONDS, from a daemon thread
+    def start(self):
+        def run():
+            while True:
+                time.sleep(THRESHOLD_CHECK_SECONDS)
+                try:
+                    self._write_pending()
+                    self._threshold = self._read_threshold()
+                except sqlite3.Error:
+                    pass
+
+        threading.Thread(target=run, name="codette-slow-traces", daemon=True).start()
+
+    def list(self) -> List[dict]:
+        self._write_pending()
+        rows = self._conn().execute(
+            "SELECT data FROM traces ORDER BY time DESC LIMIT ?", (self.history,)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    # back to threshold, with no traces, e.g. when the server is restarted
+    def reset(self, threshold: Optional[float] = None):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM traces")
+        self.threshold = threshold
@@ -1,6 +1,7 @@
 import json
 from jinja2 import Environment, FileSystemLoader
 import requests
+from generator import cacheable
 
 
 def generate_datasette_doc(url):
@@ -12,9 +13,12 @@ def generate_datasette_doc(url):
 
     return {
         "user": "What is the API documentation to use for this datasette?",
-        "assistant": template.render(
-            url=url,
-            docs=docs,
-            schema=json.dumps(schema, indent=2),
+        # the docs and schema are the same on every call for this datasette
+        "assistant": cacheable(
+            template.render(
+                url=url,
+                docs=docs,
+                schema=json.dumps(schema, indent=2),
+            )
         ),
     }
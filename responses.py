@@ -0,0 +1,97 @@
+import mmap
+import re
+from pathlib import Path
+from typing import Mapping, Optional, Tuple
+from starlette.responses import Response
+
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# a single "bytes=start-end" range as [start, end); multiple ranges aren't
+# supported, so those (and anything unparseable) get the whole body
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    match = RANGE.fullmatch((header or "").strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size
+        if int(last) == 0:
+            raise RangeNotSatisfiable()
+    else:
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+        if start >= size or end <= start:
+            raise RangeNotSatisfiable()
+    return start, end
+
+
+class BlobResponse(Response):
+    # serves a blob as bytes, either from memory or straight from a file
+    # through mmap so a multi-MB body is never copied onto the python heap
+    # in one piece; honours Range (and If-Range against our ETag)
+    def __init__(
+        self,
+        content: bytes = None,
+        path: Path = None,
+        media_type: str = None,
+        headers: Mapping[str, str] = None,
+        request_headers: Mapping[str, str] = None,
+    ):
+        self.path = path
+        self.content = content
+        size = path.stat().st_size if path is not None else len(content)
+        headers = {**(headers or {}), "Accept-Ranges": "bytes"}
+        request_headers = request_headers or {}
+
+        self.start, self.end = 0, size
+        status_code = 200
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and (not if_range or if_range == headers.get("ETag")):
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                byte_range = None
+                status_code = 416
+                self.end = 0
+                headers["Content-Range"] = f"bytes */{size}"
+            if byte_range:
+                self.start, self.end = byte_range
+                status_code = 206
+                headers["Content-Range"] = f"bytes {self.start}-{self.end - 1}/{size}"
+
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.headers["content-length"] = str(self.end - self.start)
+
+    async def __call__(self, scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope.get("method") == "HEAD" or self.end == self.start:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if self.path is None:
+            await self._send_chunks(send, self.content)
+            return
+        with self.path.open("rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                await self._send_chunks(send, mapped)
+
+    async def _send_chunks(self, send, body):
+        for offset in range(self.start, self.end, CHUNK_SIZE):
+            chunk = body[offset : min(offset + CHUNK_SIZE, self.end)]
+            more = offset + CHUNK_SIZE < self.end
+            await send({"type": "http.response.body", "body": chunk, "more_body": more})
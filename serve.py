@@ -1,33 +1,95 @@
 #!/usr/bin/env python3
 
+import argparse
+import os
 from pathlib import Path
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from api import create_app
 from store import ProjectStore
+from backends import backend_from_url
+from jobs import JobQueue, JobRegistry
+from metrics import SharedSamples
+from profiling import SharedSlowTraces
 import traceback
 
-project_store = ProjectStore(Path("./prod"))
-app = create_app(project_store)
+# the index, locks, job registry and metrics live here, on local disk;
+# every worker process opens the same ones
+store_path = Path(os.environ.get("CODETTE_PATH", "./prod"))
+metrics_path = store_path / "metrics.db"
+slow_request_seconds = (
+    float(os.environ["CODETTE_SLOW_REQUEST_SECONDS"])
+    if "CODETTE_SLOW_REQUEST_SECONDS" in os.environ
+    else None
+)
 
 
-@app.exception_handler(Exception)
-async def generic_exception_handler(request: Request, exc: Exception):
-    return JSONResponse(
-        status_code=500,
-        content={"error": str(exc), "traceback": traceback.format_exc()},
+# a factory, so uvicorn's supervisor process doesn't open the store or
+# start job and metrics threads; only the workers it runs build an app
+def create_server_app():
+    project_store = ProjectStore(
+        store_path,
+        project_cache_size=int(os.environ.get("CODETTE_PROJECT_CACHE_SIZE", 256)),
+        blob_cache_bytes=int(os.environ.get("CODETTE_BLOB_CACHE_BYTES", 32 * 1024 * 1024)),
+        chunked_blobs=os.environ.get("CODETTE_CHUNKED_BLOBS") == "1",
+        backend=backend_from_url(os.environ.get("CODETTE_STORAGE", str(store_path))),
+    )
+    job_queue = JobQueue(
+        max_workers=int(os.environ.get("CODETTE_MAX_JOBS", 4)),
+        max_per_project=int(os.environ.get("CODETTE_MAX_JOBS_PER_PROJECT", 2)),
+        registry=JobRegistry(store_path / "jobs.db"),
+    )
+    app = create_app(
+        project_store,
+        job_queue,
+        uploads_path=Path(os.environ.get("CODETTE_UPLOADS", "./uploads")),
+        admin_token=os.environ.get("CODETTE_ADMIN_TOKEN"),
+        slow_request_seconds=slow_request_seconds,
+        metrics_path=metrics_path,
     )
 
+    @app.api.exception_handler(Exception)
+    async def generic_exception_handler(request: Request, exc: Exception):
+        return JSONResponse(
+            status_code=500,
+            content={"error": str(exc), "traceback": traceback.format_exc()},
+        )
 
-@app.exception_handler(RequestValidationError)
-async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    return JSONResponse(
-        status_code=422,
-        content={"error": str(exc), "traceback": traceback.format_exc()},
-    )
+    @app.api.exception_handler(RequestValidationError)
+    async def validation_exception_handler(request: Request, exc: RequestValidationError):
+        return JSONResponse(
+            status_code=422,
+            content={"error": str(exc), "traceback": traceback.format_exc()},
+        )
 
+    return app
 
+
+# with --workers N (or WEB_CONCURRENCY) uvicorn runs N worker processes over
+# the same store; --reload, for development, restarts one on code changes
 if __name__ == "__main__":
-    uvicorn.run("serve:app", host="0.0.0.0", port=8000, reload=True, log_level="error")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1))
+    )
+    parser.add_argument("--reload", action="store_true")
+    args = parser.parse_args()
+    if args.reload and args.workers > 1:
+        parser.error("--reload only works with one worker")
+    store_path.mkdir(parents=True, exist_ok=True)
+    # metrics and slow request traces start over with each run
+    SharedSamples(metrics_path).reset()
+    SharedSlowTraces(metrics_path).reset(slow_request_seconds)
+    uvicorn.run(
+        "serve:create_server_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        reload=args.reload,
+        log_level="error",
+    )
@@ -1,11 +1,55 @@
 import re
 from pydantic import BaseModel, Field, field_validator, ValidationInfo
-from typing import List, Dict, Union, Optional, Any
+from typing import List, Dict, Union, Optional, Any, Tuple, Callable
 import json
 import hashlib
+import gzip
 from pathlib import Path
 import uuid
+import fcntl
+import time
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from index import VersionIndex
+from cache import LRUCache
+from metrics import LOAD_BLOB_SECONDS, LOAD_PROJECT_SECONDS
+from blobs import BlobStore, BlobWriter
+from manifests import (
+    ManifestPack,
+    SEGMENT_SIZE,
+    StaleManifest,
+    delta_record,
+    replay,
+    replay_assets,
+    snapshot_record,
+)
+from backends import Backend, FilesystemBackend
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# precompressed variants stored next to each blob as content/<sha256><suffix>
+COMPRESSORS = {"gzip": (".gz", lambda data: gzip.compress(data, 9, mtime=0))}
+if brotli:
+    COMPRESSORS["br"] = (".br", lambda data: brotli.compress(data, quality=11))
+
+# <project>_<version>.json manifests written before manifests were packed
+LEGACY_MANIFEST = re.compile(r"[a-z0-9-]+_[^/]+\.json")
+
+# blobs smaller than this aren't worth a second round trip to disk
+MIN_COMPRESS_SIZE = 256
+
+# how often a process checks the index stamp for another process having
+# rewritten data it may have cached
+STAMP_CHECK_SECONDS = 1.0
+
+
+class VersionConflict(Exception):
+    pass
 
 
 def validate_name(name: str) -> str:
@@ -16,6 +60,15 @@ def validate_name(name: str) -> str:
     return name
 
 
+def validate_asset_path(path: str) -> str:
+    parts = path.split("/")
+    if not all(re.fullmatch(r"[A-Za-z0-9_][A-Za-z0-9._-]*", part) for part in parts):
+        raise ValueError(
+            "Asset paths are /-separated names of letters, digits, '.', '_' and '-'"
+        )
+    return path
+
+
 class Page(BaseModel):
     name: str
     title: str = ""
@@ -35,12 +88,27 @@ class Page(BaseModel):
         return v
 
 
+# a file uploaded to a project, stored as a content-addressed blob like
+# page content so unchanged assets cost nothing in later versions
+class Asset(BaseModel):
+    path: str
+    content_hash: str
+    size: int
+    media_type: str = "application/octet-stream"
+
+    @field_validator("path")
+    @classmethod
+    def must_be_valid_path(cls, v: str) -> str:
+        return validate_asset_path(v)
+
+
 class Project(BaseModel):
     name: str
     version: str = Field(
         default_factory=lambda: f"{int(datetime.now().timestamp())}-{uuid.uuid4().hex[:6]}"
     )
     pages: List[Page] = Field(default_factory=list)
+    assets: List[Asset] = Field(default_factory=list)
 
     @field_validator("name")
     @classmethod
@@ -48,11 +116,91 @@ class Project(BaseModel):
         return validate_name(v)
 
 
+class ProjectSummary(BaseModel):
+    name: str
+    version: str
+    page_count: Optional[int] = None
+    updated: Optional[float] = None
+    versions: Optional[List[str]] = None
+
+
 class ProjectStore:
-    def __init__(self, base_path: Path):
+    def __init__(
+        self,
+        base_path: Path,
+        project_cache_size: int = 256,
+        blob_cache_bytes: int = 32 * 1024 * 1024,
+        chunked_blobs: bool = False,
+        backend: Backend = None,
+    ):
         self.base_path = base_path
-        self.content_path = base_path / "content"
-        self.content_path.mkdir(parents=True, exist_ok=True)
+        # manifests and blobs go through the backend; the version index and
+        # locks stay on local disk, the index can always be rebuilt from the
+        # backend. So a backend has one writing machine (see _update)
+        self.backend = backend or FilesystemBackend(base_path)
+        # versions are immutable once written, so (name, version) entries
+        # only go stale when history is rewritten (see _check_stamp)
+        self.project_cache = LRUCache(project_cache_size)
+        # blobs are content-addressed, so they never need invalidating; this
+        # also keeps reassembling chunked blobs off the hot path
+        self.blob_cache = LRUCache(maxsize=4096, max_bytes=blob_cache_bytes)
+        self.blobs = BlobStore(self.backend, chunked=chunked_blobs)
+        self.manifests = ManifestPack(self.backend)
+        self.locks_path = base_path / "locks"
+        self.locks_path.mkdir(parents=True, exist_ok=True)
+        self._held = threading.local()
+        index_path = base_path / "index.db"
+        # workers starting together must not each rebuild a missing index
+        # ("_" can't be in a project name, so this lock is never a project's)
+        with self.lock("_index"):
+            needs_rebuild = not index_path.exists()
+            self.index = VersionIndex(index_path)
+            if needs_rebuild:
+                self.rebuild_index()
+        self._stamp = self.index.stamp()
+        self._stamp_checked = time.monotonic()
+
+    # other processes only ever add versions and blobs, which can't make a
+    # cached entry wrong; when they rewrite something (a rebuild, repack or
+    # new compressed variants) they bump the index stamp and we start over
+    def _check_stamp(self):
+        now = time.monotonic()
+        if now - self._stamp_checked < STAMP_CHECK_SECONDS:
+            return
+        self._stamp_checked = now
+        stamp = self.index.stamp()
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self.project_cache.clear()
+            self.blob_cache.clear()
+
+    # serializes writers to a project across threads and processes (e.g.
+    # several uvicorn workers); re-entrant within a thread
+    @contextmanager
+    def lock(self, project_name: str):
+        held = self._held.__dict__.setdefault("counts", {})
+        if held.get(project_name):
+            held[project_name] += 1
+            try:
+                yield
+            finally:
+                held[project_name] -= 1
+            return
+
+        with open(self.locks_path / f"{project_name}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            held[project_name] = 1
+            try:
+                yield
+            finally:
+                held[project_name] = 0
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _check_version(self, project: Project, expected_version: Optional[str]):
+        if expected_version and project.version != expected_version:
+            raise VersionConflict(
+                f"Project {project.name} is at version {project.version}, not {expected_version}"
+            )
 
     def _hash_content(self, content: Union[str, bytes]) -> str:
         if isinstance(content, str):
@@ -60,34 +208,190 @@ class ProjectStore:
         return hashlib.sha256(content).hexdigest()
 
     def _store_content(self, content: Union[str, bytes]) -> str:
+        if isinstance(content, str):
+            content = content.encode()
         content_hash = self._hash_content(content)
-        file_path = self.content_path / content_hash
-        if not file_path.exists():
-            mode = "w" if isinstance(content, str) else "wb"
-            with file_path.open(mode) as f:
-                f.write(content)
+        if not self.blobs.has(content_hash):
+            self.blobs.put(content_hash, content)
+            self._compress_content(content_hash, content)
         return content_hash
 
-    def save_project(self, project: Project):
-        project_path = self.base_path / f"{project.name}_{project.version}.json"
-        with project_path.open("w") as f:
-            json.dump(project.model_dump(), f, indent=2)
+    def _compress_content(self, content_hash: str, content: bytes) -> int:
+        written = 0
+        if len(content) < MIN_COMPRESS_SIZE:
+            return written
+        for suffix, compress in COMPRESSORS.values():
+            if self.blobs.has_variant(content_hash, suffix):
+                continue
+            compressed = compress(content)
+            if len(compressed) < len(content):
+                self.blobs.put_variant(content_hash, suffix, compressed)
+                written += 1
+        return written
+
+    # backfill compressed variants for blobs stored before they existed
+    def compress_all_content(self) -> int:
+        written = 0
+        for content_hash in self.blobs.hashes():
+            written += self._compress_content(content_hash, self.blobs.get(content_hash))
+        if written:
+            # workers may have cached these variants as missing
+            self.index.bump()
+        return written
+
+    # updated defaults to now; imports pass the time the version was made
+    def save_project(self, project: Project, updated: float = None):
+        self._update(project.name, lambda: project, updated)
+
+    # saves what change() builds from the current head, under the project
+    # lock. Manifest records the index never heard of (left by a writer that
+    # died before indexing them) are adopted as versions first, and change()
+    # runs again on top of them so their edits aren't lost
+    def _update(
+        self, project_name: str, change: Callable[[], Project], updated: float = None
+    ) -> Project:
+        with self.lock(project_name):
+            for attempt in range(2):
+                project = change()
+                try:
+                    self._save_project(project, updated)
+                    return project
+                except StaleManifest as e:
+                    if attempt:
+                        raise VersionConflict(
+                            f"{e}; the version index is out of date, rebuild it"
+                        )
+                    self._reindex_project(project_name)
+
+    def _manifest(self, project: Project) -> Tuple[List[Dict], Dict[str, Dict]]:
+        pages = [p.model_dump(exclude_none=True) for p in project.pages]
+        assets = {a.path: a.model_dump(exclude={"path"}) for a in project.assets}
+        return pages, assets
+
+    def _save_project(self, project: Project, updated: float = None):
+        if self.index.has_version(project.name, project.version):
+            raise FileExistsError(
+                f"Version {project.version} of '{project.name}' already exists"
+            )
+        pages, assets = self._manifest(project)
+        updated = updated or time.time()
+        head = self.index.head_location(project.name)
+        if head and head.segment is not None and head.line + 1 < SEGMENT_SIZE:
+            parent_pages, parent_assets = self._manifest(
+                self.load_project(project.name, head.version)
+            )
+            record = delta_record(project.version, parent_pages, pages, parent_assets, assets)
+            segment, line = head.segment, head.line + 1
+        else:
+            record = snapshot_record(project.version, pages, assets)
+            segment, line = self.index.next_segment(project.name), 0
+        record["updated"] = updated
+        self.manifests.append(project.name, segment, line, record)
+        self.project_cache.invalidate((project.name, project.version))
+        self.index.add(
+            project.name, project.version, segment, line, len(pages), updated
+        )
+
+    # the project's index entries read back from its manifests, keeping
+    # legacy json versions (which only the index knows the order of)
+    def _reindex_project(self, project_name: str):
+        entries = [
+            (location.version, None, None, location.pages, location.updated)
+            for location in self.index.locations(project_name)
+            if location.segment is None
+        ]
+        entries.extend(self.manifests.entries(project_name))
+        self.index.replace_project(project_name, entries)
+
+    # rebuild the version index from the manifests on disk, oldest first;
+    # legacy json manifests always predate packed ones
+    def rebuild_index(self):
+        legacy = []
+        for key in self.backend.keys(""):
+            if LEGACY_MANIFEST.fullmatch(key):
+                legacy.append((self.backend.stat(key).mtime, key))
+        entries = []
+        for mtime, key in sorted(legacy):
+            pages = len(json.loads(self.backend.get(key)).get("pages", []))
+            entries.append((*key[: -len(".json")].rsplit("_", 1), None, None, pages, mtime))
+        for project_name in self.manifests.projects():
+            for entry in self.manifests.entries(project_name):
+                entries.append((project_name, *entry))
+        self.index.rebuild(entries)
+
+    # rewrite a project's whole history (including legacy json manifests)
+    # into fresh packed segments, numbered after the existing ones so the
+    # old segments stay readable until the index points at the new ones
+    def repack(self, project_name: str) -> int:
+        with self.lock(project_name):
+            return self._repack(project_name)
+
+    def _repack(self, project_name: str) -> int:
+        locations = self.index.locations(project_name)
+        old_segments = self.manifests.segments(project_name)
+        first = max(old_segments, default=-1) + 1
+        entries = []
+        parent = parent_assets = None
+        for i, location in enumerate(locations):
+            project = self.load_project(project_name, location.version)
+            pages, assets = self._manifest(project)
+            segment, line = divmod(i, SEGMENT_SIZE)
+            if line == 0:
+                record = snapshot_record(project.version, pages, assets)
+            else:
+                record = delta_record(project.version, parent, pages, parent_assets, assets)
+            if location.updated is not None:
+                record["updated"] = location.updated
+            self.manifests.append(project_name, first + segment, line, record)
+            entries.append(
+                (project.version, first + segment, line, len(pages), location.updated)
+            )
+            parent, parent_assets = pages, assets
+
+        self.index.replace_project(project_name, entries)
+        for segment in old_segments:
+            self.manifests.delete(project_name, segment)
+        for location in locations:
+            if location.segment is None:
+                self.backend.delete(f"{project_name}_{location.version}.json")
+        return len(entries)
 
-    # FIXME(ja) - this whole "latest version" is the current version
-    # is kinda broken!
     # Load the latest version if no specific version is provided
     def load_project(self, project_name: str, version: str = None) -> Project:
-        if version:
-            project_path = self.base_path / f"{project_name}_{version}.json"
-        else:
-            project_files = list(self.base_path.glob(f"{project_name}_*.json"))
-            if not project_files:
+        start = time.perf_counter()
+        self._check_stamp()
+        if not version:
+            version = self.index.head(project_name)
+            if not version:
                 raise FileNotFoundError(f"Project {project_name} not found")
-            project_path = max(project_files, key=lambda p: p.stat().st_mtime)
 
-        with project_path.open("r") as f:
-            data = json.load(f)
-        return Project.model_validate(data)
+        key = (project_name, version)
+        project = self.project_cache.get(key)
+        if project is not None:
+            LOAD_PROJECT_SECONDS.observe(time.perf_counter() - start, "hit")
+            return project
+
+        location = self.index.location(project_name, version)
+        if location is None:
+            raise FileNotFoundError(f"Project {project_name} version {version} not found")
+        if location.segment is None:
+            data = json.loads(self.backend.get(f"{project_name}_{version}.json"))
+        else:
+            records = self.manifests.read(project_name, location.segment, location.line)
+            if records[-1]["version"] != version:
+                raise ValueError(f"Manifest for {project_name} {version} is out of sync")
+            data = {
+                "name": project_name,
+                "version": version,
+                "pages": replay(records),
+                "assets": [
+                    {"path": path, **asset} for path, asset in replay_assets(records).items()
+                ],
+            }
+        project = Project.model_validate(data)
+        self.project_cache.put(key, project)
+        LOAD_PROJECT_SECONDS.observe(time.perf_counter() - start, "miss")
+        return project
 
     def load_page(self, project_name: str, page_name: str, version: str = None) -> Page:
         project = self.load_project(project_name, version)
@@ -96,33 +400,32 @@ class ProjectStore:
                 return page
         return None
 
-    # this is ugly because of the version issue
-    def list_projects(self, include_versions=True) -> List[Project]:
-        projects = {}
-        for f in self.base_path.glob("*.json"):
-            name, version = f.stem.rsplit("_", 1)
-            if name not in projects:
-                projects[name] = [self.load_project(name, version)]
-            elif include_versions:
-                projects[name].append(self.load_project(name, version))
-            elif version > projects[name][0]["version"]:
-                projects[name] = [self.load_project(name, version)]
-        for name, versions in projects.items():
-            projects[name] = sorted(versions, key=lambda v: v.version, reverse=True)
-
+    # summaries come straight from the index, no manifests are loaded
+    def list_projects(
+        self, limit: int = None, offset: int = 0, include_versions: bool = False
+    ) -> List[ProjectSummary]:
         response = []
-        for versions in projects.values():
-            for v in versions:
-                response.append(v)
+        for summary in self.index.summaries(-1 if limit is None else limit, offset):
+            response.append(
+                ProjectSummary(
+                    name=summary.project,
+                    version=summary.version,
+                    page_count=summary.pages,
+                    updated=summary.updated,
+                    versions=self.index.versions(summary.project)
+                    if include_versions
+                    else None,
+                )
+            )
         return response
 
+    def count_projects(self) -> int:
+        return self.index.project_count()
+
     def exists(self, name: str) -> bool:
-        return len(list(self.base_path.glob(f"{name}_*.json"))) > 0
+        return self.index.exists(name)
 
     def create_project(self, name: str, pages: List[Dict]) -> Project:
-        if self.exists(name):
-            raise FileExistsError(f"A project named '{name}' already exists")
-
         processed_pages = []
         for page in pages:
             content_hash = self._store_content(page["content"])
@@ -135,44 +438,203 @@ class ProjectStore:
             )
 
         project = Project(name=name, pages=processed_pages)
-        self.save_project(project)
-        return project
+
+        def change():
+            if self.exists(name):
+                raise FileExistsError(f"A project named '{name}' already exists")
+            return project
+
+        return self._update(name, change)
 
     # def get_project_pages(self, project_name: str) -> List[str]:
     #     project = self.load_project(project_name)
     #     return [page.name for page in project.pages]
 
+    # with an encoding, load the precompressed variant of the blob instead
+    @LOAD_BLOB_SECONDS.time()
+    def load_blob(self, content_hash: str, encoding: str = None) -> bytes:
+        if not re.fullmatch(r"[0-9a-f]{64}", content_hash or ""):
+            raise FileNotFoundError(f"Content {content_hash} not found")
+        self._check_stamp()
+        if not encoding:
+            blob = self.blob_cache.get(content_hash)
+            if blob is None:
+                blob = self.blobs.get(content_hash)
+                self.blob_cache.put(content_hash, blob)
+            return blob
+
+        key = (content_hash, encoding)
+        blob = self.blob_cache.get(key)
+        if blob is None:
+            # remember missing variants as b"" so we don't keep hitting disk
+            suffix = COMPRESSORS[encoding][0] if encoding in COMPRESSORS else None
+            blob = (self.blobs.get_variant(content_hash, suffix) if suffix else None) or b""
+            self.blob_cache.put(key, blob)
+        if not blob:
+            raise FileNotFoundError(f"No {encoding} variant of {content_hash}")
+        return blob
+
+    # a local file holding the blob (or its precompressed variant), for
+    # serving it without reading it into memory; None for remote backends
+    # and chunked blobs
+    def blob_file(self, content_hash: str, encoding: str = None) -> Optional[Path]:
+        if not re.fullmatch(r"[0-9a-f]{64}", content_hash or ""):
+            return None
+        if not encoding:
+            return self.blobs.file_path(content_hash)
+        if encoding not in COMPRESSORS:
+            return None
+        return self.backend.path(f"content/{content_hash}{COMPRESSORS[encoding][0]}")
+
+    # uploads are staged under tmp/ on local disk while they're hashed
+    def blob_writer(self) -> BlobWriter:
+        return self.blobs.writer(self.base_path / "tmp")
+
+    def save_asset(
+        self,
+        project_name: str,
+        path: str,
+        content_hash: str,
+        size: int,
+        media_type: str = None,
+        expected_version: str = None,
+    ) -> Project:
+        asset = Asset(
+            path=path,
+            content_hash=content_hash,
+            size=size,
+            media_type=media_type or "application/octet-stream",
+        )
+        def change():
+            project = self.load_project(project_name)
+            self._check_version(project, expected_version)
+            updated_project = Project(
+                name=project.name,
+                pages=project.pages,
+                assets=[a for a in project.assets if a.path != path] + [asset],
+            )
+            return updated_project
+
+        return self._update(project_name, change)
+
+    def delete_asset(
+        self, project_name: str, path: str, expected_version: str = None
+    ) -> Project:
+        def change():
+            project = self.load_project(project_name)
+            self._check_version(project, expected_version)
+            if not any(a.path == path for a in project.assets):
+                raise FileNotFoundError(f"Asset {path} not found in {project_name}")
+            updated_project = Project(
+                name=project.name,
+                pages=project.pages,
+                assets=[a for a in project.assets if a.path != path],
+            )
+            return updated_project
+
+        return self._update(project_name, change)
+
+    def load_asset(self, project_name: str, path: str, version: str = None) -> Optional[Asset]:
+        project = self.load_project(project_name, version)
+        for asset in project.assets:
+            if asset.path == path:
+                return asset
+        return None
+
     def load_content(self, project_name: str, content_hash: str) -> str:
-        file_path = self.content_path / content_hash
-        with file_path.open("r") as f:
-            return f.read()
+        return self.load_blob(content_hash).decode()
 
+    # with expected_version the update only applies if the project is still
+    # at that version, otherwise VersionConflict is raised
     def create_or_update_page(
-        self, project_name: str, page_name: str, content: str
+        self,
+        project_name: str,
+        page_name: str,
+        content: str,
+        expected_version: str = None,
     ) -> Project:
-        project = self.load_project(project_name)
         content_hash = self._store_content(content)
         new_page = Page(
             name=page_name,
             title=page_name,
             content_hash=content_hash,
         )
-        updated_project = Project(
-            name=project.name,
-            pages=[p for p in project.pages if p.name != page_name] + [new_page],
-        )
-        self.save_project(updated_project)
-        return updated_project
+        def change():
+            project = self.load_project(project_name)
+            self._check_version(project, expected_version)
+            updated_project = Project(
+                name=project.name,
+                pages=[p for p in project.pages if p.name != page_name] + [new_page],
+                assets=project.assets,
+            )
+            return updated_project
+
+        return self._update(project_name, change)
+
+    def delete_page(
+        self, project_name: str, page_name: str, expected_version: str = None
+    ) -> Project:
+        def change():
+            project = self.load_project(project_name)
+            self._check_version(project, expected_version)
+            updated_pages = [page for page in project.pages if page.name != page_name]
+            updated_project = Project(
+                name=project.name, pages=updated_pages, assets=project.assets
+            )
+            return updated_project
 
-    def delete_page(self, project_name: str, page_name: str) -> Project:
-        project = self.load_project(project_name)
-        updated_pages = [page for page in project.pages if page.name != page_name]
-        updated_project = Project(name=project.name, pages=updated_pages)
-        self.save_project(updated_project)
-        return updated_project
+        return self._update(project_name, change)
 
     def list_project_versions(self, project_name: str) -> List[str]:
-        versions = [
-            f.stem.split("_")[-1] for f in self.base_path.glob(f"{project_name}_*.json")
-        ]
-        return sorted(versions, reverse=True)
+        return self.index.versions(project_name)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Codette project store tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = subparsers.add_parser(
+        "rebuild-index", help="rebuild the version index from manifests on disk"
+    )
+    rebuild.add_argument("path", nargs="?", default="./prod")
+
+    compress = subparsers.add_parser(
+        "compress", help="write compressed variants for existing content blobs"
+    )
+    compress.add_argument("path", nargs="?", default="./prod")
+
+    migrate = subparsers.add_parser(
+        "migrate-blobs", help="rewrite content blobs as deduplicated chunks, or back"
+    )
+    migrate.add_argument("path", nargs="?", default="./prod")
+    migrate.add_argument("--to", choices=["chunked", "files"], default="chunked")
+
+    pack = subparsers.add_parser(
+        "pack", help="repack every project's manifests, including legacy json files"
+    )
+    pack.add_argument("path", nargs="?", default="./prod")
+
+    args = parser.parse_args()
+
+    if args.command == "rebuild-index":
+        store = ProjectStore(Path(args.path))
+        store.rebuild_index()
+        print(f"indexed {store.index.count()} versions")
+    elif args.command == "compress":
+        store = ProjectStore(Path(args.path))
+        print(f"wrote {store.compress_all_content()} compressed variants")
+    elif args.command == "pack":
+        store = ProjectStore(Path(args.path))
+        for name in store.index.projects():
+            print(f"{name}: packed {store.repack(name)} versions")
+    elif args.command == "migrate-blobs":
+        store = ProjectStore(Path(args.path), chunked_blobs=args.to == "chunked")
+        report = store.blobs.migrate()
+        saved = report["before"] - report["after"]
+        print(
+            f"{report['blobs']} blobs, {report['logical_bytes']} bytes of content: "
+            f"{report['before']} -> {report['after']} bytes on disk "
+            f"({saved / max(report['before'], 1):.0%} saved)"
+        )
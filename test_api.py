@@ -1,21 +1,48 @@
 import pytest
+import asyncio
+import json
+import time
 import tempfile
 import shutil
+import socket
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import requests
+import uvicorn
 from fastapi.testclient import TestClient
+import api
+import generator
+import metrics
+import profiling
 from api import create_app
+from archive import directory_archive
+from jobs import JobQueue, JobRegistry
+from profiling import SharedSlowTraces
 from store import ProjectStore
 
 
+# generation (streamed pages especially) goes through the model cache, which
+# mustn't carry pages between tests or touch the real one
+@pytest.fixture(autouse=True)
+def isolated_llm_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(generator.llm_cache, "path", tmp_path / "llm_cache.db")
+    monkeypatch.setattr(generator.llm_cache, "_local", threading.local())
+
+
 @pytest.fixture
 def client_builder():
     temp_dir = tempfile.mkdtemp()
     project_store = ProjectStore(Path(temp_dir))
-    app = create_app(project_store)
+    app = create_app(project_store, uploads_path=Path(temp_dir) / "uploads")
 
     def client_builder(subdomain="api"):
         return TestClient(app, base_url=f"http://{subdomain}.test")
 
+    client_builder.path = Path(temp_dir)
+    client_builder.store = project_store
+
     yield client_builder
     shutil.rmtree(temp_dir)
 
@@ -52,7 +79,9 @@ def test_create_project(client_builder):
     assert response.status_code == 200
     projects = response.json()
     assert len(projects) == 1
-    assert projects[0] == created_project
+    assert projects[0]["name"] == created_project["name"]
+    assert projects[0]["version"] == created_project["version"]
+    assert projects[0]["page_count"] == 0
 
 
 def test_only_one_project(client_builder):
@@ -74,7 +103,9 @@ def test_only_one_project(client_builder):
     assert response.status_code == 200
     projects = response.json()
     assert len(projects) == 1
-    assert projects[0] == created_project
+    assert projects[0]["name"] == created_project["name"]
+    assert projects[0]["version"] == created_project["version"]
+    assert projects[0]["page_count"] == 0
 
 
 def test_adding_pages_to_empty_project(client_builder):
@@ -265,5 +296,936 @@ def test_index_served_at_index(client_builder):
     assert response.content.decode("utf-8") == project_data["pages"][0]["content"]
 
 
+def test_page_etag_and_not_modified(client_builder):
+    api_client = client_builder()
+
+    project_data = {
+        "name": "etags",
+        "pages": [{"name": "index", "content": "This is a new index page"}],
+    }
+
+    response = api_client.post("/v0/projects", json=project_data)
+    assert response.status_code == 201
+    created_project = response.json()
+    content_hash = created_project["pages"][0]["content_hash"]
+
+    version_client = client_builder(f"etags_{created_project['version']}")
+    response = version_client.get("/")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{content_hash}"'
+    assert "immutable" in response.headers["cache-control"]
+
+    response = version_client.get("/", headers={"If-None-Match": f'"{content_hash}"'})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    latest_client = client_builder("etags")
+    response = latest_client.get("/", headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-cache"
+
+
+def test_page_served_precompressed(client_builder):
+    api_client = client_builder()
+
+    content = "<p>This is a large page</p>\n" * 200
+    project_data = {"name": "compressed", "pages": [{"name": "index", "content": content}]}
+
+    response = api_client.post("/v0/projects", json=project_data)
+    assert response.status_code == 201
+
+    content_client = client_builder("compressed")
+    response = content_client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content.decode("utf-8") == content
+
+    response = content_client.get("/", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+    assert response.content.decode("utf-8") == content
+
+
+def test_not_modified_sends_matched_variant_etag(client_builder):
+    api_client = client_builder()
+
+    content = "<p>This is a large page</p>\n" * 200
+    project_data = {"name": "variant-etags", "pages": [{"name": "index", "content": content}]}
+
+    response = api_client.post("/v0/projects", json=project_data)
+    assert response.status_code == 201
+    content_hash = response.json()["pages"][0]["content_hash"]
+
+    content_client = client_builder("variant-etags")
+    response = content_client.get("/", headers={"Accept-Encoding": "gzip"})
+    etag = response.headers["etag"]
+    assert etag == f'"{content_hash}-gzip"'
+
+    response = content_client.get(
+        "/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    response = content_client.get("/", headers={"If-None-Match": f'"{content_hash}-bogus"'})
+    assert response.status_code == 200
+
+
+def wait_for_job(api_client, job_id):
+    for _ in range(100):
+        job = api_client.get(f"/v0/jobs/{job_id}").json()
+        if job["status"] in ("done", "error"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_generate_page_runs_as_job(client_builder, monkeypatch):
+    prompts = []
+
+    def fake_generate_content(messages):
+        prompts.append(messages)
+        return f"<p>{messages[-1]}</p>"
+
+    monkeypatch.setattr(api, "generate_content", fake_generate_content)
+    monkeypatch.setattr(api, "generate_edit", lambda messages: "<title>error</title>")
+    api_client = client_builder()
+
+    response = api_client.post("/v0/projects", json={"name": "generated"})
+    assert response.status_code == 201
+
+    response = api_client.post(
+        "/v0/projects/generated/pages/index/generate", json={"prompt": "hello"}
+    )
+    assert response.status_code == 202
+    job = response.json()
+    assert job["status"] in ("queued", "running", "done")
+    assert response.headers["location"] == f"/v0/jobs/{job['id']}"
+
+    job = wait_for_job(api_client, job["id"])
+    assert job["status"] == "done"
+    assert job["result"]["project"]["pages"][0]["name"] == "index"
+    assert job["result"]["report"] == {"mode": "full"}
+
+    response = client_builder("generated").get("/")
+    assert response.content.decode("utf-8") == "<p>hello</p>"
+
+    response = api_client.post(
+        "/v0/projects/generated/pages/index/generate", json={"prompt": "again"}
+    )
+    job = wait_for_job(api_client, response.json()["id"])
+    assert job["result"]["report"]["fallback"] == "edit request failed"
+    assert prompts[-1] == [
+        "What is the current page content?",
+        {"text": "<p>hello</p>", "cache": True},
+        "again",
+    ]
+
+    response = api_client.get("/v0/jobs/unknown")
+    assert response.status_code == 404
+
+    response = api_client.post(
+        "/v0/projects/missing/pages/index/generate", json={"prompt": "hello"}
+    )
+    assert response.status_code == 404
+
+
+def test_generate_page_job_errors_when_model_fails(client_builder, monkeypatch):
+    monkeypatch.setattr(
+        api, "generate_content", lambda messages: "<title>error</title><p>overloaded</p>"
+    )
+    api_client = client_builder()
+
+    api_client.post("/v0/projects", json={"name": "failing"})
+    response = api_client.post(
+        "/v0/projects/failing/pages/index/generate", json={"prompt": "hello"}
+    )
+    job = wait_for_job(api_client, response.json()["id"])
+    assert job["status"] == "error"
+    assert "overloaded" in job["error"]
+    assert job["result"] is None
+
+    response = api_client.get("/v0/projects/failing/versions")
+    assert len(response.json()) == 1
+
+
+def test_generate_page_edit_mode(client_builder, monkeypatch):
+    def fake_generate_edit(messages):
+        assert messages[-1] == "make it blue"
+        patch = "<<<<<<< SEARCH\n<p>red</p>\n=======\n<p>blue</p>\n>>>>>>> REPLACE"
+        return {"patch": patch, "output_tokens": 20}
+
+    def fail_generate_content(messages):
+        raise AssertionError("edits shouldn't regenerate the page")
+
+    monkeypatch.setattr(api, "generate_edit", fake_generate_edit)
+    monkeypatch.setattr(api, "generate_content", fail_generate_content)
+    api_client = client_builder()
+
+    page = "<html>\n" + "<script>let x = 1;</script>\n" * 50 + "<p>red</p>\n</html>"
+    project_data = {"name": "edited", "pages": [{"name": "index", "content": page}]}
+    api_client.post("/v0/projects", json=project_data)
+
+    response = api_client.post(
+        "/v0/projects/edited/pages/index/generate", json={"prompt": "make it blue"}
+    )
+    job = wait_for_job(api_client, response.json()["id"])
+    assert job["status"] == "done"
+    report = job["result"]["report"]
+    assert report["mode"] == "edit"
+    assert report["output_tokens"] == 20
+    assert report["saved_output_tokens"] > 0
+
+    response = client_builder("edited").get("/")
+    assert response.content.decode("utf-8") == page.replace("red", "blue")
+
+
+def test_generate_page_falls_back_when_patch_does_not_apply(client_builder, monkeypatch):
+    patch = "<<<<<<< SEARCH\n<p>green</p>\n=======\n<p>blue</p>\n>>>>>>> REPLACE"
+    monkeypatch.setattr(
+        api, "generate_edit", lambda messages: {"patch": patch, "output_tokens": 20}
+    )
+    monkeypatch.setattr(api, "generate_content", lambda messages: "<p>regenerated</p>")
+    api_client = client_builder()
+
+    project_data = {"name": "edited", "pages": [{"name": "index", "content": "<p>red</p>"}]}
+    api_client.post("/v0/projects", json=project_data)
+
+    response = api_client.post(
+        "/v0/projects/edited/pages/index/generate", json={"prompt": "make it blue"}
+    )
+    job = wait_for_job(api_client, response.json()["id"])
+    assert job["result"]["report"]["mode"] == "full"
+    assert "not found" in job["result"]["report"]["fallback"]
+
+    response = client_builder("edited").get("/")
+    assert response.content.decode("utf-8") == "<p>regenerated</p>"
+
+
+def parse_events(body):
+    events = []
+    for raw in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in raw.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_generate_page_stream(client_builder, monkeypatch):
+    def fake_generate_content_stream(messages):
+        yield "<!DOCTYPE html>"
+        yield "\n<p>"
+        yield messages[-1]
+        yield "</p>"
+
+    monkeypatch.setattr(api, "generate_content_stream", fake_generate_content_stream)
+    api_client = client_builder()
+
+    response = api_client.post("/v0/projects", json={"name": "streamed"})
+    assert response.status_code == 201
+
+    with api_client.stream(
+        "POST", "/v0/projects/streamed/pages/index/generate/stream", json={"prompt": "hi"}
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = parse_events(response.read().decode())
+
+    assert [data for event, data in events if event == "chunk"] == [
+        "<!DOCTYPE html>",
+        "\n<p>",
+        "hi",
+        "</p>",
+    ]
+    event, project = events[-1]
+    assert event == "done"
+    assert project["pages"][0]["name"] == "index"
+
+    response = client_builder("streamed").get("/")
+    assert response.content.decode("utf-8") == "<!DOCTYPE html>\n<p>hi</p>"
+
+
+def test_generate_page_stream_uses_cache_and_edits(client_builder, monkeypatch):
+    calls = []
+
+    def fake_generate_content_stream(messages):
+        calls.append(messages)
+        yield "<p>red</p>"
+
+    patch = "<<<<<<< SEARCH\n<p>red</p>\n=======\n<p>blue</p>\n>>>>>>> REPLACE"
+    monkeypatch.setattr(api, "generate_content_stream", fake_generate_content_stream)
+    monkeypatch.setattr(
+        api, "generate_edit", lambda messages: {"patch": patch, "output_tokens": 20}
+    )
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "streamed"})
+    url = "/v0/projects/streamed/pages/{}/generate/stream"
+
+    for page in ("index", "copy"):
+        response = api_client.post(url.format(page), json={"prompt": "hi", "mode": "full"})
+        events = parse_events(response.content.decode())
+        assert [data for event, data in events if event == "chunk"] == ["<p>red</p>"]
+        assert events[0][0] == "job"
+    # the second page came from the cache the first one filled
+    assert len(calls) == 1
+
+    response = api_client.post(url.format("index"), json={"prompt": "blue", "mode": "edit"})
+    events = parse_events(response.content.decode())
+    assert [data for event, data in events if event == "chunk"] == ["<p>blue</p>"]
+    assert events[-1][0] == "done"
+    assert len(calls) == 1
+    assert client_builder("streamed").get("/").text == "<p>blue</p>"
+
+
+def test_generate_page_stream_error_is_not_saved(client_builder, monkeypatch):
+    def broken_stream(messages):
+        yield "<!DOCTYPE html>"
+        raise RuntimeError("overloaded")
+
+    monkeypatch.setattr(api, "generate_content_stream", broken_stream)
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "streamed"})
+
+    response = api_client.post(
+        "/v0/projects/streamed/pages/index/generate/stream", json={"prompt": "hi"}
+    )
+    assert parse_events(response.content.decode())[-1] == ("error", {"error": "overloaded"})
+    assert api_client.get("/v0/projects/streamed").json()["pages"] == []
+
+
+def test_expected_version_conflict(client_builder):
+    api_client = client_builder()
+
+    created = api_client.post("/v0/projects", json={"name": "cas"}).json()
+    page = {"name": "index", "content": "one"}
+    url = "/v0/projects/cas/pages"
+
+    response = api_client.post(url, json=page, params={"expected_version": created["version"]})
+    assert response.status_code == 201
+    updated = response.json()
+
+    response = api_client.post(url, json=page, params={"expected_version": created["version"]})
+    assert response.status_code == 409
+
+    response = api_client.delete(
+        "/v0/projects/cas/pages/index", params={"expected_version": created["version"]}
+    )
+    assert response.status_code == 409
+    response = api_client.delete(
+        "/v0/projects/cas/pages/index", params={"expected_version": updated["version"]}
+    )
+    assert response.status_code == 200
+
+
+def test_list_projects_pagination(client_builder):
+    api_client = client_builder()
+
+    for name in ["c", "a", "b"]:
+        api_client.post("/v0/projects", json={"name": name})
+    api_client.post("/v0/projects/b/pages", json={"name": "index", "content": "hi"})
+
+    response = api_client.get("/v0/projects", params={"limit": 2})
+    assert response.headers["X-Total-Count"] == "3"
+    assert [p["name"] for p in response.json()] == ["a", "b"]
+    assert response.json()[1]["page_count"] == 1
+    assert response.json()[1]["versions"] is None
+
+    response = api_client.get("/v0/projects", params={"offset": 1, "versions": True})
+    projects = response.json()
+    assert [p["name"] for p in projects] == ["b", "c"]
+    assert len(projects[0]["versions"]) == 2
+    assert projects[0]["versions"][0] == projects[0]["version"]
+
+
+def test_large_page_ranges(client_builder):
+    api_client = client_builder()
+
+    content = "".join(f"<p>row {i}</p>\n" for i in range(40000))
+    assert len(content) > api.LARGE_BLOB_SIZE
+    response = api_client.post(
+        "/v0/projects", json={"name": "large", "pages": [{"name": "index", "content": content}]}
+    )
+    content_hash = response.json()["pages"][0]["content_hash"]
+
+    content_client = client_builder("large")
+    response = content_client.get("/", headers={"Accept-Encoding": "identity"})
+    assert response.content.decode() == content
+    assert response.headers["accept-ranges"] == "bytes"
+    # served from the file, not read into the blob cache
+    assert content_hash not in client_builder.store.blob_cache._data
+
+    response = content_client.get(
+        "/", headers={"Accept-Encoding": "identity", "Range": "bytes=10-19"}
+    )
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 10-19/{len(content)}"
+    assert response.content.decode() == content[10:20]
+
+    response = api_client.get(
+        f"/v0/projects/large/raw/{content_hash}", headers={"Range": "bytes=-5"}
+    )
+    assert response.status_code == 206
+    assert response.content.decode() == content[-5:]
+
+    response = api_client.get(
+        f"/v0/projects/large/raw/{content_hash}", headers={"Range": f"bytes={len(content)}-"}
+    )
+    assert response.status_code == 416
+
+    response = content_client.get(
+        "/", headers={"Accept-Encoding": "identity", "Range": "bytes=0-9", "If-Range": '"old"'}
+    )
+    assert response.status_code == 200
+
+
+def test_static_uploads(client_builder):
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "viz"})
+    uploads = client_builder.path / "uploads" / "viz"
+    uploads.mkdir(parents=True)
+    (uploads / "points.json").write_text('{"points": [1, 2, 3]}')
+    (client_builder.path / "secret.json").write_text("{}")
+
+    content_client = client_builder("viz")
+    response = content_client.get("/static/points.json")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {"points": [1, 2, 3]}
+
+    response = content_client.get(
+        "/static/points.json", headers={"If-None-Match": response.headers["etag"]}
+    )
+    assert response.status_code == 304
+
+    response = content_client.get("/static/points.json", headers={"Range": "bytes=0-0"})
+    assert response.content == b"{"
+
+    assert content_client.get("/static/missing.json").status_code == 404
+    assert content_client.get("/static/..%2F..%2Fsecret.json").status_code == 404
+
+
+def test_asset_upload(client_builder):
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "assets"})
+    api_client.post("/v0/projects", json={"name": "copy"})
+    data = b'{"points": [' + b", ".join(b"[1, 2]" for _ in range(50000)) + b"]}"
+
+    def body():
+        for i in range(0, len(data), 65536):
+            yield data[i : i + 65536]
+
+    response = api_client.put("/v0/projects/assets/assets/data/points.json", content=body())
+    assert response.status_code == 201
+    project = response.json()
+    [asset] = project["assets"]
+    assert asset["path"] == "data/points.json"
+    assert asset["size"] == len(data)
+    assert asset["media_type"] == "application/json"
+
+    response = api_client.put("/v0/projects/copy/assets/points.json", content=data)
+    assert response.json()["assets"][0]["content_hash"] == asset["content_hash"]
+    content = client_builder.path / "content"
+    assert len([p for p in content.iterdir() if p.name == asset["content_hash"]]) == 1
+
+    # editing a page keeps the assets without storing them again
+    response = api_client.post(
+        "/v0/projects/assets/pages", json={"name": "index", "content": "<p>hi</p>"}
+    )
+    assert response.json()["assets"] == [asset]
+
+    content_client = client_builder("assets")
+    response = content_client.get("/static/data/points.json")
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["etag"] == f'"{asset["content_hash"]}"'
+
+    pinned = client_builder(f"assets_{project['version']}")
+    assert "immutable" in pinned.get("/static/data/points.json").headers["cache-control"]
+
+    assert api_client.get("/v0/projects/assets/assets").json() == [asset]
+    response = api_client.delete("/v0/projects/assets/assets/data/points.json")
+    assert response.json()["assets"] == []
+    assert content_client.get("/static/data/points.json").status_code == 404
+    assert pinned.get("/static/data/points.json").status_code == 200
+
+
+def test_asset_upload_errors(client_builder):
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "assets"})
+
+    assert api_client.put("/v0/projects/missing/assets/a.json", content=b"{}").status_code == 404
+    assert api_client.put("/v0/projects/assets/assets/.hidden", content=b"{}").status_code == 422
+    response = api_client.put(
+        "/v0/projects/assets/assets/a.json", content=b"{}", params={"expected_version": "old"}
+    )
+    assert response.status_code == 409
+    assert list((client_builder.path / "tmp").iterdir()) == []
+
+
+def test_delete_missing_asset_404s(client_builder):
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "assets"})
+
+    assert api_client.delete("/v0/projects/nope/assets/a.txt").status_code == 404
+    assert api_client.delete("/v0/projects/assets/assets/a.txt").status_code == 404
+    assert len(api_client.get("/v0/projects/assets/versions").json()) == 1
+
+
+def test_generate_variations(client_builder, monkeypatch):
+    # every call waits for a second one, so each batch has to overlap two
+    # calls; running tracks how many are in flight at once
+    overlap = threading.Barrier(2, timeout=5)
+    lock = threading.Lock()
+    running = []
+    most = []
+
+    def overlapping_generate_content(messages):
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        try:
+            overlap.wait()
+        finally:
+            with lock:
+                running.pop()
+        if messages[-1].startswith("broken"):
+            return "<title>error</title><p>nope</p>"
+        return f"<p>{messages[-1]}</p>"
+
+    monkeypatch.setattr(api, "generate_content", overlapping_generate_content)
+    api_client = client_builder()
+    api_client.post("/v0/projects", json={"name": "variations"})
+
+    response = api_client.post(
+        "/v0/projects/variations/pages/index/variations",
+        json={"prompt": "a clock", "prefixes": ["minimal", "neon", "pastel", "broken"]},
+    )
+    assert response.status_code == 200
+    events = parse_events(response.text)
+    done = events[-1][1]
+    assert done["variations"] == 4
+    # the job queue lets two jobs per project run at once
+    assert max(most) == 2
+    saved = {e["page"]: e for name, e in events if name == "variation"}
+    assert sorted(saved) == ["index-v1", "index-v2", "index-v3"]
+    [error] = [e for name, e in events if name == "error"]
+    assert error["page"] == "index-v4"
+
+    project = api_client.get("/v0/projects/variations").json()
+    assert sorted(p["name"] for p in project["pages"]) == ["index-v1", "index-v2", "index-v3"]
+    raw = api_client.get(f"/v0/projects/variations/raw/{project['pages'][0]['content_hash']}")
+    assert "a clock" in raw.text
+
+    most.clear()
+
+    def counting_generate_content(messages):
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.pop()
+        return "<p>one</p>"
+
+    monkeypatch.setattr(api, "generate_content", counting_generate_content)
+    response = api_client.post(
+        "/v0/projects/variations/pages/index/variations",
+        json={"prompt": "a clock", "count": 3, "concurrency": 1},
+    )
+    events = parse_events(response.text)
+    assert events[-1][1]["variations"] == 3
+    assert max(most) == 1
+
+    response = api_client.post(
+        "/v0/projects/variations/pages/index/variations", json={"prompt": "x", "count": 100}
+    )
+    assert response.status_code == 422
+
+
+def test_export_import_between_instances(client_builder):
+    api_client = client_builder()
+    api_client.post(
+        "/v0/projects",
+        json={"name": "moving", "pages": [{"name": "index", "content": "<p>one</p>"}]},
+    )
+    api_client.post("/v0/projects/moving/pages", json={"name": "index", "content": "<p>two</p>"})
+    api_client.put("/v0/projects/moving/assets/data.json", content=b'{"a": 1}')
+    versions = api_client.get("/v0/projects/moving/versions").json()
+
+    response = api_client.get("/v0/projects/moving/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-tar"
+    archive = response.content
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        other = TestClient(
+            create_app(ProjectStore(Path(temp_dir))), base_url="http://api.test"
+        )
+        report = other.post("/v0/import", content=archive).json()
+        assert report["projects"] == ["moving"]
+        assert report["versions"] == 3
+        assert report["blobs_written"] == 3
+        assert other.get("/v0/projects/moving/versions").json() == versions
+        assert other.get("/v0/projects/moving").json() == api_client.get(
+            "/v0/projects/moving"
+        ).json()
+        page = TestClient(other.app, base_url="http://moving.test").get("/")
+        assert page.text == "<p>two</p>"
+
+        report = other.post("/v0/import", content=archive).json()
+        assert report["existing"] == ["moving"]
+        assert report["blobs_skipped"] == 3
+        assert report["blobs_written"] == 0
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_directory_imports_as_one_version(client_builder, tmp_path):
+    source = tmp_path / "from-disk"
+    source.mkdir()
+    (source / "index.html").write_text("<p>home</p>")
+    (source / "about.html").write_text("<p>about</p>")
+    (source / "data.json").write_bytes(b'{"a": 1}')
+
+    api_client = client_builder()
+    archive = b"".join(directory_archive("from-disk", source))
+    report = api_client.post("/v0/import", content=archive).json()
+    assert report["projects"] == ["from-disk"] and report["versions"] == 1
+    assert len(api_client.get("/v0/projects/from-disk/versions").json()) == 1
+    project = api_client.get("/v0/projects/from-disk").json()
+    assert [p["name"] for p in project["pages"]] == ["about", "index"]
+    assert project["assets"][0]["media_type"] == "application/json"
+    site = client_builder("from-disk")
+    assert site.get("/").text == "<p>home</p>"
+    assert site.get("/static/data.json").json() == {"a": 1}
+
+
+def test_import_rejects_bad_archives(client_builder):
+    api_client = client_builder()
+    api_client.post(
+        "/v0/projects", json={"name": "src", "pages": [{"name": "index", "content": "<p>hi</p>"}]}
+    )
+    archive = api_client.get("/v0/export").content
+    assert api_client.get("/v0/export", params={"project": "missing"}).status_code == 404
+
+    store = client_builder.store
+    content_hash = store.load_page("src", "index").content_hash
+    tampered = archive.replace(b"<p>hi</p>", b"<p>yo</p>")
+    (client_builder.path / "content" / content_hash).unlink()
+
+    response = api_client.post("/v0/import", content=tampered)
+    assert response.status_code == 400
+    assert "doesn't match" in response.json()["detail"]
+    assert api_client.post("/v0/import", content=b"not a tar").status_code == 400
+
+
+def test_import_fails_when_client_disconnects(client_builder, monkeypatch):
+    api_client = client_builder()
+    api_client.post(
+        "/v0/projects", json={"name": "src", "pages": [{"name": "index", "content": "<p>hi</p>"}]}
+    )
+    archive = api_client.get("/v0/export").content
+
+    outcome = []
+    finished = threading.Event()
+    real_import_archive = api.import_archive
+
+    def recording_import_archive(store, f):
+        try:
+            return real_import_archive(store, f)
+        except Exception as e:
+            outcome.append(e)
+            raise
+        finally:
+            finished.set()
+
+    monkeypatch.setattr(api, "import_archive", recording_import_archive)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        other = create_app(ProjectStore(Path(temp_dir)))
+        messages = [
+            {"type": "http.request", "body": archive[: len(archive) // 2], "more_body": True},
+            {"type": "http.disconnect"},
+        ]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            pass
+
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/v0/import",
+            "raw_path": b"/v0/import",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"api.test")],
+            "client": ("127.0.0.1", 1234),
+            "server": ("api.test", 80),
+        }
+        # the loop has to outlive the request, as a server's would, for
+        # the import to get as far as failing
+        async def disconnect():
+            with pytest.raises(Exception):
+                await other(scope, receive, send)
+            return await asyncio.to_thread(finished.wait, 5)
+
+        assert asyncio.run(disconnect())
+        assert "ended before the archive" in str(outcome[0])
+        assert not ProjectStore(Path(temp_dir)).exists("src")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_host_router_fast_path_and_lifespan(client_builder):
+    api_client = client_builder()
+    project_data = {"name": "fast", "pages": [{"name": "about", "content": "<p>about</p>"}]}
+    assert api_client.post("/v0/projects", json=project_data).status_code == 201
+
+    started = []
+    app = api_client.app
+    app.api.router.on_startup.append(lambda: started.append(True))
+    with TestClient(app, base_url="http://fast.test") as content_client:
+        assert started == [True]
+
+        response = content_client.get("/about")
+        assert response.status_code == 200
+        assert response.text == "<p>about</p>"
+        response = content_client.head("/about")
+        assert response.status_code == 200
+        assert response.content == b""
+        assert response.headers["content-length"] == str(len("<p>about</p>"))
+
+        assert content_client.get("/").status_code == 404
+        assert content_client.get("/missing").json() == {"detail": "Page not found"}
+        assert content_client.get("/static/missing.json").status_code == 404
+
+    missing = TestClient(app, base_url="http://nothing.test").get("/")
+    assert missing.status_code == 404
+    assert api.parse_subdomain("fast_v1") == ("fast", "v1")
+    assert api.parse_subdomain("fast") == ("fast", None)
+
+
+def test_metrics(client_builder):
+    api_client = client_builder()
+    project_data = {"name": "measured", "pages": [{"name": "index", "content": "<p>hi</p>"}]}
+    assert api_client.post("/v0/projects", json=project_data).status_code == 201
+
+    before = api.REQUEST_SECONDS.count("content", "page_response")
+    content_client = client_builder("measured")
+    for _ in range(3):
+        assert content_client.get("/").status_code == 200
+    assert api.REQUEST_SECONDS.count("content", "page_response") == before + 3
+
+    response = api_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert "# TYPE codette_request_seconds histogram" in lines
+    assert any(
+        line.startswith('codette_request_seconds_bucket{app="api",route="create_project",le=')
+        for line in lines
+    )
+    assert 'codette_request_seconds_count{app="content",route="page_response"} ' in response.text
+    assert 'codette_requests_in_flight{app="api"} 1' in lines
+    hits = client_builder.store.project_cache.hits
+    assert f'codette_cache_requests_total{{cache="project",result="hit"}} {hits}' in lines
+    assert any(line.startswith('codette_load_project_seconds_sum{cache="hit"}') for line in lines)
+
+
+def test_admin_profile_and_slow_requests():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        store = ProjectStore(Path(temp_dir))
+        store.create_project("profiled", [{"name": "index", "title": "", "content": "<p>hi</p>"}])
+        app = create_app(store, admin_token="secret")
+        admin = TestClient(app, base_url="http://api.test")
+        auth = {"Authorization": "Bearer secret"}
+
+        assert admin.get("/v0/admin/profile").status_code == 401
+        assert TestClient(create_app(store), base_url="http://api.test").get(
+            "/v0/admin/profile", headers=auth
+        ).status_code == 404
+
+        stop = threading.Event()
+
+        def busy():
+            while not stop.is_set():
+                store.project_cache.clear()
+                store.load_project("profiled")
+
+        thread = threading.Thread(target=busy)
+        thread.start()
+        try:
+            response = admin.get("/v0/admin/profile?seconds=0.3", headers=auth)
+        finally:
+            stop.set()
+            thread.join()
+        assert response.status_code == 200
+        lines = response.text.splitlines()
+        assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+        assert any("store:ProjectStore.load_project" in line for line in lines)
+
+        assert admin.get("/v0/admin/slow-requests", headers=auth).json() == {
+            "threshold": None,
+            "requests": [],
+        }
+        response = admin.put("/v0/admin/slow-requests?threshold=0.000001", headers=auth)
+        assert response.json()["threshold"] == 0.000001
+        store.project_cache.clear()
+        assert TestClient(app, base_url="http://profiled.test").get("/").status_code == 200
+
+        slow = admin.get("/v0/admin/slow-requests", headers=auth).json()["requests"]
+        page = next(r for r in slow if r["route"] == "page_response")
+        assert page["app"] == "content" and page["path"] == "/"
+        assert page["spans"]["codette_load_project_seconds{miss}"] > 0
+        assert "codette_load_blob_seconds" in page["spans"]
+
+        # turning tracing off happens during a traced request
+        response = admin.put("/v0/admin/slow-requests", headers=auth)
+        assert response.status_code == 200
+        assert response.json()["threshold"] is None
+        assert admin.get("/v0/admin/slow-requests", headers=auth).json()["threshold"] is None
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def test_shared_slow_traces_are_written_off_the_request_path(tmp_path):
+    traces = SharedSlowTraces(tmp_path / "metrics.db", 0.5)
+    traces.record({"method": "GET", "path": "/"}, "content", "page_response", 1.0, [])
+    # queued, not yet in sqlite where other workers would see it
+    other = SharedSlowTraces(tmp_path / "metrics.db")
+    assert other.threshold == 0.5 and other.list() == []
+    assert [t["path"] for t in traces.list()] == ["/"]
+    assert [t["path"] for t in other.list()] == ["/"]
+
+
+def run_worker(path, port):
+    api.generate_content = lambda messages: f"<p>{messages[-1]}</p>"
+    metrics.FLUSH_SECONDS = 0.1
+    profiling.THRESHOLD_CHECK_SECONDS = 0.1
+    store = ProjectStore(Path(path))
+    jobs = JobQueue(registry=JobRegistry(Path(path) / "jobs.db"))
+    app = create_app(store, jobs, admin_token="secret", metrics_path=Path(path) / "metrics.db")
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="error")
+
+
+def metric_value(text: str, sample: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0
+
+
+def test_worker_processes_share_store_and_jobs():
+    temp_dir = tempfile.mkdtemp()
+    ports = []
+    for _ in range(2):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            ports.append(s.getsockname()[1])
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=run_worker, args=(temp_dir, port)) for port in ports]
+    for worker in workers:
+        worker.start()
+    try:
+        urls = [f"http://127.0.0.1:{port}" for port in ports]
+        api_headers = {"Host": "api.test"}
+        for url in urls:
+            for _ in range(300):
+                try:
+                    requests.get(f"{url}/v0/projects", headers=api_headers)
+                    break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+        first, second = urls
+
+        response = requests.post(
+            f"{first}/v0/projects", json={"name": "shared", "pages": []}, headers=api_headers
+        )
+        assert response.status_code == 201
+
+        def add_page(i):
+            response = requests.post(
+                f"{urls[i % 2]}/v0/projects/shared/pages",
+                json={"name": f"page-{i}", "content": f"<p>{i}</p>"},
+                headers=api_headers,
+            )
+            assert response.status_code == 201
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(add_page, range(20)))
+        projects = [
+            requests.get(f"{url}/v0/projects/shared", headers=api_headers).json() for url in urls
+        ]
+        assert projects[0] == projects[1]
+        assert len(projects[0]["pages"]) == 20
+
+        # a page written through one worker is served straight away by the other
+        for i, url in enumerate(urls):
+            requests.post(
+                f"{url}/v0/projects/shared/pages",
+                json={"name": "index", "content": f"<p>from {i}</p>"},
+                headers=api_headers,
+            )
+            other = urls[1 - i]
+            assert requests.get(other, headers={"Host": "shared.test"}).text == f"<p>from {i}</p>"
+
+        response = requests.post(
+            f"{first}/v0/projects/shared/pages/generated/generate",
+            json={"prompt": "hello", "mode": "full"},
+            headers=api_headers,
+        )
+        assert response.status_code == 202
+        job_id = response.json()["id"]
+        for _ in range(100):
+            job = requests.get(f"{second}/v0/jobs/{job_id}", headers=api_headers).json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.05)
+        assert job["status"] == "done"
+        assert job["worker"] == workers[0].pid
+        page = requests.get(f"{second}/generated", headers={"Host": "shared.test"})
+        assert page.text == "<p>hello</p>"
+
+        # either worker reports metrics and slow requests for both
+        sample = 'codette_request_seconds_count{app="api",route="create_or_update_page"}'
+        for _ in range(100):
+            counts = [
+                metric_value(requests.get(f"{url}/metrics", headers=api_headers).text, sample)
+                for url in urls
+            ]
+            if counts == [22, 22]:
+                break
+            time.sleep(0.05)
+        assert counts == [22, 22]
+
+        admin_headers = {**api_headers, "Authorization": "Bearer secret"}
+        response = requests.put(
+            f"{first}/v0/admin/slow-requests?threshold=0.000001", headers=admin_headers
+        )
+        assert response.json()["threshold"] == 0.000001
+        # the other worker picks the threshold up within THRESHOLD_CHECK_SECONDS
+        for _ in range(100):
+            requests.get(second, headers={"Host": "shared.test"})
+            response = requests.get(f"{first}/v0/admin/slow-requests", headers=admin_headers)
+            traced = {r["worker"] for r in response.json()["requests"]}
+            if workers[1].pid in traced:
+                break
+            time.sleep(0.05)
+        assert response.json()["threshold"] == 0.000001
+        assert workers[1].pid in traced
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        shutil.rmtree(temp_dir)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-s"])
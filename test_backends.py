@@ -0,0 +1,140 @@
+import pytest
+import io
+import tempfile
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+from backends import Backend, FilesystemBackend, SQLiteBackend, S3Backend
+from store import ProjectStore
+
+
+class NoSuchKey(Exception):
+    def __init__(self):
+        self.response = {"Error": {"Code": "NoSuchKey"}}
+
+
+# just enough of the boto3 s3 client for S3Backend, kept in memory
+class FakeS3:
+    def __init__(self, page_size=2):
+        self.buckets = {}
+        self.page_size = page_size
+
+    def _bucket(self, bucket):
+        return self.buckets.setdefault(bucket, {})
+
+    def get_object(self, Bucket, Key):
+        if Key not in self._bucket(Bucket):
+            raise NoSuchKey()
+        return {"Body": io.BytesIO(self._bucket(Bucket)[Key][0])}
+
+    def put_object(self, Bucket, Key, Body):
+        self._bucket(Bucket)[Key] = (bytes(Body), datetime.now(timezone.utc))
+
+    def upload_file(self, Filename, Bucket, Key):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Path(Filename).read_bytes())
+
+    def delete_object(self, Bucket, Key):
+        self._bucket(Bucket).pop(Key, None)
+
+    def head_object(self, Bucket, Key):
+        if Key not in self._bucket(Bucket):
+            raise NoSuchKey()
+        data, modified = self._bucket(Bucket)[Key]
+        return {"ContentLength": len(data), "LastModified": modified}
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        keys = sorted(k for k in self._bucket(Bucket) if k.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start : start + self.page_size]
+        response = {"Contents": [{"Key": k} for k in page]}
+        if start + self.page_size < len(keys):
+            response["IsTruncated"] = True
+            response["NextContinuationToken"] = str(start + self.page_size)
+        return response
+
+
+@pytest.fixture
+def store_path():
+    temp_dir = tempfile.mkdtemp()
+    yield Path(temp_dir)
+    shutil.rmtree(temp_dir)
+
+
+@pytest.fixture(params=["files", "sqlite", "s3"])
+def backend(request, store_path):
+    if request.param == "files":
+        return FilesystemBackend(store_path / "objects")
+    if request.param == "sqlite":
+        return SQLiteBackend(store_path / "objects.db")
+    return S3Backend(FakeS3(), "codette", "prod")
+
+
+def test_backend_objects(backend, store_path):
+    with pytest.raises(FileNotFoundError):
+        backend.get("content/missing")
+    assert backend.stat("content/missing") is None
+
+    backend.put("content/a", b"one")
+    backend.append("manifests/p/000000.pack", b"1\n")
+    backend.append("manifests/p/000000.pack", b"2\n")
+    backend.put("manifests/q/000000.pack", b"")
+
+    assert backend.get("content/a") == b"one"
+    assert backend.get("manifests/p/000000.pack") == b"1\n2\n"
+    assert backend.stat("content/a").size == 3
+    assert sorted(backend.keys("manifests/")) == [
+        "manifests/p/000000.pack",
+        "manifests/q/000000.pack",
+    ]
+    assert list(backend.keys("content/")) == ["content/a"]
+
+    backend.delete("content/a")
+    assert not backend.exists("content/a")
+
+    upload = store_path / "upload"
+    upload.write_bytes(b"uploaded")
+    backend.put_file("content/b", upload)
+    assert backend.get("content/b") == b"uploaded"
+
+
+def test_incomplete_backend_fails_on_creation():
+    class NoKeys(Backend):
+        def get(self, key):
+            return b""
+
+    with pytest.raises(TypeError):
+        NoKeys()
+
+
+def test_store_on_backend(backend, store_path):
+    store = ProjectStore(store_path / "local", backend=backend, chunked_blobs=True)
+    store.create_project("remote", [{"name": "index", "title": "", "content": "a" * 5000}])
+    latest = store.create_or_update_page("remote", "about", "b")
+
+    page = store.load_page("remote", "index")
+    assert store.load_content("remote", page.content_hash) == "a" * 5000
+
+    # a fresh machine only has the backend, the local index is rebuilt
+    reopened = ProjectStore(store_path / "fresh", backend=backend)
+    assert reopened.load_project("remote").version == latest.version
+    page = reopened.load_page("remote", "about")
+    assert reopened.load_content("remote", page.content_hash) == "b"
+    assert reopened.repack("remote") == 2
+    assert reopened.load_project("remote").version == latest.version
+
+
+def test_stale_index_never_overwrites_other_writers(backend, store_path):
+    first = ProjectStore(store_path / "first", backend=backend)
+    first.create_project("shared", [{"name": "index", "title": "", "content": "a"}])
+    second = ProjectStore(store_path / "second", backend=backend)
+    mine = first.create_or_update_page("shared", "index", "b")
+
+    # the second machine's index still ends at the first version: it adopts
+    # the version it didn't know about and saves after it
+    theirs = second.create_or_update_page("shared", "index", "c")
+    assert second.list_project_versions("shared")[:2] == [theirs.version, mine.version]
+    page = second.load_page("shared", "index", version=mine.version)
+    assert second.load_content("shared", page.content_hash) == "b"
+
+    first.rebuild_index()
+    assert first.list_project_versions("shared")[0] == theirs.version
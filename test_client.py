@@ -0,0 +1,95 @@
+import pytest
+import asyncio
+import tempfile
+import shutil
+import threading
+import time
+from pathlib import Path
+import httpx
+import uvicorn
+from api import create_app
+from client import AsyncCodetteClient, CodetteClient
+from store import Page, Project, ProjectStore
+
+
+@pytest.fixture
+def server_url():
+    temp_dir = tempfile.mkdtemp()
+    app = create_app(ProjectStore(Path(temp_dir)))
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="error"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    yield f"http://127.0.0.1:{port}"
+    server.should_exit = True
+    thread.join()
+    shutil.rmtree(temp_dir)
+
+
+def test_client_bulk_operations(server_url):
+    with CodetteClient(server_url, host="api.test", pool_size=4) as client:
+        client.create_project(Project(name="bulk"))
+        pages = [Page(name=f"page-{i}", content=f"<p>{i}</p>") for i in range(10)]
+        projects = client.upload_pages("bulk", pages)
+        assert all(isinstance(p, Project) for p in projects)
+
+        project = client.get_project("bulk")
+        assert len(project.pages) == 10
+        assert len(client.list_project_versions("bulk")) == 11
+        hashes = {p.name: p.content_hash for p in project.pages}
+        contents = client.fetch_raw_pages("bulk", hashes.values())
+        assert contents[hashes["page-3"]] == b"<p>3</p>"
+
+        updated = client.create_or_update_page(
+            "bulk", Page(name="index", content="hi"), expected_version=project.version
+        )
+        assert updated.version != project.version
+        [summary] = client.list_projects()
+        assert summary.page_count == 11
+
+
+def test_async_client_bulk_operations(server_url):
+    async def run():
+        async with AsyncCodetteClient(server_url, host="api.test", pool_size=4) as client:
+            await client.create_project(Project(name="bulk"))
+            pages = [Page(name=f"page-{i}", content=f"<p>{i}</p>") for i in range(10)]
+            await client.upload_pages("bulk", pages)
+            project = await client.get_project("bulk")
+            hashes = [p.content_hash for p in project.pages]
+            contents = await client.fetch_raw_pages("bulk", hashes)
+            return project, contents
+
+    project, contents = asyncio.run(run())
+    assert len(project.pages) == 10
+    assert sorted(contents.values()) == sorted(f"<p>{i}</p>".encode() for i in range(10))
+
+
+def test_async_client_retries(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request.method)
+        if len(calls) < 3:
+            return httpx.Response(503)
+        return httpx.Response(200, json=["v1"])
+
+    async def run(method):
+        client = AsyncCodetteClient("http://api.test", backoff=0)
+        client.client = httpx.AsyncClient(
+            base_url="http://api.test", transport=httpx.MockTransport(handler)
+        )
+        async with client:
+            if method == "GET":
+                return await client.list_project_versions("retried")
+            return await client._request("POST", "/v0/projects")
+
+    assert asyncio.run(run("GET")) == ["v1"]
+    assert calls == ["GET"] * 3
+
+    # a POST that reached the server isn't sent twice
+    calls.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run("POST"))
+    assert calls == ["POST"]
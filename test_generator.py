@@ -0,0 +1,164 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import generator
+from llm_cache import LLMCache
+
+
+class StubChat:
+    calls = []
+    release = threading.Event()
+
+    def __init__(self, model, sp=""):
+        self.model = model
+        self.sp = sp
+        self.use = None
+
+    def __call__(self, messages, prefill=""):
+        StubChat.calls.append((self.sp, messages))
+        StubChat.release.wait(5)
+        prompt = messages[-1]["text"] if isinstance(messages[-1], dict) else messages[-1]
+        if prompt == "fail":
+            raise RuntimeError("overloaded")
+        # pretend the provider read every block marked for caching from its cache
+        cached = sum(len(m["text"]) for m in messages if "cache_control" in m)
+        total = sum(len(m["text"] if isinstance(m, dict) else m) for m in messages)
+        self.use = SimpleNamespace(
+            input_tokens=total - cached,
+            output_tokens=len(prompt),
+            cache_creation_input_tokens=0,
+            cache_read_input_tokens=cached,
+        )
+        text = prefill + f"<p>{prompt}</p><!-- {len(StubChat.calls)} -->"
+        return SimpleNamespace(content=[SimpleNamespace(text=text)])
+
+
+@pytest.fixture
+def stub_chat(monkeypatch, tmp_path):
+    monkeypatch.setattr(generator.llm_cache, "path", tmp_path / "cache.db")
+    monkeypatch.setattr(generator.llm_cache, "_local", threading.local())
+    monkeypatch.setattr(generator, "Chat", StubChat)
+    StubChat.calls = []
+    StubChat.release = threading.Event()
+    yield StubChat
+    StubChat.release.set()
+
+
+def test_identical_generations_are_coalesced(stub_chat):
+    before = generator.in_flight.coalesced
+    results = []
+
+    def call():
+        results.append(generator.generate_content(["make a page"]))
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    stub_chat.release.set()
+    for t in threads:
+        t.join()
+
+    assert len(stub_chat.calls) == 1
+    assert generator.in_flight.coalesced - before == 2
+    assert len(set(results)) == 1
+    assert "<p>make a page</p>" in results[0]
+
+
+def test_different_generations_are_not_coalesced(stub_chat):
+    stub_chat.release.set()
+    threads = [
+        threading.Thread(target=generator.generate_content, args=([prompt],))
+        for prompt in ("one", "two")
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(m[-1] for sp, m in stub_chat.calls) == ["one", "two"]
+
+
+def test_generate_content_cache(stub_chat):
+    stub_chat.release.set()
+
+    first = generator.generate_content(["cached"])
+    assert generator.generate_content(["cached"]) == first
+    assert len(stub_chat.calls) == 1
+
+    refreshed = generator.generate_content(["cached"], force_refresh=True)
+    assert refreshed != first
+    assert generator.generate_content(["cached"]) == refreshed
+    assert len(stub_chat.calls) == 2
+
+
+def test_errors_are_not_cached(stub_chat):
+    stub_chat.release.set()
+
+    assert generator.is_error(generator.generate_content(["fail"]))
+    generator.generate_content(["fail"])
+    assert len(stub_chat.calls) == 2
+    assert generator.llm_cache.stats()["entries"] == 0
+
+
+def test_llm_cache_evicts_least_recently_used(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", max_bytes=30)
+    cache.put("a", "x" * 10)
+    cache.put("b", "y" * 10)
+    time.sleep(0.01)
+    assert cache.get("a") == "x" * 10
+    cache.put("c", "z" * 10)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 10
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+
+
+def test_llm_cache_expires_old_entries(tmp_path):
+    cache = LLMCache(tmp_path / "cache.db", max_age=60)
+    cache.put("old", "value")
+    cache._conn().execute("UPDATE entries SET created = created - 120")
+    cache._conn().commit()
+
+    assert cache.get("old") is None
+    cache.put("new", "value")
+    assert cache.prune(max_age=60) == 0
+    assert cache.stats()["entries"] == 1
+
+
+def test_stable_context_is_marked_for_prompt_caching(stub_chat):
+    stub_chat.release.set()
+    calls = generator.usage_log.calls
+
+    generator.generate_content(
+        ["docs?", generator.cacheable("the docs"), "page?", generator.cacheable("<p>page</p>"), "edit"]
+    )
+
+    sp, blocks = stub_chat.calls[-1]
+    assert sp[0]["cache_control"] == {"type": "ephemeral"}
+    assert [b.get("cache_control") is not None for b in blocks] == [
+        False,
+        True,
+        False,
+        True,
+        False,
+    ]
+    assert [b["text"] for b in blocks][-1] == "edit"
+
+    assert generator.usage_log.calls == calls + 1
+    entry = generator.usage_log.recent[-1]
+    assert entry["cache_read_input_tokens"] == len("the docs") + len("<p>page</p>")
+    assert entry["output_tokens"] == len("edit")
+    assert entry["latency"] >= 0
+
+
+def test_plain_messages_are_sent_unchanged(stub_chat):
+    stub_chat.release.set()
+    generator.generate_content(["just a prompt"])
+
+    sp, messages = stub_chat.calls[-1]
+    assert messages == ["just a prompt"]
+    assert isinstance(sp, str)
@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from jobs import Job, JobQueue, JobRegistry
+
+
+def wait(jobs, job_ids):
+    for _ in range(200):
+        if all(jobs.get(i).finished for i in job_ids):
+            return
+        time.sleep(0.01)
+    raise TimeoutError(job_ids)
+
+
+def test_per_project_limit():
+    jobs = JobQueue(max_workers=4, max_per_project=1)
+    release = threading.Event()
+    running = []
+
+    def work(name):
+        def fn():
+            running.append(name)
+            release.wait(5)
+            return name
+
+        return fn
+
+    first = jobs.submit("busy", "a", work("a"))
+    second = jobs.submit("busy", "b", work("b"))
+    other = jobs.submit("other", "c", work("c"))
+
+    time.sleep(0.1)
+    assert sorted(running) == ["a", "c"]
+    assert jobs.get(second.id).status == "queued"
+
+    release.set()
+    wait(jobs, [first.id, second.id, other.id])
+    assert [jobs.get(i).result for i in (first.id, second.id, other.id)] == ["a", "b", "c"]
+    jobs.shutdown()
+
+
+def test_failed_job_reports_error():
+    jobs = JobQueue()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    job = jobs.submit("broken", "index", fail)
+    wait(jobs, [job.id])
+    assert jobs.get(job.id).status == "error"
+    assert jobs.get(job.id).error == "boom"
+    jobs.shutdown()
+
+
+def test_registry_shares_jobs_between_queues():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        registry = JobRegistry(Path(temp_dir) / "jobs.db")
+        first = JobQueue(registry=registry)
+        second = JobQueue(registry=JobRegistry(Path(temp_dir) / "jobs.db"))
+        release = threading.Event()
+
+        job = first.submit("shared", "index", lambda: release.wait(5) and {"saved": True})
+        for _ in range(200):
+            if second.get(job.id).status == "running":
+                break
+            time.sleep(0.01)
+        assert second.get(job.id).status == "running"
+        release.set()
+        wait(second, [job.id])
+        assert second.get(job.id).status == "done"
+        assert second.get(job.id).result == {"saved": True}
+        assert second.get("missing") is None
+
+        # a job left running by a worker that has gone away
+        orphan = Job(project="shared", page="index", status="running", worker=2**22 + 1)
+        registry.put(orphan)
+        assert second.get(orphan.id).status == "error"
+        first.shutdown()
+        second.shutdown()
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,24 @@
+import pytest
+from patch import PatchError, apply_search_replace
+
+
+def block(search, replace):
+    return f"<<<<<<< SEARCH\n{search}\n=======\n{replace}\n>>>>>>> REPLACE\n"
+
+
+def test_apply_search_replace():
+    content = "<h1>Title</h1>\n<p>one</p>\n<p>two</p>\n"
+    patch = block("<p>one</p>", "<p>uno</p>") + block("<p>two</p>", "")
+
+    assert apply_search_replace(content, patch) == "<h1>Title</h1>\n<p>uno</p>\n\n"
+
+
+def test_apply_search_replace_rejects_bad_patches():
+    content = "<p>same</p>\n<p>same</p>\n"
+
+    with pytest.raises(PatchError, match="no SEARCH/REPLACE"):
+        apply_search_replace(content, "here is the whole page instead")
+    with pytest.raises(PatchError, match="not found"):
+        apply_search_replace(content, block("<p>other</p>", "<p>x</p>"))
+    with pytest.raises(PatchError, match="matches 2 times"):
+        apply_search_replace(content, block("<p>same</p>", "<p>x</p>"))
@@ -0,0 +1,311 @@
+import pytest
+import tempfile
+import shutil
+import gzip
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from store import Page, Project, ProjectStore, VersionConflict
+
+
+@pytest.fixture
+def store_path():
+    temp_dir = tempfile.mkdtemp()
+    yield Path(temp_dir)
+    shutil.rmtree(temp_dir)
+
+
+def test_latest_version_follows_index(store_path):
+    store = ProjectStore(store_path)
+    project = store.create_project("indexed", [])
+    first = store.create_or_update_page("indexed", "index", "one")
+    second = store.create_or_update_page("indexed", "index", "two")
+
+    assert store.load_project("indexed").version == second.version
+    assert store.list_project_versions("indexed") == [
+        second.version,
+        first.version,
+        project.version,
+    ]
+    assert store.exists("indexed")
+    assert not store.exists("missing")
+
+
+def test_rebuild_index_from_disk(store_path):
+    store = ProjectStore(store_path)
+    store.create_project("rebuilt", [{"name": "index", "title": "", "content": "a"}])
+    latest = store.create_or_update_page("rebuilt", "index", "b")
+
+    for p in store_path.glob("index.db*"):
+        p.unlink()
+
+    reopened = ProjectStore(store_path)
+    assert reopened.exists("rebuilt")
+    assert reopened.load_project("rebuilt").version == latest.version
+    assert len(reopened.list_project_versions("rebuilt")) == 2
+    [summary] = reopened.list_projects()
+    assert (summary.name, summary.version, summary.page_count) == ("rebuilt", latest.version, 1)
+
+
+def test_rebuild_and_repack_keep_each_versions_time(store_path):
+    store = ProjectStore(store_path)
+    for i, updated in enumerate([100.0, 200.0, 300.0]):
+        project = Project(name="timed", pages=[Page(name="index", content_hash=f"{i}" * 64)])
+        store.save_project(project, updated=updated)
+
+    store.rebuild_index()
+    assert [l.updated for l in store.index.locations("timed")] == [100.0, 200.0, 300.0]
+    store.repack("timed")
+    store.rebuild_index()
+    assert [l.updated for l in store.index.locations("timed")] == [100.0, 200.0, 300.0]
+
+
+def test_write_after_a_crash_adopts_the_orphaned_record(store_path, monkeypatch):
+    store = ProjectStore(store_path)
+    store.create_project("crashed", [{"name": "index", "title": "", "content": "a"}])
+
+    # the worker dies after appending its record but before indexing it
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(store.index, "add", crash)
+        with pytest.raises(KeyboardInterrupt):
+            store.create_or_update_page("crashed", "index", "b")
+    assert len(store.list_project_versions("crashed")) == 1
+
+    first = store.list_project_versions("crashed")[0]
+    with pytest.raises(VersionConflict):
+        store.create_or_update_page("crashed", "about", "c", expected_version=first)
+
+    latest = store.create_or_update_page("crashed", "about", "c")
+    versions = store.list_project_versions("crashed")
+    assert len(versions) == 3 and versions[0] == latest.version
+    pages = {p.name: p for p in store.load_project("crashed").pages}
+    assert sorted(pages) == ["about", "index"]
+    # the edit from the crashed write is kept, not overwritten
+    assert store.load_content("crashed", pages["index"].content_hash) == "b"
+
+
+def test_project_cache(store_path):
+    store = ProjectStore(store_path, project_cache_size=2)
+    project = store.create_project("cached", [])
+
+    store.load_project("cached")
+    store.load_project("cached", project.version)
+    assert store.project_cache.hits == 1
+    assert store.project_cache.misses == 1
+
+    updated = store.create_or_update_page("cached", "index", "hi")
+    assert store.load_project("cached").version == updated.version
+    store.load_project("cached", project.version)
+    assert store.project_cache.evictions == 0
+
+    store.delete_page("cached", "index")
+    store.load_project("cached")
+    assert store.project_cache.evictions == 1
+    assert len(store.project_cache) == 2
+
+
+def test_blob_cache_is_memory_bounded(store_path):
+    store = ProjectStore(store_path, blob_cache_bytes=10)
+    small = store._store_content("12345")
+    other = store._store_content("67890")
+    large = store._store_content("x" * 100)
+
+    assert store.load_content("blobs", small) == "12345"
+    assert store.load_content("blobs", large) == "x" * 100
+    assert store.load_content("blobs", other) == "67890"
+    assert store.load_content("blobs", small) == "12345"
+    assert store.blob_cache.hits == 1
+    assert store.blob_cache.bytes == 10
+    assert large not in store.blob_cache._data
+
+    with pytest.raises(FileNotFoundError):
+        store.load_blob("../index.db")
+
+
+def test_compress_all_content_backfills_variants(store_path):
+    store = ProjectStore(store_path)
+    content = "<p>compress me</p>\n" * 100
+    content_hash = store._hash_content(content)
+    (store_path / "content").mkdir(exist_ok=True)
+    (store_path / "content" / content_hash).write_text(content)
+
+    assert store.compress_all_content() >= 1
+    assert gzip.decompress(store.load_blob(content_hash, "gzip")).decode() == content
+    assert store.compress_all_content() == 0
+
+    short_hash = store._store_content("tiny")
+    with pytest.raises(FileNotFoundError):
+        store.load_blob(short_hash, "gzip")
+
+
+def test_chunked_blobs_share_unchanged_chunks(store_path):
+    store = ProjectStore(store_path, chunked_blobs=True)
+    lines = [f"<div id='row-{i}'>row {i}</div>\n" for i in range(5000)]
+    store.create_project("chunked", [{"name": "index", "title": "", "content": "".join(lines)}])
+
+    for i in range(10):
+        lines[i * 400] = f"<div>edit {i}</div>\n"
+        store.create_or_update_page("chunked", "index", "".join(lines))
+
+    page = store.load_page("chunked", "index")
+    store.blob_cache.clear()
+    assert store.load_content("chunked", page.content_hash) == "".join(lines)
+
+    usage = store.blobs.usage()
+    assert usage["blobs"] == 11
+    assert usage["stored_bytes"] < usage["logical_bytes"] / 4
+
+
+def test_migrate_blobs_to_chunks_and_back(store_path):
+    store = ProjectStore(store_path)
+    contents = ["".join(f"<p>{i} {j}</p>\n" for i in range(2000)) for j in range(3)]
+    hashes = [store._store_content(c) for c in contents]
+    before = store.blobs.usage()
+
+    chunked = ProjectStore(store_path, chunked_blobs=True)
+    report = chunked.blobs.migrate()
+    assert report["blobs"] == 3
+    assert report["before"] == before["stored_bytes"]
+    assert [chunked.load_content("migrated", h) for h in hashes] == contents
+    assert not any((store_path / "content" / h).exists() for h in hashes)
+
+    plain = ProjectStore(store_path)
+    plain.blobs.migrate()
+    assert plain.blobs.usage()["stored_bytes"] == before["stored_bytes"]
+    assert [(store_path / "content" / h).read_text() for h in hashes] == contents
+
+
+def test_manifests_store_deltas(store_path):
+    store = ProjectStore(store_path)
+    pages = [{"name": f"p{i}", "title": "", "content": f"page {i}"} for i in range(20)]
+    store.create_project("packed", pages)
+    latest = store.create_or_update_page("packed", "p3", "changed")
+    store.delete_page("packed", "p5")
+
+    segment = (store_path / "manifests" / "packed" / "000000.pack").read_text()
+    snapshot, edit, delete = segment.splitlines()
+    assert len(edit) < len(snapshot) / 5
+    assert '"del":["p5"]' in delete
+
+    reopened = ProjectStore(store_path)
+    loaded = reopened.load_project("packed", latest.version)
+    assert [p.name for p in loaded.pages] == [p.name for p in latest.pages]
+    assert len(reopened.load_project("packed").pages) == 19
+
+
+def test_manifests_start_new_segment(store_path, monkeypatch):
+    monkeypatch.setattr("store.SEGMENT_SIZE", 3)
+    store = ProjectStore(store_path)
+    store.create_project("segments", [])
+    for i in range(4):
+        latest = store.create_or_update_page("segments", "index", str(i))
+
+    assert store.index.head_location("segments").segment == 1
+    page = store.load_page("segments", "index")
+    assert store.load_content("segments", page.content_hash) == "3"
+    assert store.load_project("segments").version == latest.version
+
+
+def test_repack_legacy_manifests(store_path):
+    (store_path / "legacy_1.json").write_text(
+        '{"name": "legacy", "version": "1", "pages": '
+        '[{"name": "index", "title": "", "content_hash": "old"}]}'
+    )
+    store = ProjectStore(store_path)
+    assert store.load_page("legacy", "index").content_hash == "old"
+    updated = store.create_or_update_page("legacy", "index", "new")
+
+    assert store.repack("legacy") == 2
+    assert not (store_path / "legacy_1.json").exists()
+    reopened = ProjectStore(store_path)
+    assert reopened.list_project_versions("legacy") == [updated.version, "1"]
+    assert reopened.load_page("legacy", "index", "1").content_hash == "old"
+    page = reopened.load_page("legacy", "index")
+    assert reopened.load_content("legacy", page.content_hash) == "new"
+
+
+def add_pages(path, prefix, count):
+    store = ProjectStore(Path(path))
+    for i in range(count):
+        store.create_or_update_page("busy", f"{prefix}-{i}", f"{prefix} {i}")
+
+
+def test_concurrent_updates_keep_every_page(store_path):
+    store = ProjectStore(store_path)
+    store.create_project("busy", [])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for f in [pool.submit(add_pages, store_path, f"t{n}", 10) for n in range(4)]:
+            f.result()
+    ctx = multiprocessing.get_context("spawn")
+    processes = [
+        ctx.Process(target=add_pages, args=(str(store_path), f"p{n}", 10)) for n in range(3)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    reopened = ProjectStore(store_path)
+    assert len(reopened.load_project("busy").pages) == 70
+    assert len(reopened.list_project_versions("busy")) == 71
+    for version in reopened.list_project_versions("busy"):
+        reopened.load_project("busy", version)
+
+
+def test_expected_version(store_path):
+    store = ProjectStore(store_path)
+    project = store.create_project("cas", [])
+    store.create_or_update_page("cas", "index", "one", expected_version=project.version)
+
+    with pytest.raises(VersionConflict):
+        store.create_or_update_page("cas", "index", "two", expected_version=project.version)
+    with pytest.raises(VersionConflict):
+        store.delete_page("cas", "index", expected_version=project.version)
+    assert len(store.list_project_versions("cas")) == 2
+
+
+def test_assets_are_not_repeated_in_manifests(store_path):
+    store = ProjectStore(store_path)
+    store.create_project("assets", [])
+    with store.blob_writer() as writer:
+        writer.write(b"x" * 1000)
+        content_hash = writer.finish()
+    store.save_asset("assets", "data.bin", content_hash, writer.size)
+    for i in range(3):
+        latest = store.create_or_update_page("assets", "index", str(i))
+    store.delete_asset("assets", "data.bin")
+
+    lines = (store_path / "manifests" / "assets" / "000000.pack").read_text().splitlines()
+    assert [content_hash in line for line in lines] == [False, True, False, False, False, False]
+    assert store.load_project("assets", latest.version).assets[0].content_hash == content_hash
+    assert store.load_project("assets").assets == []
+    assert store.load_blob(content_hash) == b"x" * 1000
+
+
+def test_other_processes_rewrites_invalidate_caches(store_path, monkeypatch):
+    store = ProjectStore(store_path)
+    content = "<p>compress me</p>\n" * 100
+    content_hash = store._hash_content(content)
+    (store_path / "content").mkdir(exist_ok=True)
+    (store_path / "content" / content_hash).write_text(content)
+    with pytest.raises(FileNotFoundError):
+        store.load_blob(content_hash, "gzip")
+
+    # another worker backfills the variant this one cached as missing
+    other = ProjectStore(store_path)
+    assert other.compress_all_content() == 1
+    with pytest.raises(FileNotFoundError):
+        store.load_blob(content_hash, "gzip")
+    monkeypatch.setattr("store.STAMP_CHECK_SECONDS", 0)
+    assert gzip.decompress(store.load_blob(content_hash, "gzip")).decode() == content
+
+    store.create_project("stamped", [])
+    store.load_project("stamped")
+    other.rebuild_index()
+    store.load_project("stamped")
+    assert store.project_cache.misses == 2
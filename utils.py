@@ -1,7 +1,50 @@
 import os
+import sqlite3
+import tempfile
+import threading
 
 def rm(path, no_error=True):
     if os.path.exists(path):
         os.remove(path)
     elif not no_error:
-        raise FileNotFoundError(f"File {path} not found")
\ No newline at end of file
+        raise FileNotFoundError(f"File {path} not found")
+
+
+# readers see either the old file or the whole new one, never a partial write
+def atomic_write(path, data: bytes):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        rm(tmp)
+        raise
+
+
+# whether a process still exists (on this machine)
+def worker_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# the calling thread's connection to the sqlite database at path, kept in
+# local (the owner's threading.local); WAL lets readers in other threads and
+# processes carry on while one writes, and writers wait up to 30s for each
+# other instead of failing. schema runs once per new connection
+def sqlite_conn(local: threading.local, path, schema: str = None) -> sqlite3.Connection:
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        if schema:
+            conn.executescript(schema)
+        local.conn = conn
+    return conn